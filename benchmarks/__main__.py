@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runs the whole benchmark suite and saves its results in a JSON file, to be compared between versions with
+benchmarks.compare. Run it from the root folder of the project:
+
+    python3 -m benchmarks --repeat 3 --output benchmarks/results/baseline.json
+"""
+import argparse
+import os
+import time
+
+from benchmarks import dispatch_benchmark, throughput_benchmark, transfer_benchmark, batch_benchmark, \
+    status_benchmark
+from benchmarks.common import get_revision, run_repeated, save_results, print_results
+
+__author__ = 'Iván de Paz Centeno'
+
+# Benchmark name -> (run function, parameters, parameters of the quick runs).
+BENCHMARKS = {
+    "dispatch": (dispatch_benchmark.run, {"workers": 4, "requests_count": 2000},
+                 {"workers": 2, "requests_count": 200}),
+    "throughput": (throughput_benchmark.run, {"workers_counts": [1, 2, 4, 8], "requests_count": 400,
+                                              "latency": 0.01, "fixture": True},
+                   {"workers_counts": [1, 4], "requests_count": 100, "latency": 0.01, "fixture": True}),
+    "transfer": (transfer_benchmark.run, {"payload_sizes": [1024, 65536, 1048576, 8388608], "requests_count": 50},
+                 {"payload_sizes": [1024, 1048576], "requests_count": 10}),
+    "batch": (batch_benchmark.run, {"elements_count": 500, "payload_size": 65536, "workers": 4},
+              {"elements_count": 100, "payload_size": 65536, "workers": 2}),
+    "status": (status_benchmark.run, {"elements_count": 500, "clients": 8, "workers": 4, "latency": 0.01},
+               {"elements_count": 100, "clients": 4, "workers": 2, "latency": 0.01}),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the benchmark suite.")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="benchmarks to run; all by default.")
+    parser.add_argument("--quick", action="store_true", help="smaller runs, to check that the suite works.")
+    parser.add_argument("--repeat", type=int, default=1, help="amount of runs; the median of each measure is kept.")
+    parser.add_argument("--output", help="JSON file where the results are saved. By default, a file named after the "
+                                         "revision in benchmarks/results/.")
+    args = parser.parse_args()
+
+    output = args.output or os.path.join(os.path.dirname(__file__), "results", "{}_{}.json".format(
+        get_revision() or "unversioned", time.strftime("%Y%m%d%H%M%S")))
+
+    benchmarks = {}
+
+    for name in args.only or sorted(BENCHMARKS):
+        run_function, parameters, quick_parameters = BENCHMARKS[name]
+
+        if args.quick:
+            parameters = quick_parameters
+
+        results = run_repeated(run_function, args.repeat, **parameters)
+        print_results(name, results)
+        benchmarks[name] = {"parameters": parameters, "results": results}
+
+    save_results(output, benchmarks)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the BatchesService: time to process a batch and to finalize it (content.json written and zipped).
+
+The batch is stored in a temporary folder and captured by stub processors that return screenshots of the given size,
+a different one for each URL, so that every screenshot is written to its own blob.
+Run it from the root folder of the project:
+
+    python3 -m benchmarks.batch_benchmark --elements 500 --payload-size 65536 --workers 4
+"""
+import argparse
+import os
+import tempfile
+import time
+from shutil import rmtree
+
+from benchmarks.common import StubProcessor, run_repeated, save_results, print_results
+from main.services.batch_store import SQLiteBatchStore
+from main.services.batches_service import BatchesService
+from main.services.metrics import STAGE_FILE_WRITE, STAGE_ARCHIVE_BUILD
+from main.services.processor_service import ProcessorService
+
+__author__ = 'Iván de Paz Centeno'
+
+
+def _get_mean(snapshots, stage):
+    """
+    :return: mean seconds of the observations of a stage, or 0 if there are none.
+    """
+    if stage not in snapshots:
+        return 0
+
+    _, total_sum, count = snapshots[stage]
+
+    return total_sum / count if count > 0 else 0
+
+
+def run(elements_count=500, payload_size=65536, workers=4):
+    """
+    Creates a batch and waits until its ZIP is ready.
+    :param elements_count: amount of URLs of the batch.
+    :param payload_size: bytes of each screenshot.
+    :param workers: amount of pool workers.
+    :return: dict with the seconds the batch took, its elements per second, the mean seconds of writing the files of an
+    element and the seconds of building the archive.
+    """
+    batches_folder = tempfile.mkdtemp(prefix="screenshooter_benchmark_")
+
+    processor_service = ProcessorService(StubProcessor, workers,
+                                         processor_class_init_args=[{"payload_size": payload_size, "distinct": True}])
+    batches_service = BatchesService(processor_service, batch_store=SQLiteBatchStore(
+        os.path.join(batches_folder, "batches.sqlite3")), batches_folder=batches_folder)
+
+    processor_service.start()
+    batches_service.start()
+
+    urls = ["http://localhost/element/{}".format(index) for index in range(elements_count)]
+
+    start_time = time.time()
+    batch_id = batches_service.new_batch(urls)
+
+    for _ in batches_service.iter_progress(batch_id, keep_alive=1):
+        pass
+
+    elapsed = time.time() - start_time
+    snapshots = batches_service.stage_timings.get_snapshots()
+
+    batches_service.stop()
+    processor_service.stop()
+    processor_service.terminate()
+    rmtree(batches_folder, ignore_errors=True)
+
+    return {
+        "batch_seconds": elapsed,
+        "elements_per_second": elements_count / elapsed,
+        "file_write_seconds": _get_mean(snapshots, STAGE_FILE_WRITE),
+        "archive_build_seconds": _get_mean(snapshots, STAGE_ARCHIVE_BUILD)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the processing and finalization of a batch.")
+    parser.add_argument("--elements", type=int, default=500, help="amount of URLs of the batch.")
+    parser.add_argument("--payload-size", type=int, default=65536, help="bytes of each screenshot.")
+    parser.add_argument("--workers", type=int, default=4, help="amount of pool workers.")
+    parser.add_argument("--repeat", type=int, default=1, help="amount of runs; the median of each measure is kept.")
+    parser.add_argument("--output", help="JSON file where the results are saved.")
+    args = parser.parse_args()
+
+    parameters = {"elements_count": args.elements, "payload_size": args.payload_size, "workers": args.workers}
+    results = run_repeated(run, args.repeat, **parameters)
+    print_results("batch", results)
+
+    if args.output:
+        save_results(args.output, {"batch": {"parameters": parameters, "results": results}})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pieces shared by the benchmarks: a stub processor, a local HTTP fixture server and the machine-readable results.
+"""
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+
+from main.processors.capture_result import CaptureResult
+from main.processors.processor_interface import Processor
+
+__author__ = 'Iván de Paz Centeno'
+
+# Version of the format of the results files.
+RESULTS_FORMAT = 1
+
+# Seed of the payloads generated by the stub processors, so that every run captures the same bytes.
+PAYLOAD_SEED = 1234
+
+
+def make_payload(size):
+    """
+    Generates bytes that do not compress, like the ones of a PNG, always the same ones for the same size.
+    :param size: amount of bytes.
+    """
+    return random.Random(PAYLOAD_SEED).getrandbits(size * 8).to_bytes(size, "little") if size > 0 else b""
+
+
+class StubProcessor(Processor):
+    """
+    Processor that takes a fixed time and returns a fixed payload instead of driving a browser. Optionally it downloads
+    the URL of the request first, for end-to-end runs against the fixture server.
+    """
+
+    def __init__(self, options=None):
+        """
+        :param options: dict with the keys "latency" (seconds each capture takes), "payload_size" (bytes of the
+        screenshot), "fetch" (whether to download the URL of the request) and "distinct" (whether the screenshot of
+        each URL is different; otherwise all of them are the same).
+        """
+        super().__init__()
+        options = options or {}
+        self.latency = float(options.get('latency', 0))
+        self.fetch = bool(options.get('fetch', False))
+        self.distinct = bool(options.get('distinct', False))
+        self.payload = make_payload(int(options.get('payload_size', 0)))
+
+    def process(self, request):
+        dispatched_at = time.time()
+
+        if self.fetch:
+            with urllib.request.urlopen(str(request)) as response:
+                response.read()
+
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        payload = self.payload
+
+        if self.distinct:
+            # The URL replaces the first bytes of the payload, so that its hash differs from the rest of URLs.
+            url_bytes = str(request).encode()[:len(payload)]
+            payload = url_bytes + payload[len(url_bytes):]
+
+        return CaptureResult({"screenshot": payload}, {"dispatched_at": dispatched_at})
+
+
+class _FixtureHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.server.delay > 0:
+            time.sleep(self.server.delay)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(self.server.page)))
+        self.end_headers()
+        self.wfile.write(self.server.page)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FixtureServer(object):
+    """
+    Local HTTP server of a fixed page, so that end-to-end runs do not depend on the network.
+    """
+
+    def __init__(self, page_size=16 * 1024, delay=0):
+        """
+        :param page_size: bytes of the page served for any path.
+        :param delay: seconds the server waits before answering each request.
+        """
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _FixtureHandler)
+        self.server.daemon_threads = True
+        self.server.delay = delay
+        body = b"<p>" + b"x" * max(page_size - 40, 0) + b"</p>"
+        self.server.page = b"<html><body>" + body + b"</body></html>"
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_url(self, path):
+        return "http://127.0.0.1:{}/{}".format(self.server.server_address[1], path.lstrip("/"))
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+
+def summarize_latencies(latencies, prefix="latency"):
+    """
+    :param latencies: list of seconds.
+    :return: dict with the p50, p95 and max of the latencies, in seconds.
+    """
+    return {
+        prefix + "_p50": percentile(latencies, 50),
+        prefix + "_p95": percentile(latencies, 95),
+        prefix + "_max": max(latencies)
+    }
+
+
+def run_repeated(run_function, repeat, **parameters):
+    """
+    Runs a benchmark several times and keeps the median of each of its measures, to smooth out the noise of a run.
+    :param run_function: function that runs the benchmark and returns a dict of measures.
+    :param repeat: amount of runs.
+    :param parameters: arguments for the run function.
+    :return: dict of measure -> median of its values.
+    """
+    runs = [run_function(**parameters) for _ in range(repeat)]
+
+    return {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+
+
+def get_revision():
+    """
+    :return: commit of the working tree, suffixed with "-dirty" if it has changes, or None if it is not a git tree.
+    """
+    try:
+        revision = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                           stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"],
+                                        stderr=subprocess.DEVNULL).strip()
+
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return revision + ("-dirty" if dirty else "")
+
+
+def get_environment():
+    return {
+        "revision": get_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    }
+
+
+def save_results(filename, benchmarks):
+    """
+    Writes the results of the benchmarks with the environment they were run in.
+    :param filename: path of the JSON file.
+    :param benchmarks: dict of benchmark name -> dict with the keys "parameters" and "results".
+    """
+    folder = os.path.dirname(filename)
+
+    if folder != "":
+        os.makedirs(folder, exist_ok=True)
+
+    with open(filename, "w") as f:
+        json.dump({"format": RESULTS_FORMAT, "environment": get_environment(), "benchmarks": benchmarks}, f,
+                  indent=2, sort_keys=True)
+
+    print("Results saved to {}".format(filename), file=sys.stderr)
+
+
+def print_results(name, results):
+    print("{}:".format(name))
+
+    for key, value in sorted(results.items()):
+        if "latency" in key or ("_seconds" in key and "per_second" not in key):
+            print("  {}: {:.3f} ms".format(key, value * 1000))
+        else:
+            print("  {}: {:.2f}".format(key, value))
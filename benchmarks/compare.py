@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compares two results files of the benchmark suite, for example the ones of two versions of the project:
+
+    python3 -m benchmarks.compare benchmarks/results/baseline.json benchmarks/results/candidate.json
+"""
+import argparse
+import json
+import sys
+
+__author__ = 'Iván de Paz Centeno'
+
+
+def is_higher_better(measure):
+    return "per_second" in measure or measure.startswith("efficiency")
+
+
+def compare(baseline, candidate, threshold=0.05):
+    """
+    :param baseline: dict of the results file of the baseline.
+    :param candidate: dict of the results file of the candidate.
+    :param threshold: relative change below which a measure is considered unchanged.
+    :return: list of tuples (benchmark, measure, baseline value, candidate value, relative change, verdict), where the
+    verdict is "better", "worse" or "" for the measures of the benchmarks run in both files with the same parameters.
+    """
+    comparison = []
+
+    for name, candidate_benchmark in sorted(candidate["benchmarks"].items()):
+        baseline_benchmark = baseline["benchmarks"].get(name)
+
+        if baseline_benchmark is None or baseline_benchmark["parameters"] != candidate_benchmark["parameters"]:
+            print("{}: not comparable, run with different parameters or missing in the baseline.".format(name),
+                  file=sys.stderr)
+            continue
+
+        for measure, candidate_value in sorted(candidate_benchmark["results"].items()):
+            baseline_value = baseline_benchmark["results"].get(measure)
+
+            if baseline_value is None:
+                continue
+
+            change = (candidate_value - baseline_value) / abs(baseline_value) if baseline_value != 0 else 0
+            verdict = ""
+
+            if abs(change) >= threshold:
+                verdict = "better" if (change > 0) == is_higher_better(measure) else "worse"
+
+            comparison.append((name, measure, baseline_value, candidate_value, change, verdict))
+
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares two results files of the benchmark suite.")
+    parser.add_argument("baseline", help="results file of the baseline.")
+    parser.add_argument("candidate", help="results file of the candidate.")
+    parser.add_argument("--threshold", type=float, default=0.05,
+                        help="relative change below which a measure is considered unchanged.")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    print("Baseline: {revision} ({timestamp})".format(**baseline["environment"]))
+    print("Candidate: {revision} ({timestamp})".format(**candidate["environment"]))
+
+    for name, measure, baseline_value, candidate_value, change, verdict in compare(baseline, candidate,
+                                                                                    args.threshold):
+        print("{:<12} {:<40} {:>14.6g} {:>14.6g} {:>+8.1%} {}".format(name, measure, baseline_value, candidate_value,
+                                                                        change, verdict))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark of the dispatch of requests from the ProcessorService to the pool workers.
+
+It uses a stub processor with no latency nor payload, so that the measures reflect only the overhead of queueing,
+dispatching and returning the results. Run it from the root folder of the project:
+
+    python3 -m benchmarks.dispatch_benchmark --workers 4 --requests 2000
+"""
+import argparse
+import time
+from threading import Event, Lock
+
+from benchmarks.common import StubProcessor, summarize_latencies, run_repeated, save_results, print_results
+from main.parallelization.promise_set import PromiseSet
+from main.processors.capture_request import CaptureRequest
+from main.services.processor_service import ProcessorService
+
+__author__ = 'Iván de Paz Centeno'
+
+
+def run(workers=4, requests_count=2000):
+    """
+    Queues the requests in a ProcessorService backed by no-op workers and waits for them to be finished.
+    The latency is measured queueing the requests one by one, the throughput queueing all of them at once, first with
+    callbacks and then waiting for their promises with a PromiseSet.
+    :param workers: amount of pool workers.
+    :param requests_count: amount of different requests to queue in each phase.
+    :return: dict with the dispatch latencies (seconds) and the throughputs (requests/sec).
+    """
+    service = ProcessorService(StubProcessor, workers)
+    service.start()
+
+    queued_at = {}
+    latencies = []
+    finished = Event()
+    lock = Lock()
+
+    def request_finished(promise):
+        result = promise.get_result()
+        with lock:
+            latencies.append(result.get_metadata("dispatched_at") - queued_at[str(promise.get_request())])
+            if len(latencies) == expected_count:
+                finished.set()
+
+    def queue(url):
+        queued_at[url] = time.time()
+        service.queue_request(CaptureRequest(url), request_finished)
+
+    # Warms up the pool workers.
+    expected_count = workers
+    for index in range(workers):
+        queue("http://warmup/{}".format(index))
+    finished.wait()
+
+    for index in range(requests_count):
+        finished.clear()
+        expected_count = len(latencies) + 1
+        queue("http://localhost/sequential/{}".format(index))
+        finished.wait()
+
+    sequential_latencies = latencies[workers:]
+
+    finished.clear()
+    expected_count = len(latencies) + requests_count
+    start_time = time.time()
+
+    for index in range(requests_count):
+        queue("http://localhost/burst/{}".format(index))
+
+    finished.wait()
+    elapsed = time.time() - start_time
+
+    start_time = time.time()
+    promises = [service.queue_request(CaptureRequest("http://localhost/promise-set/{}".format(index)))
+                for index in range(requests_count)]
+    PromiseSet(promises).wait_for_all()
+    promise_set_elapsed = time.time() - start_time
+
+    service.stop()
+    service.terminate()
+
+    results = summarize_latencies(sequential_latencies)
+    results["requests_per_second"] = requests_count / elapsed
+    results["promise_set_requests_per_second"] = requests_count / promise_set_elapsed
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmark of the dispatch of requests to the pool workers.")
+    parser.add_argument("--workers", type=int, default=4, help="amount of pool workers.")
+    parser.add_argument("--requests", type=int, default=2000, help="amount of requests to queue.")
+    parser.add_argument("--repeat", type=int, default=1, help="amount of runs; the median of each measure is kept.")
+    parser.add_argument("--output", help="JSON file where the results are saved.")
+    args = parser.parse_args()
+
+    parameters = {"workers": args.workers, "requests_count": args.requests}
+    results = run_repeated(run, args.repeat, **parameters)
+    print_results("dispatch", results)
+
+    if args.output:
+        save_results(args.output, {"dispatch": {"parameters": parameters, "results": results}})
+
+
+if __name__ == '__main__':
+    main()
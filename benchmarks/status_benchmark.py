@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmark of the latency of the status endpoint of a batch under contention.
+
+The web app is served over HTTP on a local port, and a batch of pages of a local fixture server is posted to it. While
+the stub processors download and capture the pages, several clients poll the status of the batch until it is zipped.
+Run it from the root folder of the project:
+
+    python3 -m benchmarks.status_benchmark --elements 500 --clients 8 --workers 4
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import urllib.request
+from shutil import rmtree
+from threading import Thread
+
+from flask import Flask
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from benchmarks.common import StubProcessor, FixtureServer, summarize_latencies, run_repeated, save_results, \
+    print_results
+from main.controllers.custom.web_screenshoot_controller import WebScreenshootController
+from main.services.batch_store import SQLiteBatchStore
+from main.services.batches_service import BatchesService
+from main.services.processor_service import ProcessorService
+
+__author__ = 'Iván de Paz Centeno'
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def _poll_status(status_url, latencies):
+    """
+    Requests the status of a batch until it is zipped, measuring the latency of each request.
+    """
+    is_zipped = False
+
+    while not is_zipped:
+        start_time = time.time()
+
+        with urllib.request.urlopen(status_url) as response:
+            is_zipped = json.loads(response.read().decode())["is_zipped"]
+
+        latencies.append(time.time() - start_time)
+
+
+def run(elements_count=500, clients=8, workers=4, latency=0.01):
+    """
+    :param elements_count: amount of URLs of the batch.
+    :param clients: amount of clients polling the status at the same time.
+    :param workers: amount of pool workers.
+    :param latency: seconds each capture of the stub processor takes, on top of downloading the page.
+    :return: dict with the latencies of the status requests, the status requests per second served and the elements per
+    second captured.
+    """
+    batches_folder = tempfile.mkdtemp(prefix="screenshooter_benchmark_")
+    fixture_server = FixtureServer()
+    fixture_server.start()
+
+    processor_service = ProcessorService(StubProcessor, workers,
+                                         processor_class_init_args=[{"latency": latency, "fetch": True}])
+    batches_service = BatchesService(processor_service, batch_store=SQLiteBatchStore(
+        os.path.join(batches_folder, "batches.sqlite3")), batches_folder=batches_folder)
+
+    processor_service.start()
+    batches_service.start()
+
+    app = Flask(__name__)
+    WebScreenshootController(app, {'web_screenshoot_processor': processor_service,
+                                   'batch_screenshoot_processor': batches_service}, {})
+
+    web_server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=_QuietRequestHandler)
+    web_server_thread = Thread(target=web_server.serve_forever, daemon=True)
+    web_server_thread.start()
+    base_url = "http://127.0.0.1:{}".format(web_server.server_port)
+
+    urls = [fixture_server.get_url("page/{}".format(index)) for index in range(elements_count)]
+    batch_request = urllib.request.Request(base_url + "/web-screenshot/batches", method="POST",
+                                           data=json.dumps({"urls": urls}).encode(),
+                                           headers={"Content-Type": "application/json"})
+
+    start_time = time.time()
+
+    with urllib.request.urlopen(batch_request) as response:
+        batch_id = json.loads(response.read().decode())["batch_id"]
+
+    status_url = "{}/web-screenshot/batches/{}/status".format(base_url, batch_id)
+    latencies = []
+    polling_threads = [Thread(target=_poll_status, args=(status_url, latencies)) for _ in range(clients)]
+
+    for polling_thread in polling_threads:
+        polling_thread.start()
+
+    for polling_thread in polling_threads:
+        polling_thread.join()
+
+    elapsed = time.time() - start_time
+
+    web_server.shutdown()
+    batches_service.stop()
+    processor_service.stop()
+    processor_service.terminate()
+    fixture_server.stop()
+    rmtree(batches_folder, ignore_errors=True)
+
+    results = summarize_latencies(latencies)
+    results["status_requests_per_second"] = len(latencies) / elapsed
+    results["elements_per_second"] = elements_count / elapsed
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the status endpoint under contention.")
+    parser.add_argument("--elements", type=int, default=500, help="amount of URLs of the batch.")
+    parser.add_argument("--clients", type=int, default=8, help="amount of clients polling the status.")
+    parser.add_argument("--workers", type=int, default=4, help="amount of pool workers.")
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds each capture takes.")
+    parser.add_argument("--repeat", type=int, default=1, help="amount of runs; the median of each measure is kept.")
+    parser.add_argument("--output", help="JSON file where the results are saved.")
+    args = parser.parse_args()
+
+    parameters = {"elements_count": args.elements, "clients": args.clients, "workers": args.workers,
+                  "latency": args.latency}
+    results = run_repeated(run, args.repeat, **parameters)
+    print_results("status", results)
+
+    if args.output:
+        save_results(args.output, {"status": {"parameters": parameters, "results": results}})
+
+
+if __name__ == '__main__':
+    main()
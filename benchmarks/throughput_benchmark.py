@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the requests per second that the ProcessorService finishes with different amounts of pool workers.
+
+Every capture of the stub processor takes a fixed latency, so that the measures show how well the service keeps the
+workers busy. With --fixture the stub processor also downloads each URL from a local HTTP fixture server. Run it from
+the root folder of the project:
+
+    python3 -m benchmarks.throughput_benchmark --workers 1 2 4 8 --requests 400 --latency 0.01
+"""
+import argparse
+import time
+from threading import Event, Lock
+
+from benchmarks.common import StubProcessor, FixtureServer, run_repeated, save_results, print_results
+from main.processors.capture_request import CaptureRequest
+from main.services.processor_service import ProcessorService
+
+__author__ = 'Iván de Paz Centeno'
+
+
+def run(workers_counts=(1, 2, 4, 8), requests_count=400, latency=0.01, fixture=False):
+    """
+    Queues all the requests at once in a ProcessorService for each amount of workers, and waits for them to be finished.
+    :param workers_counts: amounts of pool workers to measure.
+    :param requests_count: amount of different requests to queue for each amount of workers.
+    :param latency: seconds each capture of the stub processor takes.
+    :param fixture: whether the stub processor downloads the URLs from a local fixture server.
+    :return: dict with the throughput (requests/sec) for each amount of workers.
+    """
+    fixture_server = None
+
+    if fixture:
+        fixture_server = FixtureServer()
+        fixture_server.start()
+
+    def get_url(path):
+        return fixture_server.get_url(path) if fixture_server is not None else "http://localhost/" + path
+
+    results = {}
+
+    for workers in workers_counts:
+        service = ProcessorService(StubProcessor, workers,
+                                   processor_class_init_args=[{"latency": latency, "fetch": fixture}])
+        service.start()
+
+        finished = Event()
+        lock = Lock()
+        finished_count = [0]
+
+        def request_finished(promise, expected_count):
+            with lock:
+                finished_count[0] += 1
+                if finished_count[0] == expected_count:
+                    finished.set()
+
+        # Warms up the pool workers.
+        for index in range(workers):
+            service.queue_request(CaptureRequest(get_url("warmup/{}".format(index))),
+                                  lambda promise: request_finished(promise, workers))
+        finished.wait()
+
+        finished.clear()
+        finished_count[0] = 0
+        start_time = time.time()
+
+        for index in range(requests_count):
+            service.queue_request(CaptureRequest(get_url("burst/{}".format(index))),
+                                  lambda promise: request_finished(promise, requests_count))
+
+        finished.wait()
+        elapsed = time.time() - start_time
+
+        service.stop()
+        service.terminate()
+
+        results["requests_per_second_{}_workers".format(workers)] = requests_count / elapsed
+
+        # Ideal throughput is workers / latency; the efficiency tells how much of it is lost in the service.
+        if latency > 0:
+            results["efficiency_{}_workers".format(workers)] = requests_count / elapsed / (workers / latency)
+
+    if fixture_server is not None:
+        fixture_server.stop()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the requests per second at N pool workers.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="amounts of pool workers.")
+    parser.add_argument("--requests", type=int, default=400, help="amount of requests to queue.")
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds each capture takes.")
+    parser.add_argument("--fixture", action="store_true", help="download the URLs from a local fixture server.")
+    parser.add_argument("--repeat", type=int, default=1, help="amount of runs; the median of each measure is kept.")
+    parser.add_argument("--output", help="JSON file where the results are saved.")
+    args = parser.parse_args()
+
+    parameters = {"workers_counts": args.workers, "requests_count": args.requests, "latency": args.latency,
+                  "fixture": args.fixture}
+    results = run_repeated(run, args.repeat, **parameters)
+    print_results("throughput", results)
+
+    if args.output:
+        save_results(args.output, {"throughput": {"parameters": parameters, "results": results}})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the cost of transferring the results from the pool workers to the ProcessorService, by payload size.
+
+The stub processor returns a screenshot of the given size with no latency; the requests are queued one by one and the
+time from queueing each of them to reading its screenshot is measured. The cost of the transfer is the difference with
+the requests of empty screenshots. Run it from the root folder of the project:
+
+    python3 -m benchmarks.transfer_benchmark --sizes 1024 65536 1048576 8388608 --requests 50
+"""
+import argparse
+import time
+from threading import Event
+
+from benchmarks.common import StubProcessor, percentile, run_repeated, save_results, print_results
+from main.processors.capture_request import CaptureRequest
+from main.services.processor_service import ProcessorService
+
+__author__ = 'Iván de Paz Centeno'
+
+
+def _measure_round_trips(payload_size, requests_count):
+    """
+    :return: list of seconds from queueing each request to having read its screenshot.
+    """
+    service = ProcessorService(StubProcessor, 1, processor_class_init_args=[{"payload_size": payload_size}])
+    service.start()
+
+    round_trips = []
+    finished = Event()
+
+    def request_finished(promise):
+        # Reads the screenshot, as the consumers of the results do.
+        promise.get_result().get_image().tobytes()
+        round_trips.append(time.time() - queued_at)
+        finished.set()
+
+    # The first request warms up the pool worker.
+    for index in range(requests_count + 1):
+        finished.clear()
+        queued_at = time.time()
+        service.queue_request(CaptureRequest("http://localhost/{}/{}".format(payload_size, index)), request_finished)
+        finished.wait()
+
+    service.stop()
+    service.terminate()
+
+    return round_trips[1:]
+
+
+def run(payload_sizes=(1024, 65536, 1048576, 8388608), requests_count=50):
+    """
+    :param payload_sizes: bytes of the screenshots to measure.
+    :param requests_count: amount of requests to measure for each size.
+    :return: dict with the p50 round trip for each size, the cost of the transfer over the round trip of empty
+    screenshots and the megabytes per second moved in a round trip.
+    """
+    baseline = percentile(_measure_round_trips(0, requests_count), 50)
+    results = {"latency_p50_0_bytes": baseline}
+
+    for payload_size in payload_sizes:
+        round_trip = percentile(_measure_round_trips(payload_size, requests_count), 50)
+
+        results["latency_p50_{}_bytes".format(payload_size)] = round_trip
+        results["transfer_seconds_{}_bytes".format(payload_size)] = round_trip - baseline
+        results["megabytes_per_second_{}_bytes".format(payload_size)] = payload_size / round_trip / 1024 / 1024
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the cost of transferring results by payload size.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 65536, 1048576, 8388608],
+                        help="bytes of the screenshots.")
+    parser.add_argument("--requests", type=int, default=50, help="amount of requests for each size.")
+    parser.add_argument("--repeat", type=int, default=1, help="amount of runs; the median of each measure is kept.")
+    parser.add_argument("--output", help="JSON file where the results are saved.")
+    args = parser.parse_args()
+
+    parameters = {"payload_sizes": args.sizes, "requests_count": args.requests}
+    results = run_repeated(run, args.repeat, **parameters)
+    print_results("transfer", results)
+
+    if args.output:
+        save_results(args.output, {"transfer": {"parameters": parameters, "results": results}})
+
+
+if __name__ == '__main__':
+    main()
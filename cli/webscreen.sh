@@ -27,24 +27,23 @@ function batch_captures
 
     preparebar 30 "#"
 
-    completion_progress=0
-    is_zipped="false"
-
-    while [[ "${completion_progress}" != "100" ]];
-    do
-        status=$(curl -s -X GET "$BACKEND/web-screenshot/batches/${batch_id}/status")
-        completion_progress=$(echo "${status}" | jq '.["percentage_completed"]')
-        progressbar ${completion_progress} 100
-        sleep 0.5
-    done
-    echo ""
-    echo -e "Backend finished getting screenshots, now it is zipping the results\c"
-    while [[ "${is_zipped}" == "false" ]];
+    # The backend pushes the progress of the batch as Server-Sent Events; the last one tells that the zip is ready.
+    curl -s -N -X GET "$BACKEND/web-screenshot/batches/${batch_id}/events" | while read -r line;
     do
-        status=$(curl -s -X GET "$BACKEND/web-screenshot/batches/${batch_id}/status")
-        is_zipped=$(echo "${status}" | jq '.["is_zipped"]')
-        echo -e ".\c"
-        sleep 0.5
+        case "${line}" in
+            "event: "*)
+                event="${line#event: }"
+                ;;
+            "data: "*)
+                if [[ "${event}" == "progress" ]];
+                then
+                    progressbar $(echo "${line#data: }" | jq '.["percentage_completed"]') 100
+                elif [[ "${event}" == "ready" ]] || [[ "${event}" == "error" ]];
+                then
+                    break
+                fi
+                ;;
+        esac
     done
     echo ""
     echo "Done. Retrieving the zip file..."
@@ -53,6 +52,16 @@ function batch_captures
     echo "Finished"
 }
 
+function batch_stream_captures
+{
+    json_file="$1"
+    output="$2"
+    batch_id=$(curl -s -X -k POST "${BACKEND}/web-screenshot/batches" -X POST -d @"${json_file}" | jq '.["batch_id"]')
+    echo "Started batch with ID ${batch_id}, downloading the captures as they are taken..."
+    curl -s -N -X GET "$BACKEND/web-screenshot/batches/${batch_id}/stream" > "${output}"
+    echo "Finished"
+}
+
 case $1 in
     capture)
       web_url="$2"
@@ -66,8 +75,15 @@ case $1 in
       batch_captures "${web_urls_json_file}" "${output}"
       echo "Done. Saved in ZIP format inside ${output}"
       ;;
+    batch-stream)
+      web_urls_json_file="$2"
+      echo "Capturing screen of URLs from JSON file ${web_urls_json_file}..."
+      batch_stream_captures "${web_urls_json_file}" "${output}"
+      echo "Done. Saved in ZIP format inside ${output}"
+      ;;
       *)
       echo "Usage: webscreen capture https://www.google.com/ -o image.png"
       echo "Usage: webscreen batch json_urls_file -o images_result.zip"
+      echo "Usage: webscreen batch-stream json_urls_file -o images_result.zip"
 esac
 
@@ -3,10 +3,20 @@
 from flask import Flask, url_for, jsonify
 import json
 from main.controllers.controller_factory import ControllerFactory
+from main.controllers.custom.diagnostics_controller import DiagnosticsController
+from main.controllers.custom.metrics_controller import MetricsController
 from main.controllers.custom.web_screenshoot_controller import WebScreenshootController
+from main.controllers.custom.workers_controller import WorkersController
+from main.parallelization.request_scheduler import RequestScheduler
+from main.processors.image_encoder import ImageEncoder
 from main.processors.phantomjs_processor import PhantomJSProcessor
+from main.services.admission_control import AdmissionControl
 from main.services.batches_service import BatchesService
+from main.services.change_detector import ChangeDetector
 from main.services.processor_service import ProcessorService
+from main.services.remote_workers_service import RemoteWorkersService
+from main.services.result_cache import ResultCache
+from main.services.tracing import Tracer
 
 __author__ = 'Iván de Paz Centeno'
 
@@ -45,19 +55,63 @@ config = load_config()
 controller_factory = ControllerFactory(app, config)
 
 # Services to inject to the controller. They are accessible from the controller side.
-processor_service = ProcessorService(PhantomJSProcessor, int(config['workers']))
+result_cache = ResultCache.from_config(config['cache']) if 'cache' in config else None
+
+if ImageEncoder.is_available():
+    image_encoder = ImageEncoder(int(config.get('images', {}).get('encoders', 2)))
+else:
+    print("Pillow is not installed: post-processing of the images is disabled.")
+    image_encoder = None
+
+processor_service = ProcessorService(PhantomJSProcessor, int(config['workers']),
+                                     processor_class_init_args=[config.get('processor', {})],
+                                     result_cache=result_cache, image_encoder=image_encoder,
+                                     requests_per_worker=int(config.get('processor', {}).get('tabs', 1)),
+                                     scheduler=RequestScheduler.from_config(config.get('scheduler', {})),
+                                     tracer=Tracer.from_config(config.get('tracing', {})),
+                                     change_detector=ChangeDetector.from_config(config.get('change_detection', {})))
 
 services = {
     'web_screenshoot_processor': processor_service,
-    'batch_screenshoot_processor': BatchesService(processor_service)
+    'batch_screenshoot_processor': BatchesService.from_config(processor_service, config.get('batches', {}))
 }
 
 for service in services.values(): service.start()
 
-controller_factory.create_controller(WebScreenshootController, services)
+if 'admission' in config:
+    # Turns away requests when the work ahead of them would take too long.
+    services['admission_control'] = AdmissionControl.from_config(processor_service,
+                                                                 services['batch_screenshoot_processor'],
+                                                                 config['admission'])
+
+web_screenshoot_controller = controller_factory.create_controller(WebScreenshootController, services)
+
+if 'remote_workers' in config:
+    # Worker agents on other machines pull requests from this node (see main/bin/worker_agent.py).
+    remote_workers_service = RemoteWorkersService.from_config(processor_service, config['remote_workers'])
+    remote_workers_service.start()
+    controller_factory.create_controller(WorkersController, {'remote_workers': remote_workers_service})
+else:
+    remote_workers_service = None
+
+controller_factory.create_controller(MetricsController, dict(services, remote_workers=remote_workers_service))
+controller_factory.create_controller(DiagnosticsController, services)
 
 print("Visit http://{}:{}/site-map for a list of endpoints.".format(config['host'], config['port']))
 
-app.run(config['host'], config['port'], threaded=True)
+server_config = config.get('server', {})
+
+if server_config.get('mode', "threaded") == "asgi":
+    # Captures are awaited without holding a thread. Requires uvicorn.
+    import uvicorn
+    from main.controllers.asgi_app import AsgiApp
+
+    asgi_app = AsgiApp(app, web_screenshoot_controller, float(server_config.get('make_timeout', 60)),
+                       int(server_config.get('wsgi_threads', 64)))
+    uvicorn.run(asgi_app, host=config['host'], port=int(config['port']),
+                backlog=int(server_config.get('backlog', 2048)))
+
+else:
+    app.run(config['host'], config['port'], threaded=True)
 
 controller_factory.release_all()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Worker agent: captures the requests of a remote API node with a local processor.
+
+It long-polls the API node for leases of jobs, processes them and sends back the result of each job as soon as it is
+available, sending heartbeats meanwhile to keep its leases alive. Run it from the root folder of the project:
+
+    python3 -m main.bin.worker_agent --server http://api-node:1448
+
+Several agents can run on the same machine; each of them drives its own processor.
+"""
+import argparse
+import importlib
+import json
+import os
+import socket
+import urllib.error
+import urllib.request
+from threading import Thread, Event
+
+from main.processors.capture_request import CaptureRequest
+
+__author__ = 'Iván de Paz Centeno'
+
+DEFAULT_PROCESSOR = "main.processors.phantomjs_processor.PhantomJSProcessor"
+DEFAULT_POLL_WAIT = 20
+RETRY_DELAY = 2
+
+
+def load_config():
+    with open("main/etc/config.json") as f:
+        config = json.load(f)
+
+    return config
+
+
+def load_processor_class(path):
+    """
+    Imports a processor class.
+    :param path: dotted path of the class, for example "main.processors.phantomjs_processor.PhantomJSProcessor".
+    """
+    module_name, class_name = path.rsplit(".", 1)
+
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+class WorkerAgent(object):
+    """
+    Pulls jobs from an API node and processes them with a processor.
+    """
+
+    def __init__(self, server_url, agent_id, processor, max_jobs=1, token=None, poll_wait=DEFAULT_POLL_WAIT):
+        """
+        Initializes the agent.
+        :param server_url: base URL of the API node.
+        :param agent_id: identifier of the agent, unique among the agents of the API node.
+        :param processor: processor that captures the jobs.
+        :param max_jobs: maximum amount of jobs to lease at once.
+        :param token: secret of the workers of the API node, if any.
+        :param poll_wait: seconds to wait for jobs in each poll.
+        """
+        self.server_url = server_url.rstrip("/")
+        self.agent_id = agent_id
+        self.processor = processor
+        self.max_jobs = max_jobs
+        self.token = token
+        self.poll_wait = poll_wait
+        self.heartbeat_interval = None
+        self.stop_event = Event()
+
+    def _post(self, path, payload=None, data=None, headers=None, method="POST", timeout=30):
+        """
+        Sends a request to the API node.
+        :return: tuple (HTTP status, decoded JSON of the response or None)
+        """
+        headers = dict(headers or {})
+
+        if payload is not None:
+            data = json.dumps(payload).encode()
+            headers['Content-Type'] = "application/json"
+
+        if self.token is not None:
+            headers['X-Worker-Token'] = self.token
+
+        http_request = urllib.request.Request(self.server_url + path, data=data, headers=headers, method=method)
+
+        try:
+            with urllib.request.urlopen(http_request, timeout=timeout) as response:
+                body = response.read()
+                status = response.status
+
+        except urllib.error.HTTPError as ex:
+            body = ex.read()
+            status = ex.code
+
+        return status, json.loads(body.decode()) if len(body) > 0 else None
+
+    def _heartbeat_loop(self):
+        while not self.stop_event.wait(self.heartbeat_interval or RETRY_DELAY):
+            try:
+                self._post("/workers/heartbeat", {"agent_id": self.agent_id})
+
+            except Exception as ex:
+                print("Heartbeat failed: {}".format(ex))
+
+    def _send_result(self, lease_id, job_id, result):
+        if result is None:
+            description = {"failed": True}
+            data = b""
+        else:
+            images = result.get_images()
+            description = {"metadata": result.get_metadata(),
+                           "images": [[name, len(image)] for name, image in images.items()]}
+            data = b"".join(bytes(image) for image in images.values())
+
+        status, response = self._post("/workers/leases/{}/jobs/{}".format(lease_id, job_id), data=data, method="PUT",
+                                      headers={'X-Capture-Result': json.dumps(description),
+                                               'Content-Type': "application/octet-stream"})
+
+        if status != 200:
+            # For example, because the lease expired and its jobs were given to other workers.
+            print("Result of job {} of lease {} rejected: {}".format(job_id, lease_id, response))
+
+    def _process_lease(self, lease):
+        lease_id = lease['lease_id']
+        requests = []
+        job_ids = {}
+
+        for job in lease['jobs']:
+            request = CaptureRequest(job['url'], job['options'])
+            requests.append(request)
+            job_ids[id(request)] = job['job_id']
+
+        def deliver(request, result):
+            try:
+                self._send_result(lease_id, job_ids[id(request)], result)
+            except Exception as ex:
+                print("Could not send the result of job {} of lease {}: {}".format(job_ids[id(request)], lease_id, ex))
+
+        self.processor.process_many(requests, deliver)
+
+    def run(self):
+        """
+        Processes jobs until stop() is invoked.
+        """
+        heartbeat_thread = Thread(target=self._heartbeat_loop, daemon=True)
+        heartbeat_thread.start()
+
+        print("Agent {} pulling jobs from {}".format(self.agent_id, self.server_url))
+
+        while not self.stop_event.is_set():
+            try:
+                status, lease = self._post("/workers/lease", {"agent_id": self.agent_id, "max_jobs": self.max_jobs,
+                                                              "wait": self.poll_wait},
+                                           timeout=self.poll_wait + 30)
+            except Exception as ex:
+                print("Could not reach {}: {}".format(self.server_url, ex))
+                self.stop_event.wait(RETRY_DELAY)
+                continue
+
+            if status == 204:
+                continue
+
+            if status != 200:
+                print("Lease rejected: {}".format(lease))
+                self.stop_event.wait(RETRY_DELAY)
+                continue
+
+            # Heartbeats are sent well before the lease expires.
+            self.heartbeat_interval = lease['lease_timeout'] / 3
+            self._process_lease(lease)
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Captures the requests of a remote API node.")
+    parser.add_argument("--server", required=True, help="base URL of the API node, for example http://api-node:1448")
+    parser.add_argument("--agent-id", default="{}-{}".format(socket.gethostname(), os.getpid()),
+                        help="identifier of this agent")
+    parser.add_argument("--processor", default=DEFAULT_PROCESSOR, help="dotted path of the processor class")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="maximum jobs to lease at once (by default, the tabs of the processor)")
+    parser.add_argument("--token", default=None, help="secret of the workers of the API node")
+    args = parser.parse_args()
+
+    processor_config = load_config().get('processor', {})
+    processor = load_processor_class(args.processor)(processor_config)
+    max_jobs = args.jobs if args.jobs is not None else int(processor_config.get('tabs', 1))
+
+    WorkerAgent(args.server, args.agent_id, processor, max_jobs, args.token).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import time
+
+from main.controllers.wsgi_bridge import WsgiBridge, DEFAULT_WSGI_THREADS
+from main.exceptions.invalid_request import InvalidRequest
+from main.services.tracing import TRACE_ID_HEADER
+
+__author__ = 'Iván de Paz Centeno'
+
+DEFAULT_MAKE_TIMEOUT = 60
+SEND_CHUNK_SIZE = 256 * 1024
+
+
+class AsgiApp(object):
+    """
+    ASGI application that serves /web-screenshot/make asynchronously: a pending capture is awaited by the event loop
+    instead of holding a thread, so a single node can keep thousands of them pending. Each capture has a timeout, and it
+    is aborted if the client disconnects or the timeout expires before it is done.
+
+    The rest of the routes are served by the Flask application, through a WSGI bridge that runs them in a pool of
+    threads, so that long-polls and streams do not block the other requests.
+    """
+
+    def __init__(self, flask_app, web_screenshoot_controller, make_timeout=DEFAULT_MAKE_TIMEOUT,
+                 wsgi_threads=DEFAULT_WSGI_THREADS):
+        """
+        Constructor of the application.
+        :param flask_app: Flask application with all the routes.
+        :param web_screenshoot_controller: WebScreenshootController, which validates the requests and builds the
+        responses.
+        :param make_timeout: maximum seconds to wait for a capture. Requests can ask for a shorter timeout.
+        :param wsgi_threads: amount of requests to the rest of the routes served at the same time.
+        """
+        self.wsgi_app = WsgiBridge(flask_app, wsgi_threads)
+        self.controller = web_screenshoot_controller
+        self.make_timeout = float(make_timeout)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._handle_lifespan(receive, send)
+
+        elif scope['type'] == 'http' and scope['path'] == "/web-screenshot/make" and scope['method'] == "PUT":
+            await self._handle_make(scope, receive, send)
+
+        else:
+            await self.wsgi_app(scope, receive, send)
+
+    @staticmethod
+    async def _handle_lifespan(receive, send):
+        while True:
+            message = await receive()
+
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def _read_body(receive):
+        """
+        Reads the whole body of the request.
+        :return: body as bytes, or None if the client disconnected.
+        """
+        body = bytearray()
+
+        while True:
+            message = await receive()
+
+            if message['type'] == 'http.disconnect':
+                return None
+
+            body += message.get('body', b"")
+
+            if not message.get('more_body', False):
+                return bytes(body)
+
+    @staticmethod
+    def _get_header(scope, name):
+        """
+        :return: value of a header of the request, or None if it was not sent.
+        """
+        name = name.lower().encode()
+
+        for header_name, value in scope.get('headers', []):
+            if header_name.lower() == name:
+                return value.decode('latin-1')
+
+        return None
+
+    @staticmethod
+    async def _send_response(send, status, mimetype, body_chunks, headers=None, content_length=None):
+        raw_headers = [(b"content-type", mimetype.encode())]
+
+        if content_length is not None:
+            raw_headers.append((b"content-length", str(content_length).encode()))
+
+        for name, value in (headers or {}).items():
+            raw_headers.append((name.lower().encode(), str(value).encode()))
+
+        await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+
+        for chunk in body_chunks:
+            await send({'type': 'http.response.body', 'body': bytes(chunk), 'more_body': True})
+
+        await send({'type': 'http.response.body', 'body': b""})
+
+    async def _send_error(self, send, error):
+        body = json.dumps(error.to_dict()).encode()
+        headers = {'Retry-After': error.retry_after} if hasattr(error, 'retry_after') else None
+        await self._send_response(send, error.status_code, "application/json", [body], headers, len(body))
+
+    def _get_timeout(self, json_request):
+        timeout = json_request.get('timeout')
+
+        if timeout is None:
+            return self.make_timeout
+
+        try:
+            timeout = float(timeout)
+        except (TypeError, ValueError):
+            raise InvalidRequest("timeout must be a number of seconds.")
+
+        if timeout <= 0:
+            raise InvalidRequest("timeout must be positive.")
+
+        return min(timeout, self.make_timeout)
+
+    @staticmethod
+    def _get_future(promise, loop):
+        """
+        Wraps a promise in a future of the event loop.
+        """
+        future = loop.create_future()
+
+        def set_future_result(result):
+            if not future.done():
+                future.set_result(result)
+
+        # The promise is fulfilled from the threads of the service; the future can only be touched from the loop.
+        promise.add_done_callback(lambda done_promise: loop.call_soon_threadsafe(set_future_result,
+                                                                                  done_promise.get_result()))
+
+        return future
+
+    async def _handle_make(self, scope, receive, send):
+        start_time = time.time()
+        body = await self._read_body(receive)
+
+        if body is None:
+            return
+
+        try:
+            json_request = json.loads(body.decode())
+        except ValueError:
+            json_request = None
+
+        try:
+            client = scope.get('client')
+            trace_id = self._get_header(scope, TRACE_ID_HEADER)
+            capture_request, image_name = self.controller.parse_make_request(json_request,
+                                                                              client[0] if client else None, trace_id)
+            timeout = self._get_timeout(json_request)
+            self.controller.check_make_admission()
+        except InvalidRequest as ex:
+            await self._send_error(send, ex)
+            return
+
+        loop = asyncio.get_running_loop()
+        service = self.controller.available_services['web_screenshoot_processor']
+
+        # Queueing may read the disk cache, which must not stall the loop.
+        promise = await loop.run_in_executor(None, service.queue_request, capture_request)
+        result_future = self._get_future(promise, loop)
+        disconnect_task = asyncio.ensure_future(receive())
+
+        done, _ = await asyncio.wait([result_future, disconnect_task], timeout=timeout,
+                                     return_when=asyncio.FIRST_COMPLETED)
+
+        if result_future not in done:
+            promise.abort()
+            result_future.cancel()
+
+            if disconnect_task in done:
+                return
+
+            disconnect_task.cancel()
+            await self._send_error(send, InvalidRequest("Screenshot of the specified URL took longer than {} "
+                                                        "seconds.".format(timeout), status_code=504))
+            return
+
+        disconnect_task.cancel()
+        result = result_future.result()
+
+        try:
+            mimetype, headers, image = self.controller.get_make_response_parts(result, image_name)
+        except InvalidRequest as ex:
+            await self._send_error(send, ex)
+            return
+
+        self.controller.trace_make_request(capture_request, start_time, headers)
+
+        if image is None:
+            await self._send_response(send, 200, mimetype, self.controller.iter_result_zip(result), headers)
+        else:
+            image_buffer = image.getbuffer()
+            chunks = (image_buffer[offset:offset + SEND_CHUNK_SIZE]
+                      for offset in range(0, len(image_buffer), SEND_CHUNK_SIZE))
+            await self._send_response(send, 200, mimetype, chunks, headers, content_length=len(image_buffer))
@@ -94,4 +94,8 @@ class Controller(object):
         """
         response = jsonify(error.to_dict())
         response.status_code = error.status_code
+
+        if hasattr(error, 'retry_after'):
+            response.headers['Retry-After'] = str(error.retry_after)
+
         return response
\ No newline at end of file
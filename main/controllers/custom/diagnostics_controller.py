@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import hmac
+import pstats
+
+from flask import jsonify, request, Response
+from main.controllers.controller import route, Controller
+from main.exceptions.invalid_request import InvalidRequest
+from main.parallelization.worker_profiling import ProfilingSettings, DEFAULT_PROFILES_FOLDER, get_profiled_pids, \
+    get_profile_stats, remove_profiles
+
+__author__ = "Ivan de Paz Centeno"
+
+DEFAULT_TRACES_LIMIT = 100
+DEFAULT_STATS_LIMIT = 50
+PROFILE_SORT_KEYS = sorted(pstats.Stats.sort_arg_dict_default)
+
+
+class DiagnosticsController(Controller):
+    """
+    Controller for /traces/ and /profiling/ URLs: the traces of the captures, and the sampled profiling of the pool
+    workers, which is switched on and off without restarting them.
+
+    Traces reveal the URLs captured for every client, so all the routes require the admin token ("profiling.token" in
+    the configuration); without it, they are disabled.
+    """
+
+    def __init__(self, flask_web_app, available_services, config):
+        """
+        Constructor of the controller.
+        :param flask_web_app: web app from Flask already initialized.
+        :param available_services: list of services filtered to be compatible with this controller.
+        :param config: config object containing all the service definitions.
+        """
+        Controller.__init__(self, flask_web_app, available_services, config)
+
+        profiling_config = config.get('profiling', {})
+        self.profiles_folder = profiling_config.get('folder', DEFAULT_PROFILES_FOLDER)
+        self.token = profiling_config.get('token') or None
+
+        if self.token is None:
+            print("profiling.token is not set: the /traces and /profiling routes are disabled.")
+
+        self.exposed_methods += [
+            self.get_traces,
+            self.get_trace,
+            self.get_profiling,
+            self.set_profiling,
+            self.get_profiling_stats,
+            self.reset_profiling_stats
+        ]
+
+        self._init_exposed_methods()
+
+    def _get_processor_service(self):
+        return self.available_services['web_screenshoot_processor']
+
+    def _check_token(self):
+        if self.token is None:
+            raise InvalidRequest("Diagnostics are disabled: profiling.token is not set.", status_code=403)
+
+        token = request.headers.get('X-Admin-Token')
+
+        if token is None or not hmac.compare_digest(token.encode(), self.token.encode()):
+            raise InvalidRequest("Invalid admin token.", status_code=403)
+
+    @staticmethod
+    def _get_int_argument(name, default, minimum=1):
+        try:
+            value = int(request.args.get(name, default))
+        except ValueError:
+            raise InvalidRequest("{} must be an integer.".format(name))
+
+        if value < minimum:
+            raise InvalidRequest("{} must be at least {}.".format(name, minimum))
+
+        return value
+
+    def _export_traces(self, trace_ids):
+        """
+        :return: response with the traces in the format requested: "json" (default) or "chrome".
+        """
+        tracer = self._get_processor_service().tracer
+        export_format = request.args.get('format', "json")
+
+        if export_format == "chrome":
+            return jsonify(tracer.export_chrome(trace_ids))
+
+        if export_format != "json":
+            raise InvalidRequest("format must be json or chrome.")
+
+        return jsonify({"traces": {trace_id: tracer.get_trace(trace_id) for trace_id in trace_ids}})
+
+    @route("/traces", methods=['GET'])
+    def get_traces(self):
+        """
+        Lists the traces kept, the most recent ones first (or the slowest ones, with sort=slowest). With format=json or
+        format=chrome, the spans of the listed traces are exported instead.
+        """
+        self._check_token()
+        tracer = self._get_processor_service().tracer
+        sort = request.args.get('sort', "recent")
+
+        if sort not in ["recent", "slowest"]:
+            raise InvalidRequest("sort must be recent or slowest.")
+
+        summaries = tracer.list_traces(self._get_int_argument('limit', DEFAULT_TRACES_LIMIT), sort == "slowest")
+
+        if 'format' in request.args:
+            return self._export_traces([summary["trace_id"] for summary in summaries])
+
+        return jsonify({"traces": summaries})
+
+    @route("/traces/<trace_id>", methods=['GET'])
+    def get_trace(self, trace_id):
+        self._check_token()
+
+        if self._get_processor_service().tracer.get_trace(trace_id) is None:
+            raise InvalidRequest("Trace ID not valid or not kept anymore.", status_code=404)
+
+        return self._export_traces([trace_id])
+
+    def _get_profiling_dict(self):
+        service = self._get_processor_service()
+        profiling_settings = service.get_profiling_settings() or ProfilingSettings(folder=self.profiles_folder)
+
+        return {
+            "profiling": profiling_settings.to_dict(),
+            "workers": service.get_worker_pids(),
+            "profiled_workers": get_profiled_pids(self.profiles_folder)
+        }
+
+    @route("/profiling", methods=['GET'])
+    def get_profiling(self):
+        self._check_token()
+
+        return jsonify(self._get_profiling_dict())
+
+    @route("/profiling", methods=['PUT'])
+    def set_profiling(self):
+        """
+        Switches the profiling of the pool workers. The JSON has the "sample_rate" (fraction of the chunks of requests
+        profiled, 0 to switch it off) and optionally the list of PIDs of the "workers" that profile (all of them by
+        default).
+        """
+        self._check_token()
+        json_request = request.get_json(force=True, silent=True, cache=False) or {}
+
+        try:
+            sample_rate = float(json_request.get('sample_rate', 0))
+            worker_pids = json_request.get('workers')
+            worker_pids = None if worker_pids is None else [int(pid) for pid in worker_pids]
+
+        except (TypeError, ValueError):
+            raise InvalidRequest("sample_rate must be a number and workers a list of PIDs.")
+
+        if not 0 <= sample_rate <= 1:
+            raise InvalidRequest("sample_rate must be between 0 and 1.")
+
+        service = self._get_processor_service()
+        previous_settings = service.get_profiling_settings()
+        generation = 0 if previous_settings is None else previous_settings.generation
+
+        service.set_profiling_settings(ProfilingSettings(sample_rate, worker_pids, generation, self.profiles_folder))
+
+        return jsonify(self._get_profiling_dict())
+
+    @route("/profiling/stats", methods=['GET'])
+    def get_profiling_stats(self):
+        """
+        Retrieves the report of the profiles dumped by the workers, merged. Optional arguments: "sort" (key of pstats),
+        "limit" (amount of functions) and "workers" (comma-separated PIDs).
+        """
+        self._check_token()
+        sort = request.args.get('sort', "cumulative")
+
+        if sort not in PROFILE_SORT_KEYS:
+            raise InvalidRequest("sort must be one of {}.".format(", ".join(PROFILE_SORT_KEYS)))
+
+        try:
+            worker_pids = [int(pid) for pid in request.args['workers'].split(",")] \
+                if 'workers' in request.args else None
+        except ValueError:
+            raise InvalidRequest("workers must be a comma-separated list of PIDs.")
+
+        report = get_profile_stats(self.profiles_folder, worker_pids, sort,
+                                   self._get_int_argument('limit', DEFAULT_STATS_LIMIT))
+
+        if report is None:
+            raise InvalidRequest("No profile was dumped yet.", status_code=404)
+
+        return Response(report, mimetype="text/plain")
+
+    @route("/profiling/stats", methods=['DELETE'])
+    def reset_profiling_stats(self):
+        """
+        Discards the profiles dumped so far; the workers start new ones.
+        """
+        self._check_token()
+        service = self._get_processor_service()
+        previous_settings = service.get_profiling_settings()
+
+        if previous_settings is not None:
+            service.set_profiling_settings(ProfilingSettings(previous_settings.sample_rate,
+                                                             previous_settings.worker_pids,
+                                                             previous_settings.generation + 1, self.profiles_folder))
+
+        remove_profiles(self.profiles_folder)
+
+        return jsonify(self._get_profiling_dict())
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from flask import Response
+from main.controllers.controller import route, Controller
+from main.services.metrics import MetricsWriter
+
+__author__ = "Ivan de Paz Centeno"
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class MetricsController(Controller):
+    """
+    Controller for /metrics URL: the metrics of the services in the Prometheus text format.
+    """
+
+    def __init__(self, flask_web_app, available_services, config):
+        """
+        Constructor of the controller.
+        :param flask_web_app: web app from Flask already initialized.
+        :param available_services: list of services filtered to be compatible with this controller.
+        :param config: config object containing all the service definitions.
+        """
+        Controller.__init__(self, flask_web_app, available_services, config)
+
+        self.exposed_methods += [
+            self.get_metrics
+        ]
+
+        self._init_exposed_methods()
+
+    @staticmethod
+    def _write_processor_metrics(writer, service):
+        queue_stats = service.get_queue_stats()
+        writer.add_gauge("queue_depth", "Requests queued, by priority class.",
+                         [({"class": name}, stats["queued"]) for name, stats in queue_stats.items()])
+        writer.add_counter("dispatched_total", "Requests dispatched to the workers, by priority class.",
+                           [({"class": name}, stats["dispatched"]) for name, stats in queue_stats.items()])
+
+        workers_processing = service.get_workers_processing()
+        writer.add_gauge("workers", "Local workers, by state.",
+                         [({"state": "busy"}, workers_processing),
+                          ({"state": "free"}, service.total_workers - workers_processing)])
+
+        writer.add_counter("browser_restarts_total", "Browsers recycled by the workers, by reason.",
+                           [({"reason": reason}, count) for reason, count in service.get_browser_recycles().items()])
+        writer.add_counter("coalesced_requests_total", "Requests served by a capture already in flight.",
+                           service.coalesced_requests)
+        writer.add_counter("blocked_requests_total", "Subresources of the pages blocked by the blocking profiles.",
+                           service.blocked_requests)
+
+        cache_stats = service.get_cache_stats()
+
+        if cache_stats is not None:
+            writer.add_counter("cache_requests_total", "Lookups of the result cache, by outcome.",
+                               [({"outcome": outcome}, cache_stats[outcome])
+                                for outcome in ["memory_hits", "disk_hits", "misses", "expired"]])
+            writer.add_gauge("cache_bytes", "Bytes of the results held by the cache, by tier.",
+                             [({"tier": "memory"}, cache_stats["memory_bytes"]),
+                              ({"tier": "disk"}, cache_stats["disk_bytes"])])
+
+        change_detection_stats = service.get_change_detection_stats()
+
+        if change_detection_stats is not None:
+            writer.add_counter("change_checks_total", "Checks of whether the webpages changed before capturing them "
+                                                      "again, by outcome.",
+                               [({"outcome": outcome}, count) for outcome, count in
+                                sorted(change_detection_stats.items())])
+
+    @staticmethod
+    def _write_batches_metrics(writer, service):
+        batches_stats = service.get_stats()
+        writer.add_gauge("batches", "Batches stored, by state.",
+                         [({"state": "processing"}, batches_stats["processing"]),
+                          ({"state": "zipped"}, batches_stats["zipped"]),
+                          ({"state": "canceled"}, batches_stats["canceled"])])
+        writer.add_gauge("batch_elements_pending", "Elements of the batches pending to be captured.",
+                         batches_stats["pending_elements"])
+        writer.add_counter("batch_images_total", "Images of the batches, by whether they were stored in a new blob "
+                                                 "or found already stored.",
+                           [({"outcome": "written"}, batches_stats["blobs_written"]),
+                            ({"outcome": "deduplicated"}, batches_stats["blobs_deduplicated"])])
+
+    @route("/metrics", methods=['GET'])
+    def get_metrics(self):
+        writer = MetricsWriter()
+        processor_service = self.available_services['web_screenshoot_processor']
+        batches_service = self.available_services['batch_screenshoot_processor']
+        admission_control = self.available_services.get('admission_control')
+        remote_workers_service = self.available_services.get('remote_workers')
+
+        self._write_processor_metrics(writer, processor_service)
+        self._write_batches_metrics(writer, batches_service)
+
+        stage_snapshots = processor_service.stage_timings.get_snapshots()
+        stage_snapshots.update(batches_service.stage_timings.get_snapshots())
+        writer.add_histograms("stage_seconds", "Latency of the stages of the captures.", "stage", stage_snapshots)
+
+        if admission_control is not None:
+            admission_stats = admission_control.get_stats()
+            writer.add_counter("rejected_total", "Requests turned away by the admission control, by kind.",
+                               [({"kind": "make"}, admission_stats["make_rejected"]),
+                                ({"kind": "batch"}, admission_stats["batches_rejected"])])
+            writer.add_gauge("capture_rate", "Estimated captures finished per second.",
+                             admission_stats["capture_rate"])
+
+        if remote_workers_service is not None:
+            agents_stats = remote_workers_service.get_agents_stats()
+            writer.add_gauge("remote_agents", "Remote worker agents seen.", len(agents_stats))
+            writer.add_gauge("remote_jobs_in_flight", "Jobs leased to remote worker agents and not finished yet.",
+                             sum(agent["in_flight"] for agent in agents_stats.values()))
+
+        return Response(writer.get_text(), content_type=PROMETHEUS_CONTENT_TYPE)
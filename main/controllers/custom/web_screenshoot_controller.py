@@ -1,13 +1,32 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from io import BytesIO
+import json
+import math
+import time
 
-from flask import jsonify, request, send_file
+from flask import jsonify, request, send_file, Response
 from main.controllers.controller import route, Controller
 from main.exceptions.invalid_request import InvalidRequest
+from main.exceptions.too_many_requests import TooManyRequests
+from main.parallelization.request_scheduler import clamp_flow_weight
+from main.processors.capture_request import CaptureRequest
+from main.processors.capture_specs import MAX_VIEWPORT_WIDTH, parse_capture_specs
+from main.processors.image_encoder import FORMAT_EXTENSIONS, FORMAT_MIMETYPES, ENCODING_OPTIONS
+from main.processors.resource_blocking import BlockingProfiles
+from main.services.tracing import parse_trace_id, TRACE_ID_HEADER, SPAN_HTTP_REQUEST
+from main.services.zip_stream import ZipStream
 
 __author__ = "Ivan de Paz Centeno"
 
+DEFAULT_BATCHES_PAGE_SIZE = 100
+MAX_BATCHES_PAGE_SIZE = 1000
+MAX_PROGRESS_WAIT = 30
+
+# Bodies of batches read as they are uploaded: one URL per line.
+NDJSON_MIMETYPE = "application/x-ndjson"
+UPLOAD_MIMETYPES = [NDJSON_MIMETYPE, "text/plain"]
+UPLOAD_BLOCK_SIZE = 256 * 1024
+
 
 class WebScreenshootController(Controller):
     """
@@ -22,6 +41,7 @@ class WebScreenshootController(Controller):
         :param config: config object containing all the service definitions.
         """
         Controller.__init__(self, flask_web_app, available_services, config)
+        self.blocking_profiles = BlockingProfiles.from_config(config.get('processor', {}).get('blocking', {}))
 
         self.exposed_methods += [
             self.make_web_screenshot,
@@ -29,19 +49,157 @@ class WebScreenshootController(Controller):
             self.get_batch_status,
             self.remove_batch,
             self.get_batch,
+            self.stream_batch,
             self.get_batches,
-            self.close_batch
+            self.close_batch,
+            self.get_batch_progress,
+            self.stream_batch_events,
+            self.get_cache_stats,
+            self.get_queue_stats
         ]
 
         self._init_exposed_methods()
 
-    @route("/web-screenshot/make", methods=['PUT'])
-    def make_web_screenshot(self):
+    def _get_capture_options(self, json_options):
         """
-        Retrieves the screenshot for the specified page
+        Validates the capture options specified in a request.
+        :param json_options: dict containing the options in the request JSON.
+        :return: dict of capture options acceptable by the processors.
         """
-        json_request = request.get_json(force=True, silent=True, cache=False)
+        options = {}
+
+        wait_for = json_options.get('wait_for')
+
+        if wait_for is not None:
+            if isinstance(wait_for, str):
+                wait_for = [wait_for]
+
+            if not isinstance(wait_for, list) or not all(isinstance(selector, str) for selector in wait_for):
+                raise InvalidRequest("wait_for must be a CSS selector or a list of CSS selectors.")
+
+            options['wait_for'] = wait_for
+
+        max_wait = json_options.get('max_wait')
+
+        if max_wait is not None:
+            try:
+                options['max_wait'] = float(max_wait)
+            except (TypeError, ValueError):
+                raise InvalidRequest("max_wait must be a number of seconds.")
+
+        max_age = json_options.get('max_age')
+
+        if max_age is not None:
+            try:
+                options['max_age'] = float(max_age)
+            except (TypeError, ValueError):
+                raise InvalidRequest("max_age must be a number of seconds.")
+
+            if options['max_age'] < 0:
+                raise InvalidRequest("max_age can't be negative.")
+
+        if_changed = json_options.get('if_changed')
+
+        if if_changed is not None:
+            if not isinstance(if_changed, bool):
+                raise InvalidRequest("if_changed must be true or false.")
+
+            if if_changed:
+                options['if_changed'] = True
+
+        block = json_options.get('block')
+
+        if block is not None:
+            if not isinstance(block, list) or not all(isinstance(name, str) for name in block):
+                raise InvalidRequest("block must be a list of names of blocking profiles.")
+
+            processor_class = self.available_services['web_screenshoot_processor'].processor_class
+
+            if not getattr(processor_class, 'blocks_per_request', False):
+                raise InvalidRequest("The browser of this server can not block resources per request; only the "
+                                     "default blocking profiles are applied.")
+
+            try:
+                options['block'] = sorted(set(self.blocking_profiles.check_names(block)))
+            except Exception as ex:
+                raise InvalidRequest("{} Available: {}.".format(ex, ", ".join(self.blocking_profiles.get_names())))
+
+        captures = json_options.get('captures')
+
+        if captures is not None:
+            try:
+                options['captures'] = parse_capture_specs(captures)
+            except ValueError as ex:
+                raise InvalidRequest(str(ex))
+
+            if any('clip' in spec for spec in options['captures']) and \
+                    not self.available_services['web_screenshoot_processor'].can_encode_images():
+                raise InvalidRequest("Clips require the post-processing of the images, which is not available.")
+
+        options.update(self._get_encoding_options(json_options))
+
+        return options
+
+    def _get_encoding_options(self, json_options):
+        """
+        Validates the options of a request that tell how to post-process its images.
+        :param json_options: dict containing the options in the request JSON.
+        :return: dict of encoding options.
+        """
+        options = {}
+
+        if not any(json_options.get(option) is not None for option in ENCODING_OPTIONS):
+            return options
+
+        if not self.available_services['web_screenshoot_processor'].can_encode_images():
+            raise InvalidRequest("Post-processing of the images is not available.")
+
+        image_format = json_options.get('format')
+
+        if image_format is not None:
+            image_format = str(image_format).lower().replace("jpg", "jpeg")
+
+            if image_format not in FORMAT_EXTENSIONS:
+                raise InvalidRequest("format must be one of {}.".format(", ".join(FORMAT_EXTENSIONS)))
+
+            options['format'] = image_format
+
+        for option, min_value, max_value in [('quality', 1, 100), ('max_width', 1, None), ('max_height', 1, None)]:
+            value = json_options.get(option)
+
+            if value is None:
+                continue
+
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise InvalidRequest("{} must be an integer.".format(option))
+
+            if value < min_value or (max_value is not None and value > max_value):
+                raise InvalidRequest("{} is out of range.".format(option))
+
+            options[option] = value
+
+        thumbnails = json_options.get('thumbnails')
+
+        if thumbnails is not None:
+            if not isinstance(thumbnails, list) or not all(isinstance(width, int) and not isinstance(width, bool) and
+                                                           0 < width <= MAX_VIEWPORT_WIDTH for width in thumbnails):
+                raise InvalidRequest("thumbnails must be a list of widths in pixels, from 1 to {}.".format(
+                    MAX_VIEWPORT_WIDTH))
+
+            options['thumbnails'] = sorted(set(thumbnails))
 
+        return options
+
+    def parse_make_request(self, json_request, client_id=None, trace_id=None):
+        """
+        Validates the JSON of a request to /web-screenshot/make.
+        :param json_request: dict with the request JSON, or None if it could not be parsed.
+        :param client_id: identifier of the client, which shares the workers fairly with the rest of clients.
+        :param trace_id: trace ID sent by the client, or None to start a new trace.
+        :return: tuple (CaptureRequest to queue, name of the requested image or None)
+        """
         try:
             url = json_request['url']
 
@@ -51,19 +209,124 @@ class WebScreenshootController(Controller):
         if not (url.lower().startswith("http://") or url.lower().startswith("https://")):
             raise InvalidRequest("Specified URL is not valid, must start with http:// or https://")
 
+        options = self._get_capture_options(json_request)
+
+        return CaptureRequest(url, options, client_id, parse_trace_id(trace_id)), json_request.get('image')
+
+    def trace_make_request(self, capture_request, start_time, headers):
+        """
+        Records the span of a request to /web-screenshot/make in its trace, and tells the client its trace ID.
+        :param capture_request: CaptureRequest of the request.
+        :param start_time: timestamp of the arrival of the request.
+        :param headers: dict of headers of the response, where the trace ID is added.
+        """
+        service = self.available_services['web_screenshoot_processor']
+        service.tracer.add_span(capture_request.get_trace_id(), SPAN_HTTP_REQUEST, start_time, time.time(),
+                                attributes={"url": str(capture_request)})
+        headers[TRACE_ID_HEADER] = capture_request.get_trace_id()
+
+    def check_make_admission(self):
+        """
+        Turns away a capture requested to /make if the server is too loaded to serve it in time.
+        """
+        admission_control = self.available_services.get('admission_control')
+        retry_after = None if admission_control is None else admission_control.get_make_retry_after()
+
+        if retry_after is not None:
+            raise TooManyRequests("The server is too busy; retry in {} seconds.".format(retry_after), retry_after)
+
+    def get_make_response_parts(self, result, image_name):
+        """
+        Chooses what to answer to a request to /web-screenshot/make from the result of its capture.
+        :param result: CaptureResult of the capture, or None if it failed.
+        :param image_name: name of the requested image, or None.
+        :return: tuple (mimetype, headers, image). If image is None, the body is the ZIP of all the images of the
+        result, generated by iter_result_zip().
+        """
+        if result is None:
+            raise InvalidRequest("Screenshot of the specified URL could not be captured.", status_code=500)
+
+        image_format = result.get_metadata('format', "png")
+        headers = {
+            'X-Readiness-Wait': "{:.3f}".format(result.get_metadata('readiness_wait', 0)),
+            'X-Cache': result.get_metadata('cache', "miss")
+        }
+
+        if result.get_metadata('blocked_requests') is not None:
+            headers['X-Blocked-Requests'] = str(result.get_metadata('blocked_requests'))
+
+        if len(result.get_images()) > 1 and image_name is None:
+            # Multi-image response: every image of the result zipped.
+            return 'application/zip', headers, None
+
+        image = result.get_image(image_name)
+
+        if image is None:
+            raise InvalidRequest("The capture has no image named {}.".format(image_name))
+
+        return FORMAT_MIMETYPES[image_format], headers, image
+
+    @staticmethod
+    def iter_result_zip(result):
+        """
+        Generates the ZIP of all the images of a result.
+        :param result: CaptureResult.
+        :return: generator of chunks of the ZIP file.
+        """
+        extension = FORMAT_EXTENSIONS[result.get_metadata('format', "png")]
+        zip_stream = ZipStream()
+
+        for name, image in result.get_images().items():
+            yield zip_stream.write_bytes("{}.{}".format(name, extension), image.getbuffer())
+
+        yield zip_stream.close()
+
+    @route("/web-screenshot/make", methods=['PUT'])
+    def make_web_screenshot(self):
+        """
+        Retrieves the screenshot for the specified page
+        """
+        start_time = time.time()
+        json_request = request.get_json(force=True, silent=True, cache=False)
+
+        capture_request, image_name = self.parse_make_request(json_request, request.remote_addr,
+                                                              request.headers.get(TRACE_ID_HEADER))
+        self.check_make_admission()
+
         service = self.available_services['web_screenshoot_processor']
 
-        promise = service.queue_request(url)
+        promise = service.queue_request(capture_request)
+
+        result = promise.get_result()
 
-        binary_result = promise.get_result()
+        mimetype, headers, image = self.get_make_response_parts(result, image_name)
+        self.trace_make_request(capture_request, start_time, headers)
 
-        img_io = BytesIO(binary_result)
-        img_io.seek(0)
+        if image is None:
+            response = Response(self.iter_result_zip(result), mimetype=mimetype)
+        else:
+            response = send_file(image.open(), mimetype=mimetype)
+            response.content_length = len(image)
 
-        return send_file(img_io, mimetype='image/jpeg')
+        response.headers.update(headers)
+
+        return response
 
     @route("/web-screenshot/batches", methods=['POST'])
     def batch_web_screenshot(self):
+        """
+        Creates a batch. The body is either a JSON with the "urls" list, or a stream of URLs (see
+        _create_uploaded_batch()).
+        """
+        admission_control = self.available_services.get('admission_control')
+        retry_after = None if admission_control is None else admission_control.get_batch_retry_after()
+
+        if retry_after is not None:
+            raise TooManyRequests("The server has too many batches pending; retry in {} "
+                                  "seconds.".format(retry_after), retry_after)
+
+        if request.mimetype in UPLOAD_MIMETYPES:
+            return self._create_uploaded_batch()
 
         json_request = request.get_json(force=True, silent=True, cache=False)
 
@@ -73,12 +336,108 @@ class WebScreenshootController(Controller):
         except Exception as ex:
             raise InvalidRequest("url is missing in the request JSON.")
 
+        options = self._get_capture_options(json_request.get('options') or {})
+        weight = self._get_batch_weight(json_request.get('weight', 1))
+
         service = self.available_services['batch_screenshoot_processor']
 
         if len(urls) == 0:
             raise InvalidRequest("Required at least 1 URL in the 'url' list")
 
-        batch_id = service.new_batch(urls)
+        batch_id = service.new_batch(urls, options, weight)
+
+        return jsonify({"batch_id": batch_id})
+
+    @staticmethod
+    def _get_batch_weight(weight):
+        """
+        :return: weight of a batch, clamped to the range of the scheduler (MIN_FLOW_WEIGHT to MAX_FLOW_WEIGHT).
+        """
+        try:
+            weight = float(weight)
+        except (TypeError, ValueError):
+            raise InvalidRequest("weight must be a number.")
+
+        if not math.isfinite(weight) or weight <= 0:
+            raise InvalidRequest("weight must be a positive finite number.")
+
+        return clamp_flow_weight(weight)
+
+    @staticmethod
+    def _iter_body_lines(stream):
+        """
+        Splits a streamed body in lines. It is read in blocks, which is much faster than reading it line by line.
+        :return: generator of lines, as bytes.
+        """
+        pending = b""
+
+        while True:
+            block = stream.read(UPLOAD_BLOCK_SIZE)
+
+            if not block:
+                break
+
+            lines = (pending + block).split(b"\n")
+            pending = lines.pop()
+
+            for line in lines:
+                yield line
+
+        yield pending
+
+    def _iter_uploaded_urls(self, stream, is_ndjson):
+        """
+        Parses the URLs of a streamed body, line by line. Blank lines are skipped.
+        :param stream: stream of the body of the request.
+        :param is_ndjson: True if each line is a JSON (a string with the URL, or an object with the "url" field);
+        False if each line is a plain URL.
+        :return: generator of URLs.
+        """
+        for line_number, line in enumerate(self._iter_body_lines(stream), 1):
+            line = line.decode("utf-8", "replace").strip()
+
+            if line == "":
+                continue
+
+            if not is_ndjson:
+                yield line
+                continue
+
+            try:
+                element = json.loads(line)
+                url = element if isinstance(element, str) else element['url']
+            except (ValueError, TypeError, KeyError):
+                raise InvalidRequest("Line {} of the body is not a URL string nor an object with a "
+                                     "url.".format(line_number))
+
+            yield url
+
+    def _create_uploaded_batch(self):
+        """
+        Creates a batch from a body of NDJSON or of plain URLs, one per line, which is read as it is uploaded: its size
+        is bounded by the disk of the server instead of by its memory. The options and the weight of the batch are
+        given in the query string, the options as JSON.
+        """
+        try:
+            options = json.loads(request.args.get('options', "{}"))
+        except ValueError:
+            options = None
+
+        if not isinstance(options, dict):
+            raise InvalidRequest("options must be a JSON object.")
+
+        options = self._get_capture_options(options)
+        weight = self._get_batch_weight(request.args.get('weight', 1))
+
+        service = self.available_services['batch_screenshoot_processor']
+        urls = self._iter_uploaded_urls(request.stream, request.mimetype == NDJSON_MIMETYPE)
+
+        try:
+            batch_id = service.new_uploaded_batch(urls, options, weight)
+        except InvalidRequest:
+            raise
+        except Exception as ex:
+            raise InvalidRequest(str(ex))
 
         return jsonify({"batch_id": batch_id})
 
@@ -134,8 +493,150 @@ class WebScreenshootController(Controller):
 
         return send_file(zip_uri)
 
+    @staticmethod
+    def _get_progress_dict(batch):
+        return {'percentage_completed': round(batch["processed"] / batch["total"] * 100),
+                'processed': batch["processed"], 'total': batch["total"], 'is_zipped': batch["zip_uri"] != ""}
+
+    @staticmethod
+    def _get_element_dict(element):
+        sequence, url, uri, images_uris, reused = element
+        return {'sequence': sequence, 'url': url, 'uri': uri, 'images': images_uris, 'reused': reused}
+
+    @staticmethod
+    def _get_after_sequence(after_sequence):
+        try:
+            after_sequence = int(after_sequence or 0)
+        except ValueError:
+            raise InvalidRequest("after must be the sequence number of an element.")
+
+        return after_sequence
+
+    @route("/web-screenshot/batches/<batch_id>/progress", methods=['GET'])
+    def get_batch_progress(self, batch_id):
+        """
+        Long-polls the progress of a batch: answers as soon as elements are processed after the sequence number "after",
+        or the ZIP of the batch is ready, or "wait" seconds pass. The "next" field is the "after" of the following poll.
+        """
+        service = self.available_services['batch_screenshoot_processor']
+        after_sequence = self._get_after_sequence(request.args.get('after'))
+
+        try:
+            wait = min(float(request.args.get('wait', MAX_PROGRESS_WAIT)), MAX_PROGRESS_WAIT)
+        except ValueError:
+            raise InvalidRequest("wait must be a number of seconds.")
+
+        try:
+            batch, elements = service.wait_for_progress(batch_id, after_sequence, wait)
+        except Exception as ex:
+            raise InvalidRequest("Batch ID not valid or not available for checking.")
+
+        progress = self._get_progress_dict(batch)
+        progress['elements'] = [self._get_element_dict(element) for element in elements]
+        progress['next'] = elements[-1][0] if len(elements) > 0 else after_sequence
+
+        return jsonify(progress)
+
+    @route("/web-screenshot/batches/<batch_id>/events", methods=['GET'])
+    def stream_batch_events(self, batch_id):
+        """
+        Streams the progress of a batch as Server-Sent Events: an "element" event for every processed URL, a "progress"
+        event after each group of them and a "ready" event, the last one, once the ZIP of the batch can be downloaded.
+        Events are identified by the sequence number of the last processed element, so a reconnecting client resumes
+        from its Last-Event-ID.
+        """
+        service = self.available_services['batch_screenshoot_processor']
+        after_sequence = self._get_after_sequence(request.headers.get('Last-Event-ID', request.args.get('after')))
+
+        try:
+            service.get_processed_percentage(batch_id)
+        except:
+            raise InvalidRequest("Batch ID not valid or not available for checking.")
+
+        def format_event(event, data, event_id):
+            return "id: {}\nevent: {}\ndata: {}\n\n".format(event_id, event, json.dumps(data))
+
+        def generate_events():
+            last_sequence = after_sequence
+
+            try:
+                for batch, elements in service.iter_progress(batch_id, after_sequence):
+                    chunk = []
+
+                    for element in elements:
+                        last_sequence = element[0]
+                        chunk.append(format_event("element", self._get_element_dict(element), last_sequence))
+
+                    chunk.append(format_event("progress", self._get_progress_dict(batch), last_sequence))
+                    yield "".join(chunk)
+
+            except Exception as ex:
+                yield format_event("error", {'message': str(ex)}, last_sequence)
+                return
+
+            yield format_event("ready", {'url': "/web-screenshot/batches/{}".format(batch_id)}, last_sequence)
+
+        response = Response(generate_events(), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = "no-cache"
+        # Proxies must not buffer the events.
+        response.headers['X-Accel-Buffering'] = "no"
+
+        return response
+
+    @route("/web-screenshot/batches/<batch_id>/stream", methods=['GET'])
+    def stream_batch(self, batch_id):
+        """
+        Downloads the ZIP of the batch while it is being processed.
+        """
+        service = self.available_services['batch_screenshoot_processor']
+
+        try:
+            service.get_processed_percentage(batch_id)
+        except:
+            raise InvalidRequest("Batch ID not valid or not available for streaming.")
+
+        response = Response(service.stream_batch_zip(batch_id), mimetype='application/zip')
+        response.headers['Content-Disposition'] = "attachment; filename=batch_{}.zip".format(batch_id)
+
+        return response
+
     @route("/web-screenshot/batches", methods=['GET'])
     def get_batches(self):
+        """
+        Lists the IDs of the batches, page by page: the "next" field of a page is the value of the "after" argument to
+        request the following page, or null if it is the last one.
+        """
         service = self.available_services['batch_screenshoot_processor']
-        batches_ids = service.get_batches_ids()
-        return jsonify({"batches": batches_ids})
\ No newline at end of file
+
+        try:
+            after = request.args.get('after')
+            after = None if after is None else int(after)
+            limit = int(request.args.get('limit', DEFAULT_BATCHES_PAGE_SIZE))
+        except ValueError:
+            raise InvalidRequest("after and limit must be integers.")
+
+        if not 0 < limit <= MAX_BATCHES_PAGE_SIZE:
+            raise InvalidRequest("limit must be between 1 and {}.".format(MAX_BATCHES_PAGE_SIZE))
+
+        batches_ids, next_after = service.list_batches(after, limit)
+        return jsonify({"batches": batches_ids, "next": next_after})
+
+    @route("/web-screenshot/cache", methods=['GET'])
+    def get_cache_stats(self):
+        service = self.available_services['web_screenshoot_processor']
+        cache_stats = service.get_cache_stats()
+
+        if cache_stats is None:
+            raise InvalidRequest("Result cache is not enabled.", status_code=404)
+
+        return jsonify(cache_stats)
+
+    @route("/web-screenshot/queue", methods=['GET'])
+    def get_queue_stats(self):
+        service = self.available_services['web_screenshoot_processor']
+
+        admission_control = self.available_services.get('admission_control')
+
+        return jsonify({"classes": service.get_queue_stats(), "hosts": service.get_host_stats(),
+                        "workers_processing": service.get_workers_processing(),
+                        "admission": None if admission_control is None else admission_control.get_stats()})
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import json
+from collections import OrderedDict
+
+from flask import jsonify, request, Response
+from main.controllers.controller import route, Controller
+from main.exceptions.invalid_request import InvalidRequest
+from main.processors.capture_result import CaptureResult
+
+__author__ = "Ivan de Paz Centeno"
+
+
+class WorkersController(Controller):
+    """
+    Controller for /workers/ URL, used by the remote worker agents.
+
+    The result of a job is sent as the raw concatenation of its images, described by the X-Capture-Result header: a
+    JSON with the "metadata" of the result and the list of "images" as [name, size] pairs, or {"failed": true} if the
+    capture failed.
+    """
+
+    def __init__(self, flask_web_app, available_services, config):
+        """
+        Constructor of the controller.
+        :param flask_web_app: web app from Flask already initialized.
+        :param available_services: list of services filtered to be compatible with this controller.
+        :param config: config object containing all the service definitions.
+        """
+        Controller.__init__(self, flask_web_app, available_services, config)
+
+        self.exposed_methods += [
+            self.lease_jobs,
+            self.heartbeat,
+            self.finish_job,
+            self.get_agents
+        ]
+
+        self._init_exposed_methods()
+
+    def _get_service(self):
+        service = self.available_services['remote_workers']
+
+        if not service.is_token_valid(request.headers.get('X-Worker-Token')):
+            raise InvalidRequest("Invalid worker token.", status_code=403)
+
+        return service
+
+    @staticmethod
+    def _get_agent_id(json_request):
+        try:
+            return str(json_request['agent_id'])
+
+        except Exception as ex:
+            raise InvalidRequest("agent_id is missing in the request JSON.")
+
+    @route("/workers/lease", methods=['POST'])
+    def lease_jobs(self):
+        """
+        Long-polls for jobs to process.
+        """
+        service = self._get_service()
+        json_request = request.get_json(force=True, silent=True, cache=False)
+        agent_id = self._get_agent_id(json_request)
+
+        try:
+            max_jobs = int(json_request.get('max_jobs', 1))
+            wait = float(json_request.get('wait', 0))
+        except (TypeError, ValueError):
+            raise InvalidRequest("max_jobs and wait must be numbers.")
+
+        if max_jobs < 1:
+            raise InvalidRequest("max_jobs must be positive.")
+
+        lease = service.lease(agent_id, max_jobs, wait)
+
+        if lease is None:
+            return Response(status=204)
+
+        return jsonify({
+            "lease_id": lease.lease_id,
+            "lease_timeout": service.lease_timeout,
+            "jobs": [{"job_id": job_id, "url": job_request.get_url(), "options": job_request.get_options()}
+                     for job_id, job_request in lease.jobs.items()]
+        })
+
+    @route("/workers/heartbeat", methods=['POST'])
+    def heartbeat(self):
+        service = self._get_service()
+        json_request = request.get_json(force=True, silent=True, cache=False)
+        leases_ids = service.heartbeat(self._get_agent_id(json_request))
+
+        return jsonify({"leases": leases_ids})
+
+    @route("/workers/leases/<lease_id>/jobs/<job_id>", methods=['PUT'])
+    def finish_job(self, lease_id, job_id):
+        service = self._get_service()
+
+        try:
+            description = json.loads(request.headers['X-Capture-Result'])
+        except Exception as ex:
+            raise InvalidRequest("X-Capture-Result header is missing or malformed.")
+
+        if description.get('failed', False):
+            result = None
+
+        else:
+            data = request.get_data(cache=False)
+            images = OrderedDict()
+            offset = 0
+
+            try:
+                for name, size in description['images']:
+                    images[name] = data[offset:offset + size]
+                    offset += size
+            except Exception as ex:
+                raise InvalidRequest("The images of X-Capture-Result are malformed.")
+
+            if offset != len(data):
+                raise InvalidRequest("The size of the images does not match the size of the body.")
+
+            result = CaptureResult(images, description.get('metadata'))
+
+        if not service.finish_job(lease_id, job_id, result):
+            raise InvalidRequest("Lease {} has expired or has no job {}.".format(lease_id, job_id), status_code=410)
+
+        return jsonify({'status': "done"})
+
+    @route("/workers", methods=['GET'])
+    def get_agents(self):
+        service = self._get_service()
+
+        return jsonify({"agents": service.get_agents_stats()})
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+
+__author__ = 'Iván de Paz Centeno'
+
+DEFAULT_WSGI_THREADS = 64
+
+
+class _RequestBody(object):
+    """
+    wsgi.input of a request served through the bridge. The body is received from the event loop as the application
+    reads it, so streamed uploads are never buffered whole.
+    """
+
+    def __init__(self, receive, loop, first_message, on_complete):
+        """
+        :param receive: ASGI receive callable of the request.
+        :param loop: event loop serving the request.
+        :param first_message: first message of the request, already received.
+        :param on_complete: callable invoked, from any thread, once the whole body was received.
+        """
+        self.receive = receive
+        self.loop = loop
+        self.buffer = bytearray(first_message.get('body', b""))
+        self.more_body = first_message.get('more_body', False)
+        self.disconnected = False
+        self.on_complete = on_complete
+
+        if not self.more_body:
+            self.on_complete()
+
+    def _receive_more(self):
+        message = asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result()
+
+        if message['type'] == 'http.disconnect':
+            self.disconnected = True
+            self.more_body = False
+
+        else:
+            self.buffer += message.get('body', b"")
+            self.more_body = message.get('more_body', False)
+
+        if not self.more_body:
+            self.on_complete()
+
+    def _take(self, size):
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+
+        return data
+
+    def read(self, size=-1):
+        while self.more_body and (size is None or size < 0 or len(self.buffer) < size):
+            self._receive_more()
+
+        return self._take(len(self.buffer) if size is None or size < 0 else size)
+
+    def readline(self, size=-1):
+        while self.more_body and b"\n" not in self.buffer and (size is None or size < 0 or len(self.buffer) < size):
+            self._receive_more()
+
+        end = self.buffer.find(b"\n") + 1 or len(self.buffer)
+
+        return self._take(end if size is None or size < 0 else min(end, size))
+
+    def readlines(self, hint=-1):
+        return list(self)
+
+    def __iter__(self):
+        line = self.readline()
+
+        while line:
+            yield line
+            line = self.readline()
+
+
+class WsgiBridge(object):
+    """
+    Serves a WSGI application from an ASGI server. Each request runs in a pool of threads of its own, so long-polls,
+    event streams and downloads do not hold each other back, and its body and response are streamed chunk by chunk in
+    both directions. A streamed response stops as soon as its client disconnects.
+    """
+
+    def __init__(self, wsgi_app, threads=DEFAULT_WSGI_THREADS):
+        """
+        :param wsgi_app: WSGI application.
+        :param threads: amount of requests served at the same time.
+        """
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    async def __call__(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        first_message = await receive()
+
+        if first_message['type'] == 'http.disconnect':
+            return
+
+        disconnected = Event()
+        state = {"finished": False, "watcher": None}
+
+        def watch_disconnect():
+            if not state["finished"] and not disconnected.is_set():
+                state["watcher"] = asyncio.ensure_future(self._wait_disconnect(receive, disconnected))
+
+        # Once the body is received, the only message left is the disconnection of the client.
+        body = _RequestBody(receive, loop, first_message, lambda: loop.call_soon_threadsafe(watch_disconnect))
+
+        try:
+            await loop.run_in_executor(self.executor, self._run_wsgi_app, scope, body, send, loop, disconnected)
+        finally:
+            state["finished"] = True
+
+            if state["watcher"] is not None:
+                state["watcher"].cancel()
+
+    @staticmethod
+    async def _wait_disconnect(receive, disconnected):
+        while True:
+            message = await receive()
+
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+                return
+
+    @staticmethod
+    def _build_environ(scope, body):
+        root_path = scope.get('root_path', "")
+        path = scope['path']
+
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+
+        server = scope.get('server') or ("localhost", 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': root_path.encode().decode('latin-1'),
+            'PATH_INFO': path.encode().decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b"").decode('latin-1'),
+            'SERVER_PROTOCOL': "HTTP/{}".format(scope.get('http_version', "1.1")),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', "http"),
+            'wsgi.input': body,
+            'wsgi.input_terminated': True,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False
+        }
+
+        if scope.get('client'):
+            environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace("-", "_")
+            value = value.decode('latin-1')
+
+            if name not in ["CONTENT_LENGTH", "CONTENT_TYPE"]:
+                name = "HTTP_" + name
+
+            environ[name] = value if name not in environ else "{},{}".format(environ[name], value)
+
+        return environ
+
+    def _run_wsgi_app(self, scope, body, send, loop, disconnected):
+        """
+        Runs the WSGI application for a request, in a thread of the pool.
+        """
+        response = {"start": None, "sent": False}
+
+        def send_message(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        def send_start():
+            if not response["sent"]:
+                response["sent"] = True
+                send_message(response["start"])
+
+        def write(data):
+            if data and not disconnected.is_set():
+                send_start()
+                send_message({'type': 'http.response.body', 'body': bytes(data), 'more_body': True})
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and response["sent"]:
+                raise exc_info[1].with_traceback(exc_info[2])
+
+            response["start"] = {
+                'type': 'http.response.start',
+                'status': int(status.split(" ", 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+            }
+
+            return write
+
+        iterable = self.wsgi_app(self._build_environ(scope, body), start_response)
+
+        try:
+            for data in iterable:
+                if disconnected.is_set() or body.disconnected:
+                    return
+
+                write(data)
+
+            if not disconnected.is_set() and not body.disconnected:
+                send_start()
+                send_message({'type': 'http.response.body', 'body': b""})
+
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
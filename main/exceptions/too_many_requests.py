@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from main.exceptions.invalid_request import InvalidRequest
+
+__author__ = "Ivan de Paz Centeno"
+
+
+class TooManyRequests(InvalidRequest):
+    """
+    Exception raised when the server is too loaded to accept a request. It is answered with a 429 code and the
+    Retry-After header.
+    """
+    def __init__(self, message, retry_after):
+        """
+        Initialization of the exception.
+        :param message: message of the exception to be raised.
+        :param retry_after: seconds after which the request is expected to be accepted.
+        """
+        InvalidRequest.__init__(self, message, status_code=429, payload={'retry_after': retry_after})
+        self.retry_after = retry_after
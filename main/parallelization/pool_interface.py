@@ -1,70 +1,117 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-from multiprocessing import Manager
+import os
+import time
+from multiprocessing import Queue
 from multiprocessing.pool import Pool
-from multiprocessing import Lock
-from queue import Empty
+from threading import Lock, Condition, Thread
+
+from main.parallelization.request_scheduler import RequestScheduler
+from main.parallelization.worker_profiling import WorkerProfiler
 
 __author__ = 'Iván de Paz Centeno'
 
 
+# Actions for the requests taken from the queue.
+DISPATCH = 0
+ABORT = 1
+SKIP = 2
+
 processor = None
-abort_dict = None
+result_queue = None
+worker_profiler = None
 
-def process(queue_element):
+def process_chunk(requests, profiling_settings=None):
     """
     Generic process function.
     The pool process is going to execute this function on its own thread.
-    :param queue_element: element extracted from the queue.
-    :return: search engine request result.
+    The results are put in the result queue one by one, as soon as each of them is available.
+    :param requests: list of requests dispatched to the worker.
+    :param profiling_settings: ProfilingSettings of the workers, or None if profiling is disabled.
+    :return: amount of requests processed.
     """
-    global processor, abort_dict
+    worker_started_at = time.time()
+    delivered = set()
 
-    # We fetch the search variables from the queue element
-    request = queue_element[0]
+    def deliver(request, retrieved_result):
+        try:
+            if hasattr(retrieved_result, 'set_metadata'):
+                # Marks for the trace of the request; the transfer of the result starts with the spooling.
+                retrieved_result.set_metadata("worker_pid", os.getpid())
+                retrieved_result.set_metadata("worker_started_at", worker_started_at)
+                retrieved_result.set_metadata("delivered_at", time.time())
 
-    is_aborted = abort_dict.get(request, False)
+            # Only a handle to the binary data travels back through the result queue.
+            if hasattr(retrieved_result, 'spool_images'):
+                retrieved_result.spool_images()
 
-    try:
-        if is_aborted:
-            raise Exception("Request is aborted.")
+        except Exception as ex:
+            retrieved_result = None
 
-        retrieved_result = processor.process(request)
+        delivered.add(id(request))
+        result_queue.put([request, retrieved_result])
+
+    try:
+        worker_profiler.run(profiling_settings, processor.process_many, requests, deliver)
 
     except Exception as ex:
-        retrieved_result = None
+        pass
+
+    finally:
+        for request in requests:
+            if id(request) not in delivered:
+                result_queue.put([request, None])
 
-    return [request, retrieved_result]
+    return len(requests)
 
 
 class PoolInterface(object):
     """
     Pool processes for a given operation.
     Allows to process something in parallel.
+
+    Requests are queued in-process, in a RequestScheduler that decides their order, and handed to the pool workers by a
+    dispatcher that sleeps on a condition variable until a request arrives or a worker frees up. Only the dispatch of a
+    request and its result cross the process boundaries.
+
+    Each free worker pulls up to chunk_size requests at once, so that processors able to work on several requests
+    concurrently (for example, one per browser tab) can do so. Their results are delivered one by one as they finish.
     """
 
-    def __init__(self, processor_class, pool_limit=1, processor_class_init_args=None):
+    def __init__(self, processor_class, pool_limit=1, processor_class_init_args=None, chunk_size=1, scheduler=None):
 
-        self.manager = Manager()
+        if scheduler is None:
+            scheduler = RequestScheduler()
 
-        self.processing_queue = self.manager.Queue()
-        self.abort_dict = self.manager.dict()
+        self.processor_class = processor_class
+        self.processing_queue = scheduler
+        self.aborted_requests = set()
+        self.result_queue = Queue()
 
         self.pool = Pool(processes=pool_limit, initializer=self._init_pool_worker,
-                         initargs=[processor_class, self.abort_dict, processor_class_init_args])
+                         initargs=[processor_class, self.result_queue, processor_class_init_args])
 
         self.pool_limit = pool_limit
+        self.chunk_size = chunk_size
         self.processes_free = pool_limit
+        self.profiling_settings = None
         self._stop_processing = False
         self.lock_process_variable = Lock()
+        self.dispatch_condition = Condition(self.lock_process_variable)
+
+        self.result_reader = Thread(target=self._read_results, daemon=True)
+        self.result_reader.start()
 
     @staticmethod
-    def _init_pool_worker(processor_class, _abort_dict, processor_class_init_args=None):
+    def _init_pool_worker(processor_class, _result_queue, processor_class_init_args=None):
         """
         Initializes the worker thread. Each worker of the pool has its own firefox and display instance.
         :return:
         """
-        global processor, abort_dict
+        global processor, result_queue, worker_profiler
+
+        result_queue = _result_queue
+        worker_profiler = WorkerProfiler()
 
         if processor_class_init_args is None:
             processor_class_init_args = []
@@ -74,11 +121,20 @@ class PoolInterface(object):
         else:
             processor = processor_class()
 
-        abort_dict = _abort_dict
-
     def do_stop(self):
-        with self.lock_process_variable:
+        """
+        Stops the dispatch of requests, waking up the dispatcher if it is waiting.
+        """
+        with self.dispatch_condition:
             self._stop_processing = True
+            self.dispatch_condition.notify_all()
+
+    def resume(self):
+        """
+        Resumes the dispatch of requests after a do_stop().
+        """
+        with self.dispatch_condition:
+            self._stop_processing = False
 
     def _stop_requested(self):
         with self.lock_process_variable:
@@ -92,7 +148,50 @@ class PoolInterface(object):
         :param request: request acceptable by the processor
         :return:
         """
-        self.processing_queue.put([request, self.abort_dict])
+        with self.dispatch_condition:
+            self.processing_queue.push(request)
+            self.dispatch_condition.notify_all()
+
+    def get_queue_stats(self):
+        """
+        Retrieves the depth and wait times of the queue, per priority class.
+        :return: dict of class name -> dict of statistics.
+        """
+        with self.lock_process_variable:
+            queue_stats = self.processing_queue.get_stats()
+
+        return queue_stats
+
+    def get_host_stats(self):
+        """
+        Retrieves the state of the hosts being captured.
+        :return: dict with the amount of hosts with captures in flight and of hosts throttled by their limits.
+        """
+        with self.lock_process_variable:
+            host_stats = self.processing_queue.get_host_stats()
+
+        return host_stats
+
+    def set_profiling_settings(self, profiling_settings):
+        """
+        Changes the profiling of the pool workers, from the next chunk of requests dispatched on.
+        :param profiling_settings: ProfilingSettings, or None to disable profiling.
+        """
+        with self.lock_process_variable:
+            self.profiling_settings = profiling_settings
+
+    def get_profiling_settings(self):
+        with self.lock_process_variable:
+            profiling_settings = self.profiling_settings
+
+        return profiling_settings
+
+    def get_worker_pids(self):
+        """
+        :return: list of PIDs of the pool workers.
+        """
+        # The pool does not expose its processes otherwise.
+        return [worker_process.pid for worker_process in self.pool._pool]
 
     def get_processes_free(self):
 
@@ -101,61 +200,207 @@ class PoolInterface(object):
 
         return processes_free
 
-    def housekeep_abort_dict(self):
-        with self.lock_process_variable:
-            if self.processes_free == self.pool_limit and len(self.abort_dict) > 0:
-                self.abort_dict.clear()
+    def _housekeep_aborted_requests(self):
+        """
+        Forgets the aborts of requests that are not pending anymore.
+        Must be called with the lock_process_variable acquired.
+        """
+        if self.processes_free == self.pool_limit and len(self.processing_queue) == 0:
+            self.aborted_requests.clear()
 
-    def take_process(self):
+    def _get_dispatch_action(self, request):
+        """
+        Decides what to do with a request taken from the queue.
+        Must be called with the lock_process_variable acquired.
+        :param request: request taken from the queue.
+        :return: DISPATCH to send it to a worker, ABORT to finish it without result or SKIP to drop it silently.
+        """
+        if request in self.aborted_requests:
+            self.aborted_requests.discard(request)
+            return ABORT
 
-        with self.lock_process_variable:
-            self.processes_free -= 1
+        return DISPATCH
 
-    def process_freed(self):
+    def _take_chunk(self, max_count):
+        """
+        Takes from the queue a chunk of requests to dispatch.
+        Must be called with the lock_process_variable acquired.
+        :param max_count: maximum amount of requests of the chunk.
+        :return: tuple (list of requests to dispatch, list of aborted requests, True if nothing else can be dispatched
+        right now)
+        """
+        chunk = []
+        aborted = []
 
-        with self.lock_process_variable:
-            self.processes_free += 1
+        while len(chunk) < max_count:
+            request = self.processing_queue.pop()
+
+            if request is None:
+                return chunk, aborted, True
+
+            dispatch_action = self._get_dispatch_action(request)
+
+            if dispatch_action == DISPATCH:
+                chunk.append(request)
+            else:
+                self.processing_queue.discard(request)
+
+                if dispatch_action == ABORT:
+                    aborted.append(request)
 
-    def process_queue(self):
+        return chunk, aborted, False
+
+    def _take_chunks(self):
         """
-        Processes the queue until all the processes are busy or until the queue is empty
-        :return:
+        Takes from the queue the chunks of requests for the free processes.
+        Must be called with the lock_process_variable acquired.
+        :return: tuple (list of chunks of requests to dispatch, list of aborted requests)
         """
+        chunks = []
+        aborted = []
 
-        while self.get_processes_free() > 0 and not self._stop_requested():
-            try:
-                queue_element = self.processing_queue.get(False)
-                self.take_process()
+        while self.processes_free > 0 and not self._stop_processing:
+            chunk, chunk_aborted, is_exhausted = self._take_chunk(self.chunk_size)
+            aborted += chunk_aborted
 
-                result = self.pool.apply_async(process, args=(queue_element,), callback=self._process_finished)
+            if len(chunk) > 0:
+                self.processes_free -= 1
+                chunks.append(chunk)
 
-            except Empty:
+            if is_exhausted:
                 break
 
-            self.housekeep_abort_dict()
+        return chunks, aborted
+
+    def process_queue(self, block=True):
+        """
+        Dispatches requests from the queue until all the processes are busy or until nothing else can be dispatched.
+        Aborted requests are finished straight away, without reaching a worker.
+        :param block: if True, waits until there is at least one request dispatched or aborted, or until a stop is
+        requested.
+        :return:
+        """
+        with self.dispatch_condition:
+            while True:
+                chunks, aborted = self._take_chunks()
+
+                if not block or len(chunks) > 0 or len(aborted) > 0 or self._stop_processing:
+                    break
+
+                # Woken up by new requests, freed processes or released requests; or when a host held by its spacing
+                # is available again.
+                self.dispatch_condition.wait(self.processing_queue.get_time_to_next_timer())
+
+            self._housekeep_aborted_requests()
+            profiling_settings = self.profiling_settings
+
+        for chunk in chunks:
+            self.pool.apply_async(process_chunk, args=(chunk, profiling_settings), callback=self._process_finished,
+                                  error_callback=self._process_finished)
+
+        for request in aborted:
+            self._deliver_result([request, None])
+
+    def lease_requests(self, max_count, timeout):
+        """
+        Takes requests from the queue to be processed out of the pool (for example, by remote workers), waiting for them
+        if there are none. Each of them must be finished with finish_request() or given back with requeue_requests().
+        :param max_count: maximum amount of requests to take.
+        :param timeout: maximum seconds to wait for requests.
+        :return: list of requests taken, empty if the timeout expired.
+        """
+        deadline = time.time() + timeout
+        chunk = []
+        aborted = []
+
+        with self.dispatch_condition:
+            while not self._stop_processing:
+                chunk, chunk_aborted, _ = self._take_chunk(max_count)
+                aborted += chunk_aborted
+                remaining_time = deadline - time.time()
+
+                if len(chunk) > 0 or remaining_time <= 0:
+                    break
+
+                time_to_next_timer = self.processing_queue.get_time_to_next_timer()
+
+                if time_to_next_timer is not None:
+                    remaining_time = min(remaining_time, time_to_next_timer)
+
+                self.dispatch_condition.wait(remaining_time)
+
+        for request in aborted:
+            self._deliver_result([request, None])
 
-    def _process_finished(self, wrapped_result):
+        return chunk
+
+    def requeue_requests(self, requests):
+        """
+        Gives back to the queue requests taken with lease_requests() that could not be processed.
+        :param requests: list of requests to queue again.
+        """
+        with self.dispatch_condition:
+            for request in requests:
+                self.processing_queue.release(request)
+                self._request_requeued(request)
+                self.processing_queue.push(request)
+
+            self.dispatch_condition.notify_all()
+
+    def _request_requeued(self, request):
+        """
+        Invoked when a request taken from the queue is queued again.
+        Must be called with the lock_process_variable acquired.
+        :param request: request queued again.
+        """
+        pass
+
+    def finish_request(self, request, result):
+        """
+        Notifies the result of a request taken with lease_requests().
+        :param request: request processed.
+        :param result: result of the request, or None if it failed.
+        """
+        with self.dispatch_condition:
+            self.processing_queue.release(request)
+            self.dispatch_condition.notify_all()
+
+        self._deliver_result([request, result])
+
+    def _process_finished(self, processed_count):
         """
         Callback when the worker's thread is finished.
         This is an internal callback.
-        It will call process_finished method if available to notify the result.
-        :param wrapped_result:
+        It frees the worker; the results are notified by the result reader as they arrive.
+        :param processed_count: amount of requests processed by the worker.
         :return:
         """
-        request = wrapped_result[0]
+        with self.dispatch_condition:
+            self.processes_free += 1
+            self.dispatch_condition.notify_all()
 
-        try:
-            del self.abort_dict[request]
-        except KeyError:
-            pass
+        return None
 
-        self.process_freed()
+    def _read_results(self):
+        """
+        Reads the results sent by the workers, notifying each of them.
+        """
+        while True:
+            wrapped_result = self.result_queue.get()
 
+            if wrapped_result is None:
+                break
+
+            self.finish_request(*wrapped_result)
+
+    def _deliver_result(self, wrapped_result):
+        """
+        It will call process_finished method if available to notify the result.
+        :param wrapped_result:
+        """
         if hasattr(self, 'process_finished'):
             self.process_finished(wrapped_result)
 
-        return None
-
     def terminate(self):
         """
         Finishes safely the pool.
@@ -163,15 +408,16 @@ class PoolInterface(object):
         """
         self.pool.terminate()
         self.pool.join()
+        self.result_queue.put(None)
+        self.result_reader.join()
 
     def abort_request(self, request):
-        try:
-            self.abort_dict[request] = True
-        except KeyError:
-            pass
+        with self.lock_process_variable:
+            self.aborted_requests.add(request)
 
     def is_request_aborted(self, request):
 
-        result = self.abort_dict.get(request, False)
+        with self.lock_process_variable:
+            result = request in self.aborted_requests
 
-        return result
\ No newline at end of file
+        return result
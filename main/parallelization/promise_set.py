@@ -35,21 +35,24 @@ class PromiseSet(object):
 
     def select(self, timeout=None):
         """
-        Selects the first promise accomplished.
-        :return: first promise accomplished
+        Selects the promises as they are accomplished, until all of them are or the timeout expires without any of them
+        being accomplished.
+        :return: generator of the promises accomplished.
         """
         while len(self.promises_selected) < self.promises_count:
-            for event_taken in self.selectors.select(timeout):
+            events_taken = self.selectors.select(timeout)
+
+            if len(events_taken) == 0:
+                # The timeout expired.
+                return
+
+            for event_taken in events_taken:
                 event_index = event_taken[0].data
                 event = self.events[event_index]
                 event.clear()
 
-                selected_promises = []
-
-                for promise in self.promises_list:
-                    if promise.peak_result():
-                        selected_promises.append(promise)
-                        break
+                # The event may be shared by several promises, so every promise accomplished since it was set is taken.
+                selected_promises = [promise for promise in self.promises_list if promise.peak_result()]
 
                 for selected_promise in selected_promises:
                     self.promises_selected.append(selected_promise)
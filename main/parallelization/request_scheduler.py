@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import heapq
+import math
+import time
+from collections import deque
+
+__author__ = 'Iván de Paz Centeno'
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+
+# Priority classes, from the most to the least prioritary.
+DEFAULT_PRIORITY_CLASSES = [INTERACTIVE, BATCH]
+
+# Priority classes whose requests are subject to the per-host limits.
+DEFAULT_POLITE_CLASSES = [BATCH]
+
+DEFAULT_MAX_IN_FLIGHT_PER_HOST = 4
+DEFAULT_MIN_HOST_SPACING = 0
+
+# Range of the weights of the flows: a flow gets from 1/100 to 100 times the dispatches of a flow of weight 1.
+MIN_FLOW_WEIGHT = 0.01
+MAX_FLOW_WEIGHT = 100
+
+# Amount of the latest dispatches taken into account for the wait statistics of a class.
+WAIT_STATS_WINDOW = 1000
+
+
+def clamp_flow_weight(weight):
+    """
+    :return: the weight of a flow within MIN_FLOW_WEIGHT and MAX_FLOW_WEIGHT, or 1 if it is not a finite number.
+    """
+    if not math.isfinite(weight):
+        return 1
+
+    return min(max(weight, MIN_FLOW_WEIGHT), MAX_FLOW_WEIGHT)
+
+
+class _Host(object):
+    """
+    Dispatch state of a host: its captures in flight, when it can be dispatched again and the flows with requests for
+    it that are waiting for it to be available.
+    """
+
+    def __init__(self, max_in_flight, min_spacing):
+        self.max_in_flight = max_in_flight
+        self.min_spacing = min_spacing
+        self.in_flight = 0
+        self.next_dispatch_time = 0
+        self.parked_flows = []
+        self.timer_scheduled = False
+
+    def is_available(self, now):
+        return self.in_flight < self.max_in_flight and now >= self.next_dispatch_time
+
+
+class _Flow(object):
+    """
+    Requests of a single flow (a batch or a client) queued in a priority class, grouped by host. The hosts available
+    take turns, so that the requests of different hosts are interleaved.
+    """
+
+    def __init__(self, flow_id, priority_class, weight):
+        self.flow_id = flow_id
+        self.priority_class = priority_class
+        self.weight = weight
+        self.deficit = 0
+        self.size = 0
+        self.host_queues = {}
+        self.ready_hosts = deque()
+        self.is_active = False
+
+
+class _PriorityClass(object):
+    """
+    Requests of a priority class, shared among its flows by deficit round robin: each turn, a flow can dispatch as many
+    requests as its weight. Only the flows with requests for available hosts take turns.
+    """
+
+    def __init__(self, name, is_polite):
+        self.name = name
+        self.is_polite = is_polite
+        self.flows = {}
+        self.active_flows = deque()
+        self.size = 0
+        self.dispatched = 0
+        self.recent_waits = deque(maxlen=WAIT_STATS_WINDOW)
+
+    def activate(self, flow):
+        if not flow.is_active and self.flows.get(flow.flow_id) is flow:
+            flow.is_active = True
+            self.active_flows.append(flow)
+
+    def push(self, request, host_name, flow_id, weight):
+        flow = self.flows.get(flow_id)
+
+        if flow is None:
+            flow = _Flow(flow_id, self, weight)
+            self.flows[flow_id] = flow
+
+        host_queue = flow.host_queues.get(host_name)
+
+        if host_queue is None:
+            host_queue = deque()
+            flow.host_queues[host_name] = host_queue
+            flow.ready_hosts.append(host_name)
+            self.activate(flow)
+
+        host_queue.append((time.time(), request))
+        flow.size += 1
+        self.size += 1
+
+    def _skip_idle_rounds(self):
+        """
+        Credits at once every active flow with the rounds in which none of them would reach a deficit of 1, as if they
+        had taken those turns one by one.
+        """
+        rounds = min(math.ceil((1 - flow.deficit) / flow.weight) for flow in self.active_flows) - 1
+
+        if rounds > 0:
+            for flow in self.active_flows:
+                flow.deficit += rounds * flow.weight
+
+    def pop(self, scheduler, now):
+        """
+        Takes the next request whose host is available.
+        :return: request, or None if no flow has requests for an available host.
+        """
+        idle_turns = 0
+
+        while len(self.active_flows) > 0:
+            flow = self.active_flows[0]
+
+            if flow.deficit < 1:
+                flow.deficit += flow.weight
+
+                if flow.deficit < 1:
+                    # Flows lighter than 1 need several turns to dispatch a single request. When all of them are, the
+                    # turns without dispatches are skipped.
+                    idle_turns += 1
+
+                    if idle_turns >= len(self.active_flows):
+                        self._skip_idle_rounds()
+                        idle_turns = 0
+
+                    self.active_flows.rotate(-1)
+                    continue
+
+            idle_turns = 0
+
+            item = self._pop_flow(flow, scheduler, now)
+
+            if item is None:
+                # Every host of the flow is unavailable; the flow takes turns again when any of them is available.
+                self.active_flows.popleft()
+                flow.is_active = False
+                flow.deficit = 0
+                continue
+
+            queued_time, request = item
+            flow.deficit -= 1
+            flow.size -= 1
+            self.size -= 1
+
+            if flow.size == 0:
+                # An empty flow leaves the round; it starts from scratch if it comes back.
+                self.active_flows.popleft()
+                flow.is_active = False
+                del self.flows[flow.flow_id]
+
+            elif flow.deficit < 1 or len(flow.ready_hosts) == 0:
+                self.active_flows.rotate(-1)
+
+            self.dispatched += 1
+            self.recent_waits.append(now - queued_time)
+
+            return request
+
+        return None
+
+    def _pop_flow(self, flow, scheduler, now):
+        while len(flow.ready_hosts) > 0:
+            host_name = flow.ready_hosts[0]
+
+            if self.is_polite and not scheduler.is_host_available(host_name, now):
+                flow.ready_hosts.popleft()
+                scheduler.park(host_name, flow, now)
+                continue
+
+            host_queue = flow.host_queues[host_name]
+            item = host_queue.popleft()
+
+            if len(host_queue) == 0:
+                flow.ready_hosts.popleft()
+                del flow.host_queues[host_name]
+            else:
+                flow.ready_hosts.rotate(-1)
+
+            return item
+
+        return None
+
+    def get_oldest_wait(self, now):
+        oldest_times = [host_queue[0][0] for flow in self.flows.values() for host_queue in flow.host_queues.values()]
+
+        return now - min(oldest_times) if len(oldest_times) > 0 else 0
+
+    def get_stats(self, now):
+        recent_waits = self.recent_waits
+
+        return {
+            "queued": self.size,
+            "flows": len(self.flows),
+            "dispatched": self.dispatched,
+            "mean_wait": sum(recent_waits) / len(recent_waits) if len(recent_waits) > 0 else 0,
+            "max_wait": max(recent_waits) if len(recent_waits) > 0 else 0,
+            "oldest_wait": self.get_oldest_wait(now)
+        }
+
+
+class RequestScheduler(object):
+    """
+    Queue of requests pending to be dispatched to the workers.
+
+    Requests are dispatched by strict priority of their classes: a request of a class is only dispatched when there is
+    nothing dispatchable in the classes above it. Inside a class, requests are grouped in flows (a batch, a client...)
+    that share the dispatches according to their weights, so that a big flow can't starve the rest of them.
+
+    Inside a flow, requests are grouped by host and the hosts take turns. The requests of the polite classes are also
+    subject to per-host limits: a maximum of captures in flight and a minimum spacing between dispatches. A flow whose
+    hosts are all at their limits is parked in those hosts until any of them is available again, so the dispatch never
+    scans the queued requests.
+
+    A request tells its class, flow and weight through get_priority_class(), get_flow_id() and get_weight(), and its
+    host through get_host(). Requests without them are dispatched as interactive requests of a single flow. Every
+    dispatched request must be released with release() once it is processed.
+
+    It is not thread-safe; its owner must synchronize the access to it.
+    """
+
+    def __init__(self, priority_classes=None, polite_classes=None,
+                 max_in_flight_per_host=DEFAULT_MAX_IN_FLIGHT_PER_HOST, min_host_spacing=DEFAULT_MIN_HOST_SPACING,
+                 host_limits=None):
+        """
+        Initializes the scheduler.
+        :param priority_classes: list of names of the priority classes, from the most to the least prioritary. Requests
+        of unknown classes go to the least prioritary one.
+        :param polite_classes: list of names of the priority classes subject to the per-host limits.
+        :param max_in_flight_per_host: maximum captures in flight of a single host.
+        :param min_host_spacing: minimum seconds between two dispatches of the same host.
+        :param host_limits: dict of host name -> dict with the keys "max_in_flight" and "min_spacing", overriding the
+        limits for that host.
+        """
+        if priority_classes is None:
+            priority_classes = DEFAULT_PRIORITY_CLASSES
+
+        if polite_classes is None:
+            polite_classes = DEFAULT_POLITE_CLASSES
+
+        self.priority_classes = [_PriorityClass(name, name in polite_classes) for name in priority_classes]
+        self.classes_by_name = {priority_class.name: priority_class for priority_class in self.priority_classes}
+        self.max_in_flight_per_host = max_in_flight_per_host
+        self.min_host_spacing = min_host_spacing
+        self.host_limits = {host_name.lower(): limits for host_name, limits in (host_limits or {}).items()}
+        self.hosts = {}
+        self.host_timers = []
+        self.size = 0
+
+    @classmethod
+    def from_config(cls, scheduler_config):
+        """
+        Builds the scheduler from the "scheduler" section of the configuration.
+        :param scheduler_config: dict with the keys "max_in_flight_per_host", "min_host_spacing" and "hosts".
+        """
+        return cls(max_in_flight_per_host=int(scheduler_config.get('max_in_flight_per_host',
+                                                                   DEFAULT_MAX_IN_FLIGHT_PER_HOST)),
+                   min_host_spacing=float(scheduler_config.get('min_host_spacing', DEFAULT_MIN_HOST_SPACING)),
+                   host_limits=scheduler_config.get('hosts'))
+
+    def _get_priority_class(self, request):
+        class_name = request.get_priority_class() if hasattr(request, 'get_priority_class') else INTERACTIVE
+
+        return self.classes_by_name.get(class_name, self.priority_classes[-1])
+
+    def get_priority(self, request):
+        """
+        :param request: request to rank.
+        :return: rank of the priority class of the request; the lower, the more prioritary.
+        """
+        return self.priority_classes.index(self._get_priority_class(request))
+
+    @staticmethod
+    def _get_host_name(request):
+        return request.get_host() if hasattr(request, 'get_host') else None
+
+    def _get_host(self, host_name):
+        host = self.hosts.get(host_name)
+
+        if host is None:
+            limits = self.host_limits.get(host_name, {})
+            host = _Host(int(limits.get('max_in_flight', self.max_in_flight_per_host)),
+                         float(limits.get('min_spacing', self.min_host_spacing)))
+            self.hosts[host_name] = host
+
+        return host
+
+    def _forget_host(self, host_name, now):
+        """
+        Forgets the state of a host if it does not constrain anything anymore.
+        """
+        host = self.hosts[host_name]
+
+        if host.in_flight == 0 and len(host.parked_flows) == 0 and not host.timer_scheduled and \
+                now >= host.next_dispatch_time:
+            del self.hosts[host_name]
+
+    def is_host_available(self, host_name, now):
+        host = self.hosts.get(host_name)
+
+        return host is None or host.is_available(now)
+
+    def park(self, host_name, flow, now):
+        """
+        Parks a flow in an unavailable host, until the host is available again.
+        """
+        host = self.hosts[host_name]
+        host.parked_flows.append(flow)
+
+        if host.in_flight < host.max_in_flight and not host.timer_scheduled:
+            # Only the spacing holds the host; it is available again at a known time.
+            host.timer_scheduled = True
+            heapq.heappush(self.host_timers, (host.next_dispatch_time, host_name))
+
+    def _unpark(self, host_name):
+        """
+        Gives back the turns to the flows parked in a host.
+        """
+        host = self.hosts[host_name]
+        parked_flows = host.parked_flows
+        host.parked_flows = []
+
+        for flow in parked_flows:
+            if host_name in flow.host_queues:
+                flow.ready_hosts.append(host_name)
+                flow.priority_class.activate(flow)
+
+    def _fire_host_timers(self, now):
+        while len(self.host_timers) > 0 and self.host_timers[0][0] <= now:
+            _, host_name = heapq.heappop(self.host_timers)
+            self.hosts[host_name].timer_scheduled = False
+            self._unpark(host_name)
+            self._forget_host(host_name, now)
+
+    def push(self, request):
+        """
+        Queues a request.
+        :param request: request to queue.
+        """
+        flow_id = request.get_flow_id() if hasattr(request, 'get_flow_id') else None
+        weight = clamp_flow_weight(request.get_weight()) if hasattr(request, 'get_weight') else 1
+
+        self._get_priority_class(request).push(request, self._get_host_name(request), flow_id, weight)
+        self.size += 1
+
+    def pop(self):
+        """
+        Takes the next request to dispatch. The request counts as in flight for its host until it is released.
+        :return: request, or None if there are no requests queued or their hosts are not available.
+        """
+        now = time.time()
+        self._fire_host_timers(now)
+
+        for priority_class in self.priority_classes:
+            if priority_class.size == 0:
+                continue
+
+            request = priority_class.pop(self, now)
+
+            if request is not None:
+                self.size -= 1
+                host_name = self._get_host_name(request)
+
+                if host_name is not None:
+                    host = self._get_host(host_name)
+                    host.in_flight += 1
+                    host.next_dispatch_time = now + host.min_spacing
+
+                return request
+
+        return None
+
+    def release(self, request):
+        """
+        Notifies that a dispatched request is not in flight anymore.
+        :param request: request returned by pop().
+        """
+        host_name = self._get_host_name(request)
+
+        if host_name is None or host_name not in self.hosts:
+            return
+
+        now = time.time()
+        host = self.hosts[host_name]
+        host.in_flight -= 1
+
+        if len(host.parked_flows) > 0 and host.in_flight < host.max_in_flight:
+            self._unpark(host_name)
+
+        self._forget_host(host_name, now)
+
+    def discard(self, request):
+        """
+        Releases a request that was taken with pop() but not dispatched.
+        :param request: request returned by pop().
+        """
+        self.release(request)
+
+    def get_time_to_next_timer(self):
+        """
+        :return: seconds until a host held by its spacing is available again, or None if no host is held by it.
+        """
+        if len(self.host_timers) == 0:
+            return None
+
+        return max(self.host_timers[0][0] - time.time(), 0)
+
+    def get_stats(self):
+        """
+        Retrieves the depth and the wait times of every priority class. Wait times are in seconds; the mean and the
+        maximum are measured over the latest dispatches of the class.
+        :return: dict of class name -> dict of statistics.
+        """
+        now = time.time()
+
+        return {priority_class.name: priority_class.get_stats(now) for priority_class in self.priority_classes}
+
+    def get_queued_count(self, class_name):
+        """
+        Counts the requests that would be dispatched before a new request of a priority class.
+        :param class_name: name of the priority class.
+        :return: amount of requests queued in the class and in the more prioritary ones.
+        """
+        rank = self.priority_classes.index(self.classes_by_name.get(class_name, self.priority_classes[-1]))
+
+        return sum(priority_class.size for priority_class in self.priority_classes[:rank + 1])
+
+    def get_host_stats(self):
+        """
+        Retrieves the state of the hosts being captured.
+        :return: dict with the amount of hosts with captures in flight and the amount of hosts that hold queued requests
+        because of their limits.
+        """
+        return {
+            "in_flight": sum(1 for host in self.hosts.values() if host.in_flight > 0),
+            "throttled": sum(1 for host in self.hosts.values() if len(host.parked_flows) > 0)
+        }
+
+    def __len__(self):
+        return self.size
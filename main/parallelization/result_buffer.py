@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import io
+import mmap
+import os
+import tempfile
+import uuid
+
+__author__ = 'Iván de Paz Centeno'
+
+# Spool files live in shared memory when available, so that writing and mapping them never touches the disk.
+if os.path.isdir("/dev/shm"):
+    SPOOL_FOLDER = "/dev/shm/screenshooter_spool/"
+else:
+    SPOOL_FOLDER = os.path.join(tempfile.gettempdir(), "screenshooter_spool")
+
+
+class SpoolHandle(object):
+    """
+    Small reference to binary data written by a pool worker into a spool file.
+    It is what travels through the result pipe of the pool instead of the data itself.
+    """
+
+    def __init__(self, filename, size):
+        self.filename = filename
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+
+def spool(binary_data):
+    """
+    Writes binary data into a new spool file.
+    :param binary_data: bytes-like object to spool.
+    :return: SpoolHandle of the spool file.
+    """
+    try:
+        os.makedirs(SPOOL_FOLDER)
+    except OSError:
+        pass
+
+    filename = os.path.join(SPOOL_FOLDER, "{}_{}".format(os.getpid(), uuid.uuid4().hex))
+
+    with open(filename, "wb") as f:
+        f.write(binary_data)
+
+    return SpoolHandle(filename, len(binary_data))
+
+
+class _BufferReader(io.RawIOBase):
+    """
+    Read-only file-like object over a ScreenshotBuffer. Each reader keeps its own position, and keeps the buffer alive
+    while it is being read.
+    """
+
+    def __init__(self, screenshot_buffer):
+        io.RawIOBase.__init__(self)
+        self.screenshot_buffer = screenshot_buffer
+        self.view = screenshot_buffer.getbuffer()
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        size = min(len(b), len(self.view) - self.position)
+        b[:size] = self.view[self.position:self.position + size]
+        self.position += size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+
+        self.position = max(0, min(offset, len(self.view)))
+        return self.position
+
+    def tell(self):
+        return self.position
+
+
+class ScreenshotBuffer(object):
+    """
+    Read-only buffer with the binary data of a screenshot.
+
+    Buffers attached to a spool file are memory-mapped: the data is read straight from the pages of the spool file,
+    without being copied into the process. The spool file is unlinked as soon as it is mapped, so its memory is given
+    back when the buffer is released, either explicitly or when the last reference to the buffer is gone.
+    """
+
+    def __init__(self, data, mapping=None):
+        """
+        Initializes the buffer. Use attach() or from_bytes() instead.
+        :param data: bytes-like object with the data.
+        :param mapping: mmap object the data belongs to, if any.
+        """
+        self.view = memoryview(data)
+        self.mapping = mapping
+
+    @classmethod
+    def attach(cls, spool_handle):
+        """
+        Maps the spool file referenced by a handle and removes it from the spool folder.
+        :param spool_handle: SpoolHandle returned by a worker.
+        :return: ScreenshotBuffer with the data of the spool file.
+        """
+        try:
+            if spool_handle.size == 0:
+                return cls(b"")
+
+            with open(spool_handle.filename, "rb") as f:
+                mapping = mmap.mmap(f.fileno(), spool_handle.size, access=mmap.ACCESS_READ)
+
+        finally:
+            os.remove(spool_handle.filename)
+
+        return cls(mapping, mapping)
+
+    @classmethod
+    def from_bytes(cls, binary_data):
+        return cls(binary_data)
+
+    def __len__(self):
+        return len(self.view)
+
+    def getbuffer(self):
+        """
+        Retrieves a view over the data, without copying it.
+        :return: memoryview
+        """
+        return self.view
+
+    def open(self):
+        """
+        Opens the data as a read-only file-like object.
+        :return: file-like object positioned at the beginning of the data.
+        """
+        return _BufferReader(self)
+
+    def tobytes(self):
+        return self.view.tobytes()
+
+    def release(self):
+        """
+        Releases the memory mapped for this buffer. The buffer can't be read afterwards.
+        """
+        self.view.release()
+
+        if self.mapping is not None:
+            try:
+                self.mapping.close()
+            except BufferError:
+                # Some reader still holds a view over the mapping; it will be unmapped when the reader is gone.
+                pass
+
+            self.mapping = None
+
+    def __del__(self):
+        if hasattr(self, 'view'):
+            self.release()
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 import os
 import select
+from threading import Lock, Condition
 
 __author__ = "Ivan de Paz Centeno"
 
@@ -51,7 +52,7 @@ class ResultPromise(object):
     Also, it allows to wait for the result to be ready.
     """
 
-    def __init__(self, multithread_manager, request, service_owner, callback=None, promise_lock=None, promise_event=None):
+    def __init__(self, request, service_owner, callback=None, promise_lock=None, promise_event=None):
         """
         Initializes the result container.
         """
@@ -64,9 +65,14 @@ class ResultPromise(object):
         self.discard_aborts = 0
         self.service_owner = service_owner
         self.listener_func = callback
+        self.done_callbacks = []
 
         if self.lock is None:
-            self.lock = multithread_manager.Lock()
+            self.lock = Lock()
+
+        # Every promise has its own condition, even if the lock is shared, so that waiters are only woken by their own
+        # results.
+        self.condition = Condition(self.lock)
 
         if self.event is None:
             self.event = WaitableEvent()
@@ -79,28 +85,42 @@ class ResultPromise(object):
         with self.lock:
             self.result = result
             self.result_set = True
+            done_callbacks = self.done_callbacks
+            self.done_callbacks = []
+            self.condition.notify_all()
 
         self.event.set()
 
         if self.listener_func is not None:
             self.listener_func(self)
 
-    def get_result(self):
+        for done_callback in done_callbacks:
+            done_callback(self)
+
+    def add_done_callback(self, done_callback):
         """
-        Getter for the result. It will wait until the result is ready.
-        :return: Resource object.
+        Registers a function to be invoked with the promise once its result is set, without waiting for it. Unlike the
+        listener, any amount of them can be registered. If the result is already set, it is invoked straight away.
+        Note that it is invoked from the thread that sets the result.
+        :param done_callback: function that receives the promise as parameter.
         """
         with self.lock:
             result_set = self.result_set
 
-        while result_set is False:
-            self.event.wait()
-            self.event.clear()
+            if not result_set:
+                self.done_callbacks.append(done_callback)
 
-            with self.lock:
-                result_set = self.result_set
+        if result_set:
+            done_callback(self)
 
-        with self.lock:
+    def get_result(self, timeout=None):
+        """
+        Getter for the result. It will wait until the result is ready.
+        :param timeout: maximum seconds to wait, or None to wait forever.
+        :return: Resource object, or None if the timeout expired.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.result_set, timeout)
             result = self.result
 
         return result
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import cProfile
+import io
+import os
+import pstats
+import random
+
+__author__ = 'Iván de Paz Centeno'
+
+DEFAULT_PROFILES_FOLDER = "/tmp/screenshooter_profiles/"
+PROFILE_PREFIX = "worker_"
+PROFILE_EXTENSION = ".prof"
+
+
+class ProfilingSettings(object):
+    """
+    Which pool workers profile their work and how often. It travels with each chunk of requests dispatched, so changing
+    it takes effect in the workers without restarting them.
+    """
+
+    def __init__(self, sample_rate=0.0, worker_pids=None, generation=0, folder=DEFAULT_PROFILES_FOLDER):
+        """
+        :param sample_rate: fraction of the chunks of requests profiled, from 0 (profiling disabled) to 1.
+        :param worker_pids: list of PIDs of the workers that profile, or None for all of them.
+        :param generation: increased every time the profiles are reset, so that the workers start new ones.
+        :param folder: folder where each worker dumps its profile.
+        """
+        self.sample_rate = sample_rate
+        self.worker_pids = worker_pids
+        self.generation = generation
+        self.folder = folder
+
+    def is_enabled(self):
+        return self.sample_rate > 0
+
+    def is_selected(self, pid):
+        return self.worker_pids is None or pid in self.worker_pids
+
+    def to_dict(self):
+        return {"sample_rate": self.sample_rate, "worker_pids": self.worker_pids, "generation": self.generation}
+
+
+def get_profile_filename(folder, pid):
+    return os.path.join(folder, "{}{}{}".format(PROFILE_PREFIX, pid, PROFILE_EXTENSION))
+
+
+class WorkerProfiler(object):
+    """
+    Profiles with cProfile a sample of the work of a pool worker, accumulating it in a profile that is dumped to the
+    profiles folder after each sampled chunk.
+    """
+
+    def __init__(self):
+        self.profile = None
+        self.generation = None
+
+    def run(self, settings, function, *args):
+        """
+        Runs a function, profiling it if the settings select this worker and the chunk is sampled.
+        :param settings: ProfilingSettings, or None if profiling is disabled.
+        :return: what the function returns.
+        """
+        pid = os.getpid()
+
+        if settings is None or not settings.is_enabled() or not settings.is_selected(pid) or \
+                random.random() >= settings.sample_rate:
+            return function(*args)
+
+        if self.profile is None or self.generation != settings.generation:
+            self.profile = cProfile.Profile()
+            self.generation = settings.generation
+
+        try:
+            return self.profile.runcall(function, *args)
+
+        finally:
+            os.makedirs(settings.folder, exist_ok=True)
+            self.profile.dump_stats(get_profile_filename(settings.folder, pid))
+
+
+def get_profiled_pids(folder):
+    """
+    :return: list of PIDs of the workers with a profile dumped in the folder.
+    """
+    try:
+        filenames = os.listdir(folder)
+    except OSError:
+        return []
+
+    return sorted(int(filename[len(PROFILE_PREFIX):-len(PROFILE_EXTENSION)]) for filename in filenames
+                  if filename.startswith(PROFILE_PREFIX) and filename.endswith(PROFILE_EXTENSION))
+
+
+def get_profile_stats(folder, pids=None, sort="cumulative", limit=50):
+    """
+    Merges the profiles dumped by the workers into a report.
+    :param folder: folder of the profiles.
+    :param pids: list of PIDs of the workers to report, or None for all of them.
+    :param sort: key to sort the functions by (see pstats.Stats.sort_stats()).
+    :param limit: maximum amount of functions in the report.
+    :return: report as text, or None if there is no profile to report.
+    """
+    filenames = [get_profile_filename(folder, pid) for pid in get_profiled_pids(folder) if pids is None or pid in pids]
+
+    if len(filenames) == 0:
+        return None
+
+    report = io.StringIO()
+    stats = pstats.Stats(*filenames, stream=report)
+    stats.sort_stats(sort).print_stats(limit)
+
+    return report.getvalue()
+
+
+def remove_profiles(folder):
+    for pid in get_profiled_pids(folder):
+        try:
+            os.remove(get_profile_filename(folder, pid))
+        except OSError:
+            pass
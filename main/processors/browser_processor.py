@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import time
+from collections import OrderedDict
+from threading import Thread
+
+from main.processors.capture_result import CaptureResult
+from main.processors.capture_specs import DEFAULT_IMAGE_NAME, MAX_PAGE_HEIGHT, get_capture_spec_name
+from main.processors.page_readiness import PageReadinessWaiter
+from main.processors.processor_interface import Processor
+from main.processors.recycling_policy import RecyclingPolicy, RECYCLE_REQUESTED, get_process_tree_rss
+from main.processors.resource_blocking import BlockingProfiles
+from main.services.metrics import STAGE_NAVIGATION, STAGE_READINESS_WAIT, STAGE_SCREENSHOT
+
+__author__ = 'Iván de Paz Centeno'
+
+VIEWPORT_SIZE_SCRIPT = "return [window.innerWidth, window.innerHeight, window.devicePixelRatio || 1];"
+PAGE_HEIGHT_SCRIPT = "return Math.max(document.documentElement.scrollHeight, " \
+                     "document.body ? document.body.scrollHeight : 0);"
+
+
+class BrowserProcessor(Processor):
+    """
+    Base class for the processors that capture the pages with a browser driven by selenium.
+
+    It owns the lifecycle of the browser: the browser is recycled when its RecyclingPolicy says so, and its replacement
+    is launched in background as soon as the policy foresees the recycle, so that swapping them does not stall the
+    worker. Subclasses implement _launch_driver() and _capture().
+
+    When configured with several tabs, a single browser captures up to that amount of requests at once: each of them
+    is loaded in its own tab, and the tabs are polled in turns until their pages are ready to be captured.
+
+    Requests with capture specs (the option "captures") get several screenshots from a single load of their page: the
+    viewport is resized for each of them. Clips, and the viewport of the browsers whose screenshots are always of the
+    whole page, are cropped afterwards by the image encoder, from the "crops" metadata of the result.
+
+    Subresources of the pages (ads, trackers, fonts, videos...) are blocked as told by the blocking profiles of the
+    configuration, or by the ones chosen by each request (the option "block"). Browsers able to block them per page
+    implement _install_blocking() and report the amount of requests blocked in the "blocked_requests" metadata. The
+    results of the requests with blocking profiles captured by the other browsers are flagged with the
+    "blocking_ignored" metadata.
+    """
+
+    # Whether the browser blocks the subresources chosen by each request, instead of only the default ones.
+    blocks_per_request = False
+
+    # Size of the windows of the browser, or None to keep the default one. Overridden by the "window" configuration.
+    window_size = None
+
+    def __init__(self, processor_config=None):
+        """
+        Constructor of the class.
+        :param processor_config: dict with the "processor" section of the configuration.
+        """
+        Processor.__init__(self)
+
+        if processor_config is None:
+            processor_config = {}
+
+        self.tabs = int(processor_config.get('tabs', 1))
+        self.blocking_profiles = BlockingProfiles.from_config(processor_config.get('blocking', {}))
+
+        if 'window' in processor_config:
+            self.window_size = (int(processor_config['window']['width']), int(processor_config['window']['height']))
+
+        self.readiness_waiter = PageReadinessWaiter(processor_config.get('readiness'))
+        self.recycling_policy = RecyclingPolicy(processor_config.get('recycling'))
+        self.spare_driver = None
+        self.spare_launcher = None
+        self.recycle_count = 0
+
+        # Reason of the last recycle of the browser, until it is reported in the metadata of a result.
+        self.unreported_recycle = None
+        self.unreported_recycle_detail = None
+        self.driver = self._launch_driver()
+
+    def _launch_driver(self):
+        """
+        Launches a new browser.
+        :return: selenium webdriver.
+        """
+        raise NotImplementedError()
+
+    def _capture(self, request):
+        """
+        Captures the page of a request with self.driver.
+        :param request: CaptureRequest to process.
+        :return: CaptureResult, or None if the capture failed.
+        """
+        raise NotImplementedError()
+
+    def _get_blocking_profile(self, request):
+        """
+        :return: BlockingProfile of a request: the profiles it chose, or the default ones.
+        """
+        return self.blocking_profiles.resolve(request.get_option('block'))
+
+    def _install_blocking(self, request):
+        """
+        Sets the subresources to block while the page of a request is loaded in the current tab. By default, the
+        browser blocks the ones of the default profiles since its launch, if it can.
+        :param request: CaptureRequest about to be loaded.
+        """
+        pass
+
+    def _get_blocked_count(self):
+        """
+        :return: amount of requests blocked while loading the page of the current tab, or None if it is unknown.
+        """
+        return None
+
+    def _set_viewport_size(self, width, height):
+        """
+        Resizes the window of the browser so that its viewport has the given size.
+        :return: device pixel ratio of the page.
+        """
+        self.driver.set_window_size(width, height)
+        inner_width, inner_height, pixel_ratio = self.driver.execute_script(VIEWPORT_SIZE_SCRIPT)
+
+        if (inner_width, inner_height) != (width, height):
+            # The size of the window includes the frame of the browser.
+            self.driver.set_window_size(2 * width - inner_width, 2 * height - inner_height)
+
+        return pixel_ratio
+
+    def _take_screenshots(self, request):
+        """
+        Takes the screenshots of a request from its page, already loaded: one for each of its capture specs, or a
+        single one of the viewport as it is if it has none.
+        :param request: CaptureRequest whose page is loaded.
+        :return: tuple (ordered dict of image name -> PNG data, dict of image name -> crop box [left, upper, right,
+        lower] in pixels of the image, list of spans of the screenshots).
+        """
+        capture_specs = request.get_option('captures')
+
+        if not capture_specs:
+            start_time = time.time()
+            screenshot = self.driver.get_screenshot_as_png()
+
+            return OrderedDict([(DEFAULT_IMAGE_NAME, screenshot)]), {}, [[STAGE_SCREENSHOT, start_time, time.time()]]
+
+        images = OrderedDict()
+        crops = {}
+        spans = []
+        window_size = self.driver.get_window_size()
+
+        try:
+            for spec in capture_specs:
+                start_time = time.time()
+                name = get_capture_spec_name(spec)
+                pixel_ratio = self._set_viewport_size(spec['width'], spec['height'])
+
+                if spec['full_page']:
+                    page_height = min(int(self.driver.execute_script(PAGE_HEIGHT_SCRIPT)), MAX_PAGE_HEIGHT)
+
+                    if page_height > spec['height']:
+                        pixel_ratio = self._set_viewport_size(spec['width'], page_height)
+
+                images[name] = self.driver.get_screenshot_as_png()
+                clip = spec.get('clip')
+
+                if clip is not None:
+                    crops[name] = [round(value * pixel_ratio) for value in [
+                        clip['x'], clip['y'], clip['x'] + clip['width'], clip['y'] + clip['height']]]
+
+                elif not spec['full_page']:
+                    crops[name] = [0, 0, round(spec['width'] * pixel_ratio), round(spec['height'] * pixel_ratio)]
+
+                spans.append([STAGE_SCREENSHOT, start_time, time.time()])
+
+        finally:
+            self.driver.set_window_size(window_size['width'], window_size['height'])
+
+        return images, crops, spans
+
+    def process(self, request):
+        """
+        Captures the page of a request, keeping track of the health of the browser.
+        :param request: CaptureRequest to process.
+        :return: CaptureResult of the capture.
+        """
+        start_time = time.time()
+        result = None
+
+        try:
+            result = self._capture(request)
+
+        finally:
+            self.recycling_policy.record_capture(time.time() - start_time, result is not None)
+            self._check_health()
+
+        self._report_recycle(result)
+        self._report_blocking_ignored(request, result)
+
+        return result
+
+    def _report_recycle(self, result):
+        """
+        Reports the last recycle of the browser in the "browser_recycled" metadata of a result, if it was not reported
+        yet, so that the service can account the recycles of every worker.
+        """
+        if result is not None and self.unreported_recycle is not None:
+            result.set_metadata("browser_recycled", self.unreported_recycle)
+            result.set_metadata("browser_recycle_detail", self.unreported_recycle_detail)
+            self.unreported_recycle = None
+            self.unreported_recycle_detail = None
+
+    def _report_blocked_count(self, result):
+        """
+        Reports in the "blocked_requests" metadata of a result the requests blocked while loading its page, if known.
+        """
+        blocked_count = self._get_blocked_count()
+
+        if blocked_count is not None:
+            result.set_metadata("blocked_requests", blocked_count)
+
+    def _report_blocking_ignored(self, request, result):
+        """
+        Flags with the "blocking_ignored" metadata the result of a request whose blocking profiles were not applied.
+        """
+        if result is not None and not self.blocks_per_request and request.get_option('block') is not None:
+            result.set_metadata("blocking_ignored", True)
+
+    def process_many(self, requests, deliver):
+        """
+        Captures several requests, each one in its own tab when the processor has more than one tab.
+        :param requests: list of CaptureRequest to process. At most as many as tabs.
+        :param deliver: function to invoke with (request, result) for each request, as soon as it is captured.
+        """
+        if self.tabs == 1 or len(requests) == 1:
+            return Processor.process_many(self, requests, deliver)
+
+        try:
+            self._capture_in_tabs(requests, deliver)
+        finally:
+            self._check_health()
+
+    def _get_tab_handles(self, count):
+        """
+        Retrieves the handles of the tabs of the browser, opening new tabs if there are not enough of them.
+        :param count: amount of tabs required.
+        :return: list of window handles.
+        """
+        handles = self.driver.window_handles
+
+        while len(handles) < count:
+            self.driver.execute_script("window.open('about:blank');")
+            new_handles = [handle for handle in self.driver.window_handles if handle not in handles]
+
+            if self.window_size is not None:
+                for handle in new_handles:
+                    self.driver.switch_to.window(handle)
+                    self.driver.set_window_size(*self.window_size)
+
+            handles += new_handles
+
+        return handles[:count]
+
+    def _capture_in_tabs(self, requests, deliver):
+        """
+        Loads every request in its own tab without waiting for them, and captures each tab as soon as its page is ready.
+        """
+        pending_tabs = []
+
+        for handle, request in zip(self._get_tab_handles(len(requests)), requests):
+            print("Processing {}".format(request))
+
+            try:
+                start_time = time.time()
+                self.driver.switch_to.window(handle)
+                self._install_blocking(request)
+                # The page is flagged as being left, so that its readiness is not mistaken for the one of the new page.
+                self.driver.execute_script("window.__screenshooterLeaving = true; window.location.href = arguments[0];",
+                                           str(request))
+                navigation_time = time.time() - start_time
+                tracker = self.readiness_waiter.track(request.get_option('wait_for'), request.get_option('max_wait'))
+                pending_tabs.append((handle, request, tracker, navigation_time))
+
+            except Exception as ex:
+                print("Could not load {}: {}".format(request, ex))
+                self.recycling_policy.record_capture(0, False)
+                deliver(request, None)
+
+        while len(pending_tabs) > 0:
+            for pending_tab in list(pending_tabs):
+                handle, request, tracker, navigation_time = pending_tab
+
+                try:
+                    self.driver.switch_to.window(handle)
+
+                    if not tracker.poll(self.driver):
+                        continue
+
+                    start_time = time.time()
+                    images, crops, screenshot_spans = self._take_screenshots(request)
+                    end_time = time.time()
+                    timings = {STAGE_NAVIGATION: navigation_time, STAGE_READINESS_WAIT: tracker.get_wait_time(),
+                               STAGE_SCREENSHOT: end_time - start_time}
+                    spans = [[STAGE_NAVIGATION, tracker.start_time - navigation_time, tracker.start_time],
+                             [STAGE_READINESS_WAIT, tracker.start_time, start_time]] + screenshot_spans
+                    result = CaptureResult(images, {"readiness_wait": tracker.get_wait_time(), "tabs": len(requests),
+                                                    "timings": timings, "spans": spans, "crops": crops})
+                    self._report_blocked_count(result)
+                    self._report_blocking_ignored(request, result)
+                    print("Processed {} ({:.2f}s waiting for the page{})".format(
+                        request, tracker.get_wait_time(), "" if tracker.is_ready else ", timed out"))
+
+                except Exception as ex:
+                    print("Could not capture {}: {}".format(request, ex))
+                    result = None
+
+                pending_tabs.remove(pending_tab)
+                self.recycling_policy.record_capture(time.time() - tracker.start_time, result is not None)
+                self._report_recycle(result)
+                deliver(request, result)
+
+            if len(pending_tabs) > 0:
+                time.sleep(self.readiness_waiter.poll_interval)
+
+    def _get_browser_pid(self, driver):
+        try:
+            return driver.service.process.pid
+        except AttributeError:
+            return None
+
+    def _check_health(self):
+        """
+        Recycles the browser if its policy says so, or launches its replacement in advance if the recycle is near.
+        :return: the reason of the recycle, or None if the browser was not recycled.
+        """
+        pid = self._get_browser_pid(self.driver)
+
+        if pid is not None:
+            self.recycling_policy.record_rss(get_process_tree_rss(pid))
+
+        recycle_reason = self.recycling_policy.get_recycle_reason()
+
+        if recycle_reason is not None:
+            self.restart(recycle_reason, self.recycling_policy.get_recycle_detail(recycle_reason))
+
+        elif self.recycling_policy.should_prelaunch():
+            self._prelaunch_driver()
+
+        return recycle_reason
+
+    def _prelaunch_driver(self):
+        """
+        Launches in background the browser that will replace the current one.
+        """
+        if self.spare_launcher is not None or self.spare_driver is not None:
+            return
+
+        def launch():
+            try:
+                self.spare_driver = self._launch_driver()
+            except Exception as ex:
+                print("Could not pre-launch a browser: {}".format(ex))
+
+        self.spare_launcher = Thread(target=launch, daemon=True)
+        self.spare_launcher.start()
+
+    def restart(self, reason=RECYCLE_REQUESTED, detail=None):
+        """
+        Replaces the browser by a fresh one. The pre-launched browser is used if available.
+        :param reason: code of the reason of the restart, for the metrics.
+        :param detail: description of the reason of the restart with its measurements, for the logs.
+        """
+        detail = detail or reason
+        print("Recycling browser ({}).".format(detail))
+        self.unreported_recycle = reason
+        self.unreported_recycle_detail = detail
+
+        if self.spare_launcher is not None:
+            self.spare_launcher.join()
+            self.spare_launcher = None
+
+        new_driver = self.spare_driver
+        self.spare_driver = None
+
+        if new_driver is None:
+            new_driver = self._launch_driver()
+
+        old_driver = self.driver
+        self.driver = new_driver
+        self.recycling_policy.reset()
+        self.recycle_count += 1
+
+        # Quitting a browser may take a while; the worker does not need to wait for it.
+        Thread(target=self._quit_driver, args=(old_driver,), daemon=True).start()
+
+    @staticmethod
+    def _quit_driver(driver):
+        try:
+            driver.quit()
+        except Exception as ex:
+            print("Could not quit a browser: {}".format(ex))
+
+    def __del__(self):
+        if self.spare_launcher is not None:
+            self.spare_launcher.join()
+
+        for driver in [getattr(self, 'driver', None), self.spare_driver]:
+            if driver is not None:
+                self._quit_driver(driver)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from main.parallelization.request_scheduler import INTERACTIVE
+from main.services.tracing import new_trace_id
+
+__author__ = 'Iván de Paz Centeno'
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+# Options that tell how a request must be served, but that do not change the captured result.
+NON_CAPTURE_OPTIONS = ["max_age", "if_changed"]
+
+
+def normalize_url(url):
+    """
+    Normalizes a URL so that different spellings of the same webpage are equal.
+    Scheme and host are lowercased, default ports and fragments are removed and the query parameters are sorted.
+    :param url: URL to normalize.
+    :return: normalized URL.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or "").lower()
+
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        netloc = "{}:{}".format(netloc, port)
+
+    if parts.username is not None:
+        credentials = parts.username if parts.password is None else "{}:{}".format(parts.username, parts.password)
+        netloc = "{}@{}".format(credentials, netloc)
+
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
+class CaptureRequest(object):
+    """
+    Wraps the URL to capture together with the options that customize its capture.
+
+    Interactive requests are scheduled in a flow per client, so that the clients share the workers fairly.
+    """
+
+    def __init__(self, url, options=None, client_id=None, trace_id=None):
+        """
+        Initializes the request.
+        :param url: URL of the webpage to capture.
+        :param options: dict of capture options (for example "wait_for" or "max_wait").
+        :param client_id: identifier of the client that requested the capture (for example, its address).
+        :param trace_id: ID of the trace of the request. By default, a new one.
+        """
+        self.url = url
+        self.options = dict(options or {})
+        self.client_id = client_id
+        self.trace_id = trace_id or new_trace_id()
+
+    def get_url(self):
+        return self.url
+
+    def get_options(self):
+        return self.options
+
+    def get_option(self, name, default=None):
+        return self.options.get(name, default)
+
+    def get_host(self):
+        """
+        :return: lowercased host name of the URL.
+        """
+        return urlsplit(self.url.strip()).hostname or ""
+
+    def get_trace_id(self):
+        return self.trace_id
+
+    def get_priority_class(self):
+        return INTERACTIVE
+
+    def get_flow_id(self):
+        return self.client_id
+
+    def get_weight(self):
+        return 1
+
+    def get_capture_options(self):
+        """
+        Retrieves the options that have an effect on the captured result.
+        :return: dict of options.
+        """
+        return {name: value for name, value in self.options.items() if name not in NON_CAPTURE_OPTIONS}
+
+    def get_cache_key(self):
+        """
+        Computes the key that identifies the result of this request: the hash of the normalized URL and the capture
+        options.
+        :return: hexadecimal digest.
+        """
+        key_content = json.dumps([normalize_url(self.url), self.get_capture_options()], sort_keys=True)
+        return hashlib.sha256(key_content.encode()).hexdigest()
+
+    def __eq__(self, other):
+        if isinstance(other, str):
+            return self.url == other and len(self.options) == 0
+
+        try:
+            equals = self.url == other.url and self.options == other.options
+
+        except AttributeError:
+            equals = False
+
+        return equals
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.url)
+
+    def __str__(self):
+        return self.url
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from main.parallelization.result_buffer import spool, SpoolHandle, ScreenshotBuffer
+
+__author__ = 'Iván de Paz Centeno'
+
+
+class CaptureResult(object):
+    """
+    Wraps the outcome of a capture: the images taken from the page and the metadata gathered while taking them.
+    """
+
+    def __init__(self, images=None, metadata=None):
+        """
+        Initializes the result.
+        :param images: ordered dict of image name -> image. The first image is the main one. Images are binary data when
+        created by the processors, and ScreenshotBuffer objects once delivered by the service.
+        :param metadata: dict of values describing how the capture went (for example, "readiness_wait").
+        """
+        self.images = OrderedDict(images or {})
+        self.metadata = dict(metadata or {})
+
+    def get_image(self, name=None):
+        """
+        Retrieves an image of the result.
+        :param name: name of the image. If None, the main image is returned.
+        :return: the image, or None if there is no such image.
+        """
+        if name is None:
+            return next(iter(self.images.values()), None)
+
+        return self.images.get(name)
+
+    def get_images(self):
+        return self.images
+
+    def set_image(self, name, binary_data):
+        self.images[name] = binary_data
+
+    def spool_images(self):
+        """
+        Moves the binary data of the images into spool files, leaving only handles to them.
+        Invoked in the pool workers, so that only the handles travel back to the service.
+        """
+        for name, image in self.images.items():
+            if isinstance(image, (bytes, bytearray)):
+                self.images[name] = spool(image)
+
+    def attach_images(self):
+        """
+        Replaces the handles of spooled images by buffers mapped on their spool files, and wraps the binary data of the
+        rest of the images into buffers.
+        """
+        for name, image in self.images.items():
+            if isinstance(image, SpoolHandle):
+                self.images[name] = ScreenshotBuffer.attach(image)
+            elif isinstance(image, (bytes, bytearray)):
+                self.images[name] = ScreenshotBuffer.from_bytes(image)
+
+    def get_metadata(self, key=None, default=None):
+        if key is None:
+            return self.metadata
+
+        return self.metadata.get(key, default)
+
+    def set_metadata(self, key, value):
+        self.metadata[key] = value
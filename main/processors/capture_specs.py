@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Iván de Paz Centeno'
+
+# Name of the image of the requests without capture specs.
+DEFAULT_IMAGE_NAME = "screenshot"
+
+MAX_CAPTURE_SPECS = 10
+MAX_VIEWPORT_WIDTH = 4096
+MAX_VIEWPORT_HEIGHT = 4096
+
+# Full-page captures of longer pages are cut at this height.
+MAX_PAGE_HEIGHT = 16384
+
+
+def get_capture_spec_name(spec):
+    """
+    :param spec: dict of a capture spec.
+    :return: name of the image of the spec: its "name", or "<width>x<height>" followed by "_full" for full-page
+    captures and "_clip" for clipped ones.
+    """
+    if spec.get('name') is not None:
+        return spec['name']
+
+    return "{}x{}{}{}".format(spec['width'], spec['height'], "_full" if spec.get('full_page') else "",
+                              "_clip" if spec.get('clip') is not None else "")
+
+
+def _get_integer(json_object, key, min_value, max_value=None):
+    value = json_object.get(key)
+
+    if not isinstance(value, int) or isinstance(value, bool) or value < min_value or \
+            (max_value is not None and value > max_value):
+        value_range = "from {}".format(min_value) if max_value is None else "from {} to {}".format(min_value, max_value)
+        raise ValueError("{} must be an integer {}.".format(key, value_range))
+
+    return value
+
+
+def parse_capture_specs(json_specs):
+    """
+    Validates the capture specs of a request: the list of screenshots taken from its page once loaded. Each of them is
+    a dict with the size of the viewport ("width" and "height"), whether the whole page is captured instead of only
+    the viewport ("full_page"), an optional rectangle of the page to keep ("clip", a dict with "x", "y", "width" and
+    "height") and an optional "name" of its image.
+    :param json_specs: list of dicts from the request JSON.
+    :return: list of capture specs.
+    :raises ValueError: if the specs are not valid.
+    """
+    if not isinstance(json_specs, list) or not 0 < len(json_specs) <= MAX_CAPTURE_SPECS:
+        raise ValueError("captures must be a list of 1 to {} capture specs.".format(MAX_CAPTURE_SPECS))
+
+    specs = []
+
+    for json_spec in json_specs:
+        if not isinstance(json_spec, dict):
+            raise ValueError("Each capture spec must be an object.")
+
+        spec = {
+            "width": _get_integer(json_spec, 'width', 1, MAX_VIEWPORT_WIDTH),
+            "height": _get_integer(json_spec, 'height', 1, MAX_VIEWPORT_HEIGHT),
+            "full_page": json_spec.get('full_page', False)
+        }
+
+        if not isinstance(spec['full_page'], bool):
+            raise ValueError("full_page must be true or false.")
+
+        clip = json_spec.get('clip')
+
+        if clip is not None:
+            if not isinstance(clip, dict):
+                raise ValueError("clip must be an object with x, y, width and height.")
+
+            spec['clip'] = {"x": _get_integer(clip, 'x', 0), "y": _get_integer(clip, 'y', 0),
+                            "width": _get_integer(clip, 'width', 1), "height": _get_integer(clip, 'height', 1)}
+
+        name = json_spec.get('name')
+
+        if name is not None:
+            if not isinstance(name, str) or not name.replace("_", "").replace("-", "").isalnum():
+                raise ValueError("name must contain only letters, digits, - and _.")
+
+            spec['name'] = name
+
+        specs.append(spec)
+
+    names = [get_capture_spec_name(spec) for spec in specs]
+
+    if len(set(names)) < len(names):
+        raise ValueError("The names of the captures must be unique.")
+
+    return specs
@@ -1,49 +1,102 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import base64
+import time
+
 from selenium import webdriver
-from main.processors.processor_interface import Processor
+from main.processors.browser_processor import BrowserProcessor
+from main.processors.capture_result import CaptureResult
+from main.services.metrics import STAGE_NAVIGATION, STAGE_READINESS_WAIT, STAGE_SCREENSHOT
 from pyvirtualdisplay import Display
-import time
 
 __author__ = 'Iván de Paz Centeno'
 
-WAIT_TIME_AFTER_GET = 5
 
+class FirefoxProcessor(BrowserProcessor):
+    """
+    Captures the pages with Firefox in a virtual display.
 
-class FirefoxProcessor(Processor):
+    Firefox can not block subresources per page: the default blocking profiles are applied to the whole browser when it
+    is launched, with a proxy auto-config that blocks their domains and preferences that disable their images, fonts,
+    stylesheets and media autoplay. Scripts are never blocked, as the readiness of the pages is probed with them. The
+    server rejects the requests that choose their blocking profiles.
+    """
 
-    def __init__(self):
+    def __init__(self, processor_config=None):
         """
         Constructor of the class.
         Initializes the webdriver for this processor.
+        :param processor_config: dict with the "processor" section of the configuration.
         """
-        Processor.__init__(self)
+        window_size = processor_config.get('window') if processor_config is not None else None
+        display_size = (800, 600) if window_size is None else (int(window_size['width']), int(window_size['height']))
+
+        # Windows larger than the display are allowed: the full-page captures resize them to the height of the page.
+        self.virtual_browser_display = Display(visible=0, size=display_size)
+        self.virtual_browser_display.start()
+
+        BrowserProcessor.__init__(self, processor_config)
+
+    def _launch_driver(self):
         profile = webdriver.FirefoxProfile()
         profile.set_preference("browser.cache.disk.enable", False)
         profile.set_preference("browser.cache.memory.enable", False)
         profile.set_preference("browser.cache.offline.enable", False)
         profile.set_preference("network.http.use-cache", False)
+        self._set_blocking_preferences(profile, self.blocking_profiles.resolve())
 
-        self.virtual_browser_display = Display(visible=0, size=(800, 600))
-        self.virtual_browser_display.start()
+        driver = webdriver.Firefox(firefox_profile=profile, executable_path="main/drivers/geckodriver")
+
+        if self.window_size is not None:
+            driver.set_window_size(*self.window_size)
+
+        return driver
+
+    @staticmethod
+    def _set_blocking_preferences(profile, blocking_profile):
+        if len(blocking_profile.domains) > 0:
+            proxy_autoconfig = base64.b64encode(blocking_profile.get_proxy_autoconfig().encode()).decode()
+            profile.set_preference("network.proxy.type", 2)
+            profile.set_preference("network.proxy.autoconfig_url",
+                                   "data:application/x-ns-proxy-autoconfig;base64," + proxy_autoconfig)
+
+        if "image" in blocking_profile.resource_types:
+            profile.set_preference("permissions.default.image", 2)
+
+        if "font" in blocking_profile.resource_types:
+            profile.set_preference("gfx.downloadable_fonts.enabled", False)
+
+        if "stylesheet" in blocking_profile.resource_types:
+            profile.set_preference("permissions.default.stylesheet", 2)
 
-        self.driver = webdriver.Firefox(firefox_profile=profile, executable_path="main/drivers/geckodriver") 
-        #self.driver.set_window_size(1024, 768)
+        if "media" in blocking_profile.resource_types:
+            profile.set_preference("media.autoplay.default", 5)
 
-    def process(self, url):
+    def _capture(self, url_wrapper):
         """
         Retrieves a request (any url) and returns a screenshot in binary format.
-        :param url: URL to process.
-        :return: binary data in PNG format of the screenshot.
+        :param url_wrapper: CaptureRequest to process.
+        :return: CaptureResult with the screenshot in PNG format, the seconds waited for the page to be ready, the
+        seconds spent in each stage of the capture and its spans.
         """
+        url = str(url_wrapper)
         print("Processing {}".format(url))
+        start_time = time.time()
         self.driver.get(url)  # whatever reachable url
-        time.sleep(WAIT_TIME_AFTER_GET) # Wait 10 seconds for page to be loaded.
-        binary_data = self.driver.get_screenshot_as_png()
+        spans = [[STAGE_NAVIGATION, start_time, time.time()]]
+        start_time = time.time()
+        wait_time, is_ready = self.readiness_waiter.wait(self.driver, url_wrapper.get_option('wait_for'),
+                                                         url_wrapper.get_option('max_wait'))
+        spans.append([STAGE_READINESS_WAIT, start_time, time.time()])
+        start_time = time.time()
+        images, crops, screenshot_spans = self._take_screenshots(url_wrapper)
+        spans += screenshot_spans
+        timings = {STAGE_NAVIGATION: spans[0][2] - spans[0][1], STAGE_READINESS_WAIT: wait_time,
+                   STAGE_SCREENSHOT: time.time() - start_time}
         self.driver.back()
-        print("Processed {}".format(url))
-        return binary_data
+        print("Processed {} ({:.2f}s waiting for the page{})".format(url, wait_time, "" if is_ready else ", timed out"))
+        return CaptureResult(images, {"readiness_wait": wait_time, "timings": timings, "spans": spans, "crops": crops})
 
     def __del__(self):
-        self.driver.quit()
+        BrowserProcessor.__del__(self)
         self.virtual_browser_display.stop()
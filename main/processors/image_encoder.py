@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import io
+import os
+import time
+from collections import OrderedDict
+from importlib.util import find_spec
+from multiprocessing.pool import Pool
+
+from main.parallelization.result_buffer import spool
+
+__author__ = 'Iván de Paz Centeno'
+
+DEFAULT_ENCODERS = 2
+DEFAULT_QUALITY = 85
+
+# Options of a request that require its images to be post-processed.
+ENCODING_OPTIONS = ["format", "quality", "max_width", "max_height", "thumbnails"]
+
+PIL_FORMATS = {"png": "PNG", "jpeg": "JPEG", "webp": "WEBP"}
+FORMAT_EXTENSIONS = {"png": "png", "jpeg": "jpg", "webp": "webp"}
+FORMAT_MIMETYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+
+def _encode_image(image, image_format, quality):
+    if image_format == "jpeg" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    output = io.BytesIO()
+
+    if image_format == "png":
+        image.save(output, PIL_FORMATS[image_format])
+    else:
+        image.save(output, PIL_FORMATS[image_format], quality=quality)
+
+    return spool(output.getbuffer())
+
+
+def encode_images(images, options):
+    """
+    Generic encode function.
+    The encoder pool process is going to execute this function on its own thread.
+    Every image is cropped, resized to fit the maximum size and encoded in the requested format. Thumbnails of each
+    image are named "<image name>_thumbnail_<width>".
+    :param images: ordered dict of image name -> SpoolHandle.
+    :param options: options of the request, plus the "crops" of the images (dict of image name -> box [left, upper,
+    right, lower] in pixels).
+    :return: tuple (ordered dict of image name -> SpoolHandle with the encoded images, seconds spent encoding)
+    """
+    from PIL import Image
+
+    start_time = time.time()
+    image_format = options.get('format', "png")
+    quality = options.get('quality', DEFAULT_QUALITY)
+    max_width = options.get('max_width')
+    max_height = options.get('max_height')
+    crops = options.get('crops', {})
+    encoded_images = OrderedDict()
+
+    try:
+        for name, spool_handle in images.items():
+            with Image.open(spool_handle.filename) as image:
+                image.load()
+
+            if name in crops:
+                # Clips out of the page keep at least its last pixel.
+                left, upper, right, lower = crops[name]
+                left, upper = min(left, image.width - 1), min(upper, image.height - 1)
+                image = image.crop((left, upper, max(min(right, image.width), left + 1),
+                                    max(min(lower, image.height), upper + 1)))
+
+            if max_width is not None or max_height is not None:
+                image.thumbnail((max_width or image.width, max_height or image.height), Image.LANCZOS)
+
+            encoded_images[name] = _encode_image(image, image_format, quality)
+
+            for width in options.get('thumbnails', []):
+                thumbnail = image.copy()
+                thumbnail.thumbnail((width, image.height), Image.LANCZOS)
+                encoded_images["{}_thumbnail_{}".format(name, width)] = _encode_image(thumbnail, image_format, quality)
+
+    finally:
+        for spool_handle in images.values():
+            os.remove(spool_handle.filename)
+
+    return encoded_images, time.time() - start_time
+
+
+class ImageEncoder(object):
+    """
+    Post-processes the images of the capture results (resizing, thumbnails and encoding) in its own pool of processes,
+    so that the browser workers never spend time on it.
+
+    It requires Pillow to be installed.
+    """
+
+    def __init__(self, encoders=DEFAULT_ENCODERS):
+        """
+        Initializes the pool of encoders.
+        :param encoders: amount of encoder processes.
+        """
+        self.pool = Pool(processes=encoders)
+
+    @staticmethod
+    def is_available():
+        """
+        Checks whether the images can be post-processed.
+        :return: True if Pillow is installed, False otherwise.
+        """
+        return find_spec("PIL") is not None
+
+    @staticmethod
+    def is_required(request):
+        """
+        Checks whether the images of the result of a request must be post-processed.
+        :param request: CaptureRequest
+        :return: True if the request has any encoding option or capture specs, whose images may have to be cropped.
+        """
+        return any(request.get_option(option) is not None for option in ENCODING_OPTIONS + ["captures"])
+
+    def encode(self, request, result, callback):
+        """
+        Post-processes the images of a result in background.
+        :param request: CaptureRequest whose options tell how to post-process the images.
+        :param result: CaptureResult with the spooled images, as returned by the pool workers.
+        :param callback: function invoked with (request, result) once the images are post-processed. If the
+        post-processing fails, result is None.
+        """
+        def encoding_finished(encoding_result):
+            encoded_images, encoding_time = encoding_result
+            result.images = encoded_images
+            result.set_metadata("format", request.get_option('format', "png"))
+            result.set_metadata("encoding_time", encoding_time)
+            callback(request, result)
+
+        def encoding_failed(ex):
+            print("Could not post-process the images of {}: {}".format(request, ex))
+            callback(request, None)
+
+        options = dict(request.get_options(), crops=result.get_metadata('crops', {}))
+        self.pool.apply_async(encode_images, args=(result.get_images(), options),
+                              callback=encoding_finished, error_callback=encoding_failed)
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
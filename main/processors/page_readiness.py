@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import time
+
+__author__ = 'Iván de Paz Centeno'
+
+DEFAULT_MAX_WAIT = 10
+DEFAULT_NETWORK_IDLE = 0.5
+DEFAULT_DOM_QUIET = 0.5
+DEFAULT_POLL_INTERVAL = 0.1
+
+# Installs (only once per page) a MutationObserver that timestamps the last DOM change, and reports the state of the
+# page: its readyState, the amount of resources fetched so far, the milliseconds since the last DOM mutation and the
+# amount of the requested selectors already present.
+# A page flagged with __screenshooterLeaving is a page being navigated away from; its state is not reported.
+READINESS_PROBE_SCRIPT = """
+var selectors = arguments[0];
+
+if (window.__screenshooterLeaving) {
+    return {leaving: true};
+}
+
+var state = window.__screenshooterReadiness;
+
+if (!state) {
+    state = {lastMutation: Date.now()};
+    if (window.MutationObserver && document.documentElement) {
+        new MutationObserver(function() { state.lastMutation = Date.now(); }).observe(document.documentElement,
+            {childList: true, subtree: true, attributes: true, characterData: true});
+    }
+    window.__screenshooterReadiness = state;
+}
+
+var resources = -1;
+if (window.performance && window.performance.getEntriesByType) {
+    resources = window.performance.getEntriesByType('resource').length;
+}
+
+var found = 0;
+for (var i = 0; i < selectors.length; i++) {
+    if (document.querySelector(selectors[i])) { found++; }
+}
+
+return {readyState: document.readyState, resources: resources, mutationAge: Date.now() - state.lastMutation,
+        selectorsFound: found};
+"""
+
+
+class PageReadinessWaiter(object):
+    """
+    Waits for a page loaded in a webdriver to be ready to be captured.
+
+    A page is considered ready when its document.readyState is "complete", no new resource has been fetched during the
+    network-idle window, the DOM has not mutated during the DOM-quiet window and every requested selector is present.
+    The wait is always capped by a maximum, after which the page is captured as it is.
+    """
+
+    def __init__(self, readiness_config=None):
+        """
+        Initializes the waiter.
+        :param readiness_config: dict with the keys "max_wait", "network_idle", "dom_quiet" and "poll_interval", in
+        seconds. Missing keys take the default values.
+        """
+        if readiness_config is None:
+            readiness_config = {}
+
+        self.max_wait = float(readiness_config.get('max_wait', DEFAULT_MAX_WAIT))
+        self.network_idle = float(readiness_config.get('network_idle', DEFAULT_NETWORK_IDLE))
+        self.dom_quiet = float(readiness_config.get('dom_quiet', DEFAULT_DOM_QUIET))
+        self.poll_interval = float(readiness_config.get('poll_interval', DEFAULT_POLL_INTERVAL))
+
+    def track(self, wait_for=None, max_wait=None):
+        """
+        Starts tracking the readiness of a page that has just been requested.
+        :param wait_for: list of CSS selectors that must be present in the page before capturing it.
+        :param max_wait: maximum seconds to wait for this page. It can't exceed the configured maximum.
+        :return: PageReadinessTracker to be polled.
+        """
+        if max_wait is None:
+            max_wait = self.max_wait
+        else:
+            max_wait = min(float(max_wait), self.max_wait)
+
+        return PageReadinessTracker(self, wait_for or [], max_wait)
+
+    def wait(self, driver, wait_for=None, max_wait=None):
+        """
+        Blocks until the page currently loaded in the driver is ready, or until the maximum wait is reached.
+        :param driver: selenium webdriver with the page already requested.
+        :param wait_for: list of CSS selectors that must be present in the page before capturing it.
+        :param max_wait: maximum seconds to wait for this page. It can't exceed the configured maximum.
+        :return: tuple (seconds waited, True if the page got ready or False if the maximum wait was reached)
+        """
+        tracker = self.track(wait_for, max_wait)
+
+        while not tracker.poll(driver):
+            time.sleep(min(self.poll_interval, tracker.get_remaining_time()))
+
+        return tracker.get_wait_time(), tracker.is_ready
+
+
+class PageReadinessTracker(object):
+    """
+    Readiness state of a single page. It is polled until the page is ready or until its maximum wait is reached, which
+    allows to track several pages at once (one per tab) from a single thread.
+    """
+
+    def __init__(self, readiness_waiter, wait_for, max_wait):
+        self.readiness_waiter = readiness_waiter
+        self.wait_for = wait_for
+        self.start_time = time.time()
+        self.deadline = self.start_time + max_wait
+        self.last_resources = None
+        self.last_resources_change = self.start_time
+        self.is_ready = False
+        self.finish_time = None
+
+    def poll(self, driver):
+        """
+        Probes the state of the page, which must be the one currently selected in the driver.
+        :param driver: selenium webdriver.
+        :return: True if the page is ready or its maximum wait was reached, False otherwise.
+        """
+        if self.finish_time is not None:
+            return True
+
+        now = time.time()
+        waiter = self.readiness_waiter
+
+        try:
+            state = driver.execute_script(READINESS_PROBE_SCRIPT, self.wait_for)
+        except Exception as ex:
+            # The page may be in the middle of a navigation; its state is not available yet.
+            state = None
+
+        if state is not None and not state.get('leaving', False):
+            resources = state.get('resources', -1)
+
+            if resources != self.last_resources:
+                self.last_resources = resources
+                self.last_resources_change = now
+
+            self.is_ready = state.get('readyState') == "complete" and \
+                (resources < 0 or now - self.last_resources_change >= waiter.network_idle) and \
+                state.get('mutationAge', 0) / 1000 >= waiter.dom_quiet and \
+                state.get('selectorsFound', 0) == len(self.wait_for)
+
+        if self.is_ready or now >= self.deadline:
+            self.finish_time = now
+
+        return self.finish_time is not None
+
+    def get_remaining_time(self):
+        return max(self.deadline - time.time(), 0)
+
+    def get_wait_time(self):
+        """
+        :return: seconds waited for the page, up to now if it is still being tracked.
+        """
+        return (self.finish_time or time.time()) - self.start_time
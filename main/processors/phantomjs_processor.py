@@ -1,63 +1,128 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import time
+
 from selenium import webdriver
-from main.processors.processor_interface import Processor
+from main.processors.browser_processor import BrowserProcessor
+from main.processors.capture_result import CaptureResult
+from main.services.metrics import STAGE_NAVIGATION, STAGE_READINESS_WAIT, STAGE_SCREENSHOT
 
 __author__ = 'Iván de Paz Centeno'
 
-MAX_PROCESS_COUNT = 5
-WAIT_TIME_AFTER_GET = 5
 RETRY_COUNT = 2
 BINARY_DATA_EMPTY = 0
 BINARY_DATA_FAIL = 3150
 
-class PhantomJSProcessor(Processor):
+# Runs in the PhantomJS context of the current page (this), where its requests can be aborted before being sent. The
+# rules are updated for every capture; the handler is installed only once per page.
+BLOCKING_SCRIPT = """
+var page = this;
+page.__blockingRules = arguments[0];
+page.__blockedRequests = 0;
+
+if (!page.__blockingInstalled) {
+    page.__blockingInstalled = true;
+    page.onResourceRequested = function(requestData, networkRequest) {
+        var rules = page.__blockingRules;
+
+        if (!rules || requestData.url === rules.pageUrl) {
+            return;
+        }
+
+        var match = /^[a-z]+:\\/\\/([^\\/:?#]+)/i.exec(requestData.url);
+        var host = match ? match[1].toLowerCase() : "";
+        var blocked = false;
+
+        for (var i = 0; i < rules.domains.length && !blocked; i++) {
+            var domain = rules.domains[i];
+            blocked = host === domain || host.slice(-domain.length - 1) === "." + domain;
+        }
+
+        if (!blocked && rules.pattern) {
+            blocked = new RegExp(rules.pattern).test(requestData.url.split(/[?#]/)[0].toLowerCase());
+        }
+
+        if (blocked) {
+            page.__blockedRequests++;
+            networkRequest.abort();
+        }
+    };
+}
+"""
+
+BLOCKED_COUNT_SCRIPT = "return this.__blockedRequests || 0;"
+
+
+class PhantomJSProcessor(BrowserProcessor):
 
-    def __init__(self):
+    blocks_per_request = True
+    window_size = (1024, 768)
+
+    def __init__(self, processor_config=None):
         """
         Constructor of the class.
         Initializes the webdriver for this processor.
+        :param processor_config: dict with the "processor" section of the configuration.
         """
-        Processor.__init__(self)
-        self.driver = webdriver.PhantomJS("main/phantomjs/phantomjs")  # the normal SE phantomjs binding
-        self.driver.set_window_size(1024, 768)
-        self.process_count = 0
+        BrowserProcessor.__init__(self, processor_config)
+
+    def _launch_driver(self):
+        driver = webdriver.PhantomJS("main/phantomjs/phantomjs")  # the normal SE phantomjs binding
+        driver.command_executor._commands['executePhantomScript'] = ('POST', '/session/$sessionId/phantom/execute')
+        driver.set_window_size(*self.window_size)
+        return driver
+
+    def _execute_phantom_script(self, script, *args):
+        return self.driver.execute('executePhantomScript', {'script': script, 'args': list(args)})['value']
+
+    def _install_blocking(self, request):
+        self._execute_phantom_script(BLOCKING_SCRIPT, self._get_blocking_profile(request).get_rules(str(request)))
+
+    def _get_blocked_count(self):
+        return self._execute_phantom_script(BLOCKED_COUNT_SCRIPT)
 
-    def process(self, url_wrapper):
+    def _capture(self, url_wrapper):
         """
         Retrieves a request (any url) and returns a screenshot in binary format.
-        :param url: URL to process.
-        :return: binary data in PNG format of the screenshot.
+        :param url_wrapper: CaptureRequest to process.
+        :return: CaptureResult with the screenshot in PNG format and the seconds waited for the page to be ready.
         """
         url = str(url_wrapper)
         retries = 0
         binary_data = b""
+        images = {}
+        crops = {}
+        blocked_count = None
+        wait_time = 0
+        timings = {STAGE_NAVIGATION: 0, STAGE_READINESS_WAIT: 0, STAGE_SCREENSHOT: 0}
+        spans = []
 
         while retries < RETRY_COUNT and (len(binary_data) == BINARY_DATA_EMPTY or len(binary_data) == BINARY_DATA_FAIL):
             print("Processing {}".format(url))
+            self._install_blocking(url_wrapper)
+            start_time = time.time()
             self.driver.get(url)  # whatever reachable url
-            time.sleep(WAIT_TIME_AFTER_GET)
-            binary_data = self.driver.get_screenshot_as_png()
+            timings[STAGE_NAVIGATION] += time.time() - start_time
+            spans.append([STAGE_NAVIGATION, start_time, time.time()])
+            start_time = time.time()
+            wait_time, is_ready = self.readiness_waiter.wait(self.driver, url_wrapper.get_option('wait_for'),
+                                                             url_wrapper.get_option('max_wait'))
+            timings[STAGE_READINESS_WAIT] += wait_time
+            spans.append([STAGE_READINESS_WAIT, start_time, time.time()])
+            start_time = time.time()
+            images, crops, screenshot_spans = self._take_screenshots(url_wrapper)
+            binary_data = next(iter(images.values()))
+            timings[STAGE_SCREENSHOT] += time.time() - start_time
+            spans += screenshot_spans
+            # Read before going back, which loads another page.
+            blocked_count = self._get_blocked_count()
             if len(binary_data) == 3150:
                 print("URL {} did not apparently report a valid screenshot. Retrying... ({}/{})".format(url, retries,
                                                                                                         RETRY_COUNT))
             self.driver.back()
-            print("Processed {}".format(url))
-            self.process_count += 1
-
-            if self.process_count % MAX_PROCESS_COUNT == 0:
-                self.restart()
-
+            print("Processed {} ({:.2f}s waiting for the page{})".format(url, wait_time,
+                                                                       "" if is_ready else ", timed out"))
             retries += 1
 
-        return binary_data
-
-    def restart(self):
-        print("Reseted one.")
-        self.driver.quit()
-        self.driver = webdriver.PhantomJS("main/phantomjs/phantomjs")  # the normal SE phantomjs binding
-        self.driver.set_window_size(1024, 768)
-
-    def __del__(self):
-        self.driver.quit()
+        return CaptureResult(images, {"readiness_wait": wait_time, "timings": timings, "spans": spans,
+                                      "crops": crops, "blocked_requests": blocked_count})
@@ -14,4 +14,20 @@ class Processor(object):
         :param request: request to work with.
         :return: result of processing.
         """
-        return None
\ No newline at end of file
+        return None
+
+    def process_many(self, requests, deliver):
+        """
+        Do something with several requests, delivering the result of each of them as soon as it is available.
+        By default the requests are processed one after another; override it to process them concurrently.
+        :param requests: list of requests to work with.
+        :param deliver: function to invoke with (request, result) for each request. A request that could not be
+        processed is delivered with None as result.
+        """
+        for request in requests:
+            try:
+                result = self.process(request)
+            except Exception as ex:
+                result = None
+
+            deliver(request, result)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+from collections import deque
+
+__author__ = 'Iván de Paz Centeno'
+
+DEFAULT_PAGE_BUDGET = 100
+DEFAULT_MAX_RSS_MB = 1024
+DEFAULT_LATENCY_DRIFT_FACTOR = 2.5
+DEFAULT_LATENCY_WINDOW = 10
+DEFAULT_MAX_CONSECUTIVE_FAILURES = 3
+DEFAULT_PRELAUNCH_RATIO = 0.8
+
+# Reasons to recycle a browser. They label the metrics, so they are a fixed set; the measurements go in their details.
+RECYCLE_CONSECUTIVE_FAILURES = "consecutive_failures"
+RECYCLE_PAGE_BUDGET = "page_budget"
+RECYCLE_RSS = "rss"
+RECYCLE_LATENCY_DRIFT = "latency_drift"
+RECYCLE_REQUESTED = "requested"
+RECYCLE_REASONS = [RECYCLE_CONSECUTIVE_FAILURES, RECYCLE_PAGE_BUDGET, RECYCLE_RSS, RECYCLE_LATENCY_DRIFT,
+                   RECYCLE_REQUESTED]
+
+
+def get_process_tree_rss(pid):
+    """
+    Measures the resident memory of a process and all its descendants, from /proc.
+    :param pid: PID of the root process.
+    :return: bytes of resident memory, or None if it can't be measured.
+    """
+    rss_bytes = 0
+    pending_pids = [pid]
+    measured = False
+
+    while len(pending_pids) > 0:
+        current_pid = pending_pids.pop()
+
+        try:
+            with open("/proc/{}/status".format(current_pid)) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss_bytes += int(line.split()[1]) * 1024
+                        measured = True
+                        break
+
+            task_folder = "/proc/{}/task".format(current_pid)
+
+            for task in os.listdir(task_folder):
+                with open(os.path.join(task_folder, task, "children")) as f:
+                    pending_pids += [int(child_pid) for child_pid in f.read().split()]
+
+        except (OSError, ValueError):
+            # The process is gone, or the kernel does not expose its children.
+            pass
+
+    return rss_bytes if measured else None
+
+
+class RecyclingPolicy(object):
+    """
+    Decides when a browser must be replaced by a fresh one, from measurements of its health: the pages it processed,
+    its resident memory, the drift of its capture latency and its consecutive failures.
+
+    It also tells when the browser is getting close to be recycled, so that its replacement can be launched in advance.
+    """
+
+    def __init__(self, recycling_config=None):
+        """
+        Initializes the policy.
+        :param recycling_config: dict with the keys "page_budget", "max_rss_mb", "latency_drift_factor",
+        "latency_window", "max_consecutive_failures" and "prelaunch_ratio". Missing keys take the default values.
+        """
+        if recycling_config is None:
+            recycling_config = {}
+
+        self.page_budget = int(recycling_config.get('page_budget', DEFAULT_PAGE_BUDGET))
+        self.max_rss = float(recycling_config.get('max_rss_mb', DEFAULT_MAX_RSS_MB)) * 1024 * 1024
+        self.latency_drift_factor = float(recycling_config.get('latency_drift_factor', DEFAULT_LATENCY_DRIFT_FACTOR))
+        self.latency_window = int(recycling_config.get('latency_window', DEFAULT_LATENCY_WINDOW))
+        self.max_consecutive_failures = int(recycling_config.get('max_consecutive_failures',
+                                                                 DEFAULT_MAX_CONSECUTIVE_FAILURES))
+        self.prelaunch_ratio = float(recycling_config.get('prelaunch_ratio', DEFAULT_PRELAUNCH_RATIO))
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the measurements. Invoked when the browser is replaced.
+        """
+        self.pages = 0
+        self.rss = 0
+        self.consecutive_failures = 0
+        self.baseline_latencies = []
+        self.recent_latencies = deque(maxlen=self.latency_window)
+
+    def record_capture(self, latency, success):
+        """
+        Records the outcome of a capture.
+        :param latency: seconds taken by the capture.
+        :param success: True if the capture succeeded, False otherwise.
+        """
+        self.pages += 1
+
+        if not success:
+            self.consecutive_failures += 1
+            return
+
+        self.consecutive_failures = 0
+
+        if len(self.baseline_latencies) < self.latency_window:
+            self.baseline_latencies.append(latency)
+        else:
+            self.recent_latencies.append(latency)
+
+    def record_rss(self, rss):
+        """
+        Records the resident memory of the browser.
+        :param rss: bytes of resident memory, or None if it could not be measured.
+        """
+        if rss is not None:
+            self.rss = rss
+
+    def _get_latency_drift(self):
+        """
+        :return: ratio between the recent average latency and the baseline one, or 0 if there is not enough data.
+        """
+        if len(self.recent_latencies) < self.latency_window:
+            return 0
+
+        baseline_latency = sum(self.baseline_latencies) / len(self.baseline_latencies)
+
+        if baseline_latency <= 0:
+            return 0
+
+        return sum(self.recent_latencies) / len(self.recent_latencies) / baseline_latency
+
+    def get_recycle_reason(self):
+        """
+        Checks whether the browser must be recycled.
+        :return: reason to recycle the browser (one of the RECYCLE_* codes), or None if it is healthy.
+        """
+        reason = None
+
+        if self.consecutive_failures >= self.max_consecutive_failures:
+            reason = RECYCLE_CONSECUTIVE_FAILURES
+        elif self.pages >= self.page_budget:
+            reason = RECYCLE_PAGE_BUDGET
+        elif self.rss >= self.max_rss:
+            reason = RECYCLE_RSS
+        elif self._get_latency_drift() >= self.latency_drift_factor:
+            reason = RECYCLE_LATENCY_DRIFT
+
+        return reason
+
+    def get_recycle_detail(self, reason):
+        """
+        :param reason: reason returned by get_recycle_reason().
+        :return: string with the measurement that made the browser be recycled by that reason.
+        """
+        if reason == RECYCLE_CONSECUTIVE_FAILURES:
+            return "{} consecutive failures".format(self.consecutive_failures)
+        if reason == RECYCLE_PAGE_BUDGET:
+            return "page budget of {} exhausted".format(self.page_budget)
+        if reason == RECYCLE_RSS:
+            return "RSS of {:.0f} MB".format(self.rss / 1024 / 1024)
+        if reason == RECYCLE_LATENCY_DRIFT:
+            return "capture latency drifted x{:.1f}".format(self._get_latency_drift())
+
+        return reason
+
+    def should_prelaunch(self):
+        """
+        Checks whether the browser is close to be recycled, so that its replacement should be launched in advance.
+        :return: True if any measurement reached the prelaunch ratio of its limit.
+        """
+        ratio = self.prelaunch_ratio
+
+        return self.consecutive_failures >= max(self.max_consecutive_failures - 1, 1) or \
+            self.pages >= self.page_budget * ratio or \
+            self.rss >= self.max_rss * ratio or \
+            self._get_latency_drift() >= self.latency_drift_factor * ratio
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+__author__ = 'Iván de Paz Centeno'
+
+# Extensions of the URLs of each type of resource that can be blocked.
+RESOURCE_TYPE_EXTENSIONS = {
+    "image": ["png", "jpg", "jpeg", "gif", "webp", "svg", "ico", "bmp", "avif"],
+    "media": ["mp4", "webm", "ogg", "ogv", "mp3", "m4a", "wav", "m3u8", "mpd", "flv", "mov"],
+    "font": ["woff", "woff2", "ttf", "otf", "eot"],
+    "stylesheet": ["css"],
+    "script": ["js", "mjs"]
+}
+
+# Profiles available without configuring them. The configuration may override them.
+BUILTIN_PROFILES = {
+    "trackers": {
+        "domains": ["doubleclick.net", "googlesyndication.com", "googleadservices.com", "google-analytics.com",
+                    "googletagmanager.com", "googletagservices.com", "adservice.google.com", "connect.facebook.net",
+                    "scorecardresearch.com", "adnxs.com", "criteo.com", "criteo.net", "taboola.com", "outbrain.com",
+                    "amazon-adsystem.com", "quantserve.com", "hotjar.com", "segment.io", "mixpanel.com",
+                    "newrelic.com", "nr-data.net", "chartbeat.com", "moatads.com", "rubiconproject.com",
+                    "pubmatic.com", "openx.net", "adsrvr.org", "bat.bing.com"]
+    },
+    "media": {
+        "types": ["media", "font"]
+    }
+}
+
+# Returned by the proxy auto-config of the browsers for the blocked hosts: nothing listens there, so they fail fast.
+BLOCKED_PROXY = "PROXY 127.0.0.1:9"
+
+
+class BlockingProfile(object):
+    """
+    Which subresources of the pages are not loaded: the ones of some types (told by the extension of their URLs) and
+    the ones served from some domains (and their subdomains). The document of the page itself is never blocked.
+    """
+
+    def __init__(self, resource_types=None, domains=None):
+        """
+        :param resource_types: list of types of resources to block (keys of RESOURCE_TYPE_EXTENSIONS).
+        :param domains: list of domains whose resources are blocked.
+        """
+        self.resource_types = sorted(set(resource_types or []))
+        self.domains = sorted(set(domain.lower() for domain in domains or []))
+
+    @classmethod
+    def from_dict(cls, profile_dict):
+        """
+        :param profile_dict: dict with the keys "types" and "domains".
+        """
+        resource_types = profile_dict.get('types', [])
+        unknown_types = [resource_type for resource_type in resource_types
+                         if resource_type not in RESOURCE_TYPE_EXTENSIONS]
+
+        if len(unknown_types) > 0:
+            raise Exception("Unknown resource types to block: {}.".format(", ".join(unknown_types)))
+
+        return cls(resource_types, profile_dict.get('domains', []))
+
+    def merge(self, other):
+        """
+        :return: profile that blocks what this profile and another one block.
+        """
+        return BlockingProfile(self.resource_types + other.resource_types, self.domains + other.domains)
+
+    def is_empty(self):
+        return len(self.resource_types) == 0 and len(self.domains) == 0
+
+    def get_url_pattern(self):
+        """
+        :return: regular expression, for Python and JavaScript, matching the paths of the URLs of the resources of the
+        blocked types, or None if no type is blocked.
+        """
+        extensions = sorted(extension for resource_type in self.resource_types
+                            for extension in RESOURCE_TYPE_EXTENSIONS[resource_type])
+
+        if len(extensions) == 0:
+            return None
+
+        return r"\.({})$".format("|".join(extensions))
+
+    def get_rules(self, page_url=None):
+        """
+        :return: dict serializable to JSON with the rules, for the scripts that enforce them inside the browsers.
+        """
+        return {"domains": self.domains, "pattern": self.get_url_pattern(), "pageUrl": page_url}
+
+    def get_proxy_autoconfig(self):
+        """
+        :return: proxy auto-config (PAC) script that blocks the domains of this profile.
+        """
+        conditions = " || ".join('host == "{0}" || dnsDomainIs(host, ".{0}")'.format(domain) for domain in self.domains)
+
+        return "function FindProxyForURL(url, host) {{ host = host.toLowerCase(); " \
+               "return ({}) ? \"{}\" : \"DIRECT\"; }}".format(conditions or "false", BLOCKED_PROXY)
+
+
+class BlockingProfiles(object):
+    """
+    Named blocking profiles, and the ones applied to the requests that do not choose theirs.
+    """
+
+    def __init__(self, profiles=None, default_names=None):
+        """
+        :param profiles: dict of name -> BlockingProfile.
+        :param default_names: names of the profiles applied by default.
+        """
+        self.profiles = profiles if profiles is not None else {}
+        self.default_names = default_names or []
+
+    @classmethod
+    def from_config(cls, blocking_config):
+        """
+        Builds the profiles from the "blocking" section of the configuration of the processors, on top of the builtin
+        ones.
+        :param blocking_config: dict with the keys "default" (list of names) and "profiles" (dict of name -> dict with
+        "types" and "domains").
+        """
+        profile_dicts = dict(BUILTIN_PROFILES)
+        profile_dicts.update(blocking_config.get('profiles', {}))
+        profiles = {name: BlockingProfile.from_dict(profile_dict) for name, profile_dict in profile_dicts.items()}
+        blocking_profiles = cls(profiles)
+        blocking_profiles.default_names = blocking_profiles.check_names(blocking_config.get('default', []))
+
+        return blocking_profiles
+
+    def check_names(self, names):
+        """
+        :param names: list of names of profiles.
+        :return: the names.
+        :raises Exception: if a name is not the one of a profile.
+        """
+        unknown_names = [name for name in names if name not in self.profiles]
+
+        if len(unknown_names) > 0:
+            raise Exception("Unknown blocking profiles: {}.".format(", ".join(unknown_names)))
+
+        return names
+
+    def get_names(self):
+        return sorted(self.profiles)
+
+    def resolve(self, names=None):
+        """
+        :param names: list of names of the profiles to apply, or None for the default ones.
+        :return: BlockingProfile merging them.
+        """
+        profile = BlockingProfile()
+
+        for name in self.default_names if names is None else names:
+            profile = profile.merge(self.profiles[name])
+
+        return profile
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import math
+import time
+from collections import deque
+from threading import Lock
+
+from main.parallelization.request_scheduler import INTERACTIVE
+
+__author__ = 'Iván de Paz Centeno'
+
+DEFAULT_RATE_WINDOW = 60
+DEFAULT_MAKE_MAX_DRAIN_TIME = 30
+DEFAULT_BATCH_MAX_DRAIN_TIME = 3600
+DEFAULT_INITIAL_CAPTURE_SECONDS = 5
+
+
+class CaptureRateMeter(object):
+    """
+    Measures the captures finished per second and their mean duration over a sliding window of time.
+    Captures are accounted in buckets of one second, so the memory of the meter is bounded by the window.
+    """
+
+    def __init__(self, window=DEFAULT_RATE_WINDOW):
+        """
+        :param window: seconds of the sliding window.
+        """
+        self.window = window
+        self.lock = Lock()
+
+        # [second, captures, captures with duration, sum of their durations], from the oldest to the newest second.
+        self.buckets = deque()
+        self.first_record_time = None
+
+    def _discard_old_buckets(self, now):
+        while len(self.buckets) > 0 and self.buckets[0][0] <= now - self.window:
+            self.buckets.popleft()
+
+    def record(self, duration=None):
+        """
+        Records a finished capture.
+        :param duration: seconds the capture was in flight, or None if unknown.
+        """
+        now = time.time()
+        second = int(now)
+
+        with self.lock:
+            if self.first_record_time is None:
+                self.first_record_time = now
+
+            if len(self.buckets) == 0 or self.buckets[-1][0] != second:
+                self.buckets.append([second, 0, 0, 0.0])
+                self._discard_old_buckets(now)
+
+            bucket = self.buckets[-1]
+            bucket[1] += 1
+
+            if duration is not None:
+                bucket[2] += 1
+                bucket[3] += duration
+
+    def get_rate(self):
+        """
+        :return: captures finished per second over the window, or None if none was recorded yet.
+        """
+        now = time.time()
+
+        with self.lock:
+            if self.first_record_time is None:
+                return None
+
+            self._discard_old_buckets(now)
+            captures = sum(bucket[1] for bucket in self.buckets)
+            elapsed = max(min(self.window, now - self.first_record_time), 1)
+
+        return captures / elapsed
+
+    def get_mean_duration(self):
+        """
+        :return: mean seconds in flight of the captures of the window, or None if there are none.
+        """
+        with self.lock:
+            self._discard_old_buckets(time.time())
+            count = sum(bucket[2] for bucket in self.buckets)
+            total_duration = sum(bucket[3] for bucket in self.buckets)
+
+        return total_duration / count if count > 0 else None
+
+
+class AdmissionControl(object):
+    """
+    Decides whether the server can accept more work, so that it turns away a few requests quickly instead of letting
+    every caller time out when traffic spikes.
+
+    The time to drain the work ahead of a new request is estimated from the queued captures and the capture rate of
+    the processor service. Requests are rejected when it exceeds a budget, with the seconds after which it is expected
+    to be within the budget again. Captures requested to /make only wait for the interactive captures, while a new
+    batch waits for everything already accepted, including the elements of the batches not queued yet.
+    """
+
+    def __init__(self, processor_service, batches_service=None, make_max_drain_time=DEFAULT_MAKE_MAX_DRAIN_TIME,
+                 batch_max_drain_time=DEFAULT_BATCH_MAX_DRAIN_TIME,
+                 initial_capture_seconds=DEFAULT_INITIAL_CAPTURE_SECONDS):
+        """
+        Initializes the admission control.
+        :param processor_service: ProcessorService whose load is controlled.
+        :param batches_service: BatchesService whose pending elements are accounted for new batches, if any.
+        :param make_max_drain_time: maximum seconds of work ahead of a capture requested to /make, or 0 for no limit.
+        :param batch_max_drain_time: maximum seconds of work ahead of a new batch, or 0 for no limit.
+        :param initial_capture_seconds: seconds a capture is assumed to take until the real ones are measured.
+        """
+        self.processor_service = processor_service
+        self.batches_service = batches_service
+        self.make_max_drain_time = make_max_drain_time
+        self.batch_max_drain_time = batch_max_drain_time
+        self.initial_capture_seconds = initial_capture_seconds
+        self.lock = Lock()
+        self.stats = {"make_rejected": 0, "batches_rejected": 0}
+
+    @classmethod
+    def from_config(cls, processor_service, batches_service, admission_config):
+        """
+        Builds the admission control from the "admission" section of the configuration.
+        :param admission_config: dict with the keys "make_max_drain_time", "batch_max_drain_time" and
+        "initial_capture_seconds".
+        """
+        return cls(processor_service, batches_service,
+                   float(admission_config.get('make_max_drain_time', DEFAULT_MAKE_MAX_DRAIN_TIME)),
+                   float(admission_config.get('batch_max_drain_time', DEFAULT_BATCH_MAX_DRAIN_TIME)),
+                   float(admission_config.get('initial_capture_seconds', DEFAULT_INITIAL_CAPTURE_SECONDS)))
+
+    def get_capture_rate(self):
+        """
+        :return: captures per second the processor service is expected to finish.
+        """
+        capture_rate = self.processor_service.get_capture_rate()
+
+        if capture_rate is None:
+            capture_rate = self.processor_service.get_capture_slots() / self.initial_capture_seconds
+
+        return capture_rate
+
+    def _get_retry_after(self, backlog, max_drain_time, counter):
+        """
+        :param backlog: captures ahead of the new work.
+        :param max_drain_time: maximum seconds to drain them.
+        :param counter: name of the counter of rejections.
+        :return: seconds after which the work is expected to be accepted, or None if it is accepted now.
+        """
+        if max_drain_time <= 0:
+            return None
+
+        drain_time = backlog / self.get_capture_rate()
+
+        if drain_time <= max_drain_time:
+            return None
+
+        with self.lock:
+            self.stats[counter] += 1
+
+        return max(int(math.ceil(drain_time - max_drain_time)), 1)
+
+    def get_make_retry_after(self):
+        """
+        Checks whether a capture requested to /make can be accepted.
+        :return: seconds after which it is expected to be accepted, or None if it is accepted now.
+        """
+        backlog = self.processor_service.get_queued_count(INTERACTIVE) + 1
+
+        return self._get_retry_after(backlog, self.make_max_drain_time, "make_rejected")
+
+    def get_batch_retry_after(self):
+        """
+        Checks whether a new batch can be accepted.
+        :return: seconds after which it is expected to be accepted, or None if it is accepted now.
+        """
+        backlog = self.processor_service.get_queued_count(INTERACTIVE)
+
+        if self.batches_service is not None:
+            backlog += self.batches_service.get_pending_count()
+
+        return self._get_retry_after(backlog, self.batch_max_drain_time, "batches_rejected")
+
+    def get_stats(self):
+        """
+        :return: dict with the estimated capture rate and the counters of rejections.
+        """
+        with self.lock:
+            stats = dict(self.stats)
+
+        stats["capture_rate"] = self.get_capture_rate()
+
+        return stats
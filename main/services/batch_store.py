@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from threading import Lock, local
+
+__author__ = 'Iván de Paz Centeno'
+
+DEFAULT_STORE_PATH = "/tmp/screenshooter_batches/batches.sqlite3"
+
+ELEMENT_PENDING = 0
+ELEMENT_PROCESSED = 1
+ELEMENT_CANCELED = 2
+
+# Total of elements of the batches whose URLs are still being uploaded.
+UNSEALED_TOTAL = -1
+
+# Amount of rows read at once when iterating over the elements of a batch.
+READ_PAGE_SIZE = 1000
+
+
+class BatchStore(object):
+    """
+    Interface of the stores of the batches: their options, progress counters and the state of each of their elements.
+
+    Batches are returned as dicts with the keys "batch_id", "options", "weight", "total", "processed", "canceled",
+    "zip_uri" and "created". Elements are identified by their position in the list of URLs of their batch.
+
+    Batches can also be stored while their URLs are being uploaded: opened, filled chunk by chunk and finally sealed.
+    Until they are sealed, their total is UNSEALED_TOTAL.
+    """
+
+    def create_batch(self, url_list, options, weight):
+        """
+        Stores a new batch, with all its elements pending.
+        :param url_list: list of URLs of the batch.
+        :param options: dict of capture options, common to every URL.
+        :param weight: share of the workers of the batch.
+        :return: ID of the batch.
+        """
+        raise NotImplementedError()
+
+    def open_batch(self, options, weight):
+        """
+        Stores a new batch without elements, to be filled with add_elements() and sealed with seal_batch().
+        :param options: dict of capture options, common to every URL.
+        :param weight: share of the workers of the batch.
+        :return: ID of the batch.
+        """
+        raise NotImplementedError()
+
+    def add_elements(self, batch_id, first_position, url_list):
+        """
+        Stores pending elements of an unsealed batch.
+        :param batch_id: ID of the batch.
+        :param first_position: position of the first URL of the list.
+        :param url_list: list of URLs.
+        """
+        raise NotImplementedError()
+
+    def seal_batch(self, batch_id, total):
+        """
+        Marks an unsealed batch as complete.
+        :param batch_id: ID of the batch.
+        :param total: amount of elements added to the batch.
+        """
+        raise NotImplementedError()
+
+    def get_batch(self, batch_id):
+        """
+        :return: dict of the batch, or None if it does not exist.
+        """
+        raise NotImplementedError()
+
+    def list_batches(self, after=None, limit=100):
+        """
+        Lists the batches ordered by their ID.
+        :param after: ID of the batch after which the listing starts, or None to start from the first one.
+        :param limit: maximum amount of batches to list.
+        :return: list of dicts of the batches.
+        """
+        raise NotImplementedError()
+
+    def get_unzipped_batches(self):
+        """
+        :return: list of dicts of the batches whose ZIP is not built yet.
+        """
+        raise NotImplementedError()
+
+    def get_pending_count(self):
+        """
+        :return: amount of elements pending to be processed among all the sealed batches.
+        """
+        raise NotImplementedError()
+
+    def get_stats(self):
+        """
+        :return: dict with the amount of "batches", how many of them are "zipped" and how many are "canceled".
+        """
+        raise NotImplementedError()
+
+    def get_pending_elements(self, batch_id, after_position, limit):
+        """
+        Retrieves pending elements of a batch, ordered by position.
+        :param batch_id: ID of the batch.
+        :param after_position: position after which the elements are retrieved.
+        :param limit: maximum amount of elements to retrieve.
+        :return: list of tuples (position, url).
+        """
+        raise NotImplementedError()
+
+    def finish_element(self, batch_id, position, uri, images_uris, reused=False):
+        """
+        Records the result of a pending element. Elements that are not pending anymore are left untouched.
+        Each image of a processed element counts as a reference to its blob.
+        :param batch_id: ID of the batch.
+        :param position: position of the element.
+        :param uri: blob ID of the main screenshot, or "Canceled".
+        :param images_uris: list of blob IDs of all the images captured for the element.
+        :param reused: whether a previous capture of the element was reused instead of capturing it again.
+        :return: tuple (processed elements, total elements) of the batch.
+        """
+        raise NotImplementedError()
+
+    def cancel_batch(self, batch_id, after_position):
+        """
+        Flags a batch as canceled and finishes as canceled its pending elements after a position.
+        :param batch_id: ID of the batch.
+        :param after_position: position after which the pending elements are canceled; the ones before are expected
+        to be finished by the processor.
+        :return: tuple (processed elements, total elements) of the batch.
+        """
+        raise NotImplementedError()
+
+    def get_processed_elements(self, batch_id, after_sequence, limit):
+        """
+        Retrieves the elements of a batch in the order they were processed.
+        :param batch_id: ID of the batch.
+        :param after_sequence: sequence number after which the elements are retrieved (0 to start from the first).
+        :param limit: maximum amount of elements to retrieve.
+        :return: list of tuples (sequence number, url, uri, images uris, reused).
+        """
+        raise NotImplementedError()
+
+    def iter_url_uri_pairs(self, batch_id):
+        """
+        Iterates over the processed elements of a batch, ordered by position.
+        :return: generator of tuples (url, uri).
+        """
+        raise NotImplementedError()
+
+    def set_zip_uri(self, batch_id, zip_uri):
+        raise NotImplementedError()
+
+    def remove_batch(self, batch_id):
+        """
+        Removes a batch with its elements, dropping their references to the blobs.
+        :return: list of IDs of the blobs that are not referenced anymore.
+        """
+        raise NotImplementedError()
+
+    def get_unreferenced_blob_ids(self, blob_ids):
+        """
+        :param blob_ids: list of IDs of blobs.
+        :return: list of the ones among them that no element references.
+        """
+        raise NotImplementedError()
+
+
+class SQLiteBatchStore(BatchStore):
+    """
+    Batch store backed by an embedded SQLite database.
+
+    The progress counters are kept in the row of each batch, so the state of a batch is read in constant time. The
+    elements are indexed by position, by processing order and, only while they are pending, by state; so feeding,
+    streaming and cancelling a batch never scan its whole list of elements.
+
+    Each thread uses its own connection, and the database is in WAL mode: readers do not block each other nor the
+    writer. Writers are serialized by a lock instead of by the busy handler of SQLite.
+    """
+
+    def __init__(self, path=DEFAULT_STORE_PATH):
+        """
+        Opens the database, creating it if it does not exist.
+        :param path: path of the database file.
+        """
+        self.path = path
+        self.write_lock = Lock()
+        self.connections = local()
+
+        folder = os.path.dirname(path)
+
+        if folder != "":
+            try:
+                os.makedirs(folder)
+            except OSError:
+                pass
+
+        connection = self._get_connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS batches (
+                batch_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                options TEXT NOT NULL,
+                weight REAL NOT NULL,
+                total INTEGER NOT NULL,
+                processed INTEGER NOT NULL DEFAULT 0,
+                next_sequence INTEGER NOT NULL DEFAULT 1,
+                canceled INTEGER NOT NULL DEFAULT 0,
+                zip_uri TEXT NOT NULL DEFAULT '',
+                created REAL NOT NULL
+            );
+
+            CREATE TABLE IF NOT EXISTS elements (
+                batch_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                url TEXT NOT NULL,
+                state INTEGER NOT NULL DEFAULT 0,
+                uri TEXT,
+                images TEXT,
+                sequence INTEGER,
+                reused INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (batch_id, position)
+            ) WITHOUT ROWID;
+
+            CREATE TABLE IF NOT EXISTS blobs (
+                blob_id TEXT PRIMARY KEY,
+                refs INTEGER NOT NULL
+            ) WITHOUT ROWID;
+
+            CREATE INDEX IF NOT EXISTS pending_elements ON elements (batch_id, position) WHERE state = 0;
+            CREATE INDEX IF NOT EXISTS processed_elements ON elements (batch_id, sequence) WHERE sequence IS NOT NULL;
+        """)
+
+        # Databases created before the reused captures were flagged.
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(elements)")]
+
+        if "reused" not in columns:
+            connection.execute("ALTER TABLE elements ADD COLUMN reused INTEGER NOT NULL DEFAULT 0")
+
+    def _get_connection(self):
+        connection = getattr(self.connections, 'connection', None)
+
+        if connection is None:
+            # Transactions are managed explicitly.
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.connections.connection = connection
+
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._get_connection()
+
+        with self.write_lock:
+            connection.execute("BEGIN IMMEDIATE")
+
+            try:
+                yield connection
+            except:
+                connection.execute("ROLLBACK")
+                raise
+
+            connection.execute("COMMIT")
+
+    @staticmethod
+    def _batch_from_row(row):
+        return {"batch_id": row[0], "options": json.loads(row[1]), "weight": row[2], "total": row[3],
+                "processed": row[4], "canceled": row[5] != 0, "zip_uri": row[6], "created": row[7]}
+
+    def _select_batches(self, condition, parameters=()):
+        rows = self._get_connection().execute(
+            "SELECT batch_id, options, weight, total, processed, canceled, zip_uri, created FROM batches " + condition,
+            parameters).fetchall()
+
+        return [self._batch_from_row(row) for row in rows]
+
+    def create_batch(self, url_list, options, weight):
+        with self._transaction() as connection:
+            cursor = connection.execute("INSERT INTO batches (options, weight, total, created) VALUES (?, ?, ?, ?)",
+                                        (json.dumps(options or {}), weight, len(url_list), time.time()))
+            batch_id = cursor.lastrowid
+            connection.executemany("INSERT INTO elements (batch_id, position, url) VALUES (?, ?, ?)",
+                                   ((batch_id, position, str(url)) for position, url in enumerate(url_list)))
+
+        return batch_id
+
+    def open_batch(self, options, weight):
+        with self._transaction() as connection:
+            cursor = connection.execute("INSERT INTO batches (options, weight, total, created) VALUES (?, ?, ?, ?)",
+                                        (json.dumps(options or {}), weight, UNSEALED_TOTAL, time.time()))
+
+        return cursor.lastrowid
+
+    def add_elements(self, batch_id, first_position, url_list):
+        with self._transaction() as connection:
+            connection.executemany("INSERT INTO elements (batch_id, position, url) VALUES (?, ?, ?)",
+                                   ((batch_id, position, str(url))
+                                    for position, url in enumerate(url_list, first_position)))
+
+    def seal_batch(self, batch_id, total):
+        with self._transaction() as connection:
+            connection.execute("UPDATE batches SET total = ? WHERE batch_id = ?", (total, batch_id))
+
+    def get_batch(self, batch_id):
+        batches = self._select_batches("WHERE batch_id = ?", (batch_id,))
+
+        return batches[0] if len(batches) > 0 else None
+
+    def list_batches(self, after=None, limit=100):
+        return self._select_batches("WHERE batch_id > ? AND total != ? ORDER BY batch_id LIMIT ?",
+                                    (-1 if after is None else after, UNSEALED_TOTAL, limit))
+
+    def get_unzipped_batches(self):
+        return self._select_batches("WHERE zip_uri = '' ORDER BY batch_id")
+
+    def get_pending_count(self):
+        row = self._get_connection().execute(
+            "SELECT SUM(total - processed) FROM batches WHERE total != ? AND processed < total",
+            (UNSEALED_TOTAL,)).fetchone()
+
+        return row[0] or 0
+
+    def get_stats(self):
+        row = self._get_connection().execute(
+            "SELECT COUNT(*), SUM(zip_uri != ''), SUM(canceled) FROM batches WHERE total != ?",
+            (UNSEALED_TOTAL,)).fetchone()
+
+        return {"batches": row[0], "zipped": row[1] or 0, "canceled": row[2] or 0}
+
+    def get_pending_elements(self, batch_id, after_position, limit):
+        return self._get_connection().execute(
+            "SELECT position, url FROM elements WHERE batch_id = ? AND state = ? AND position > ? "
+            "ORDER BY position LIMIT ?", (batch_id, ELEMENT_PENDING, after_position, limit)).fetchall()
+
+    def _get_counters(self, connection, batch_id):
+        row = connection.execute("SELECT processed, total FROM batches WHERE batch_id = ?", (batch_id,)).fetchone()
+
+        return (0, 0) if row is None else row
+
+    def finish_element(self, batch_id, position, uri, images_uris, reused=False):
+        state = ELEMENT_CANCELED if uri == "Canceled" else ELEMENT_PROCESSED
+
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE elements SET state = ?, uri = ?, images = ?, reused = ?, "
+                "sequence = (SELECT next_sequence FROM batches WHERE batch_id = ?) "
+                "WHERE batch_id = ? AND position = ? AND state = ?",
+                (state, uri, json.dumps(images_uris), int(reused), batch_id, batch_id, position, ELEMENT_PENDING))
+
+            if cursor.rowcount > 0:
+                connection.execute("UPDATE batches SET processed = processed + 1, next_sequence = next_sequence + 1 "
+                                   "WHERE batch_id = ?", (batch_id,))
+
+                if state == ELEMENT_PROCESSED:
+                    self._add_references(connection, images_uris, 1)
+
+            counters = self._get_counters(connection, batch_id)
+
+        return counters
+
+    def cancel_batch(self, batch_id, after_position):
+        with self._transaction() as connection:
+            # Sequence numbers stay unique: positions are below the total of elements of the batch.
+            cursor = connection.execute(
+                "UPDATE elements SET state = ?, uri = 'Canceled', images = '[]', "
+                "sequence = (SELECT next_sequence FROM batches WHERE batch_id = ?) + position "
+                "WHERE batch_id = ? AND state = ? AND position > ?",
+                (ELEMENT_CANCELED, batch_id, batch_id, ELEMENT_PENDING, after_position))
+
+            connection.execute("UPDATE batches SET canceled = 1, processed = processed + ?, "
+                               "next_sequence = next_sequence + total WHERE batch_id = ?", (cursor.rowcount, batch_id))
+
+            counters = self._get_counters(connection, batch_id)
+
+        return counters
+
+    def get_processed_elements(self, batch_id, after_sequence, limit):
+        rows = self._get_connection().execute(
+            "SELECT sequence, url, uri, images, reused FROM elements WHERE batch_id = ? AND sequence > ? "
+            "ORDER BY sequence LIMIT ?", (batch_id, after_sequence, limit)).fetchall()
+
+        return [(sequence, url, uri, json.loads(images), bool(reused)) for sequence, url, uri, images, reused in rows]
+
+    def iter_url_uri_pairs(self, batch_id):
+        position = -1
+
+        while True:
+            rows = self._get_connection().execute(
+                "SELECT position, url, uri FROM elements WHERE batch_id = ? AND position > ? AND state != ? "
+                "ORDER BY position LIMIT ?", (batch_id, position, ELEMENT_PENDING, READ_PAGE_SIZE)).fetchall()
+
+            for position, url, uri in rows:
+                yield url, uri
+
+            if len(rows) < READ_PAGE_SIZE:
+                return
+
+    def set_zip_uri(self, batch_id, zip_uri):
+        with self._transaction() as connection:
+            connection.execute("UPDATE batches SET zip_uri = ? WHERE batch_id = ?", (zip_uri, batch_id))
+
+    @staticmethod
+    def _add_references(connection, blob_ids, amount):
+        for blob_id in blob_ids:
+            connection.execute("INSERT OR IGNORE INTO blobs (blob_id, refs) VALUES (?, 0)", (blob_id,))
+            connection.execute("UPDATE blobs SET refs = refs + ? WHERE blob_id = ?", (amount, blob_id))
+
+    def remove_batch(self, batch_id):
+        with self._transaction() as connection:
+            rows = connection.execute("SELECT images FROM elements WHERE batch_id = ? AND state = ?",
+                                      (batch_id, ELEMENT_PROCESSED))
+            blob_ids = [blob_id for images, in rows for blob_id in json.loads(images)]
+
+            self._add_references(connection, blob_ids, -1)
+            unreferenced_blob_ids = [blob_id for blob_id, in connection.execute(
+                "SELECT blob_id FROM blobs WHERE refs <= 0")]
+
+            connection.execute("DELETE FROM blobs WHERE refs <= 0")
+            connection.execute("DELETE FROM elements WHERE batch_id = ?", (batch_id,))
+            connection.execute("DELETE FROM batches WHERE batch_id = ?", (batch_id,))
+
+        return unreferenced_blob_ids
+
+    def get_unreferenced_blob_ids(self, blob_ids):
+        connection = self._get_connection()
+
+        return [blob_id for blob_id in set(blob_ids) if connection.execute(
+            "SELECT 1 FROM blobs WHERE blob_id = ? AND refs > 0", (blob_id,)).fetchone() is None]
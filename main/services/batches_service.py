@@ -1,232 +1,726 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import json
-from time import sleep
-import uuid
-from shutil import make_archive, move, rmtree
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Condition, Lock
+from shutil import rmtree
 import os
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+from main.parallelization.request_scheduler import BATCH
 from main.parallelization.service_interface import ServiceInterface, SERVICE_STOPPED
+from main.processors.capture_request import CaptureRequest
+from main.processors.image_encoder import FORMAT_EXTENSIONS
+from main.services.batch_store import SQLiteBatchStore, DEFAULT_STORE_PATH, UNSEALED_TOTAL
+from main.services.blob_store import BlobStore
+from main.services.metrics import StageTimings, STAGE_FILE_WRITE, STAGE_ARCHIVE_BUILD
+from main.services.tracing import SPAN_BATCH_CALLBACK
+from main.services.zip_stream import ZipStream
 
 __author__ = 'Iván de Paz Centeno'
 
-ZIP_FOLDER = "/tmp/screenshooter_batches_zip/"
+DEFAULT_BATCHES_FOLDER = "/tmp/screenshooter_batches/"
+DEFAULT_FINALIZATION_WORKERS = 4
+DEFAULT_WINDOW = 10000
 
+# Amount of processed elements read at once from the store when iterating over a batch.
+ITER_PAGE_SIZE = 1000
 
-class RequestWrapper():
+# Amount of URLs of an uploaded batch stored at once.
+UPLOAD_CHUNK_SIZE = 10000
 
-    def __init__(self, request, batch_id):
-        super().__init__()
-        self.request = request
-        self.batch_id = batch_id
+# Seconds that a watcher of the progress of a batch waits for changes before getting an update without them.
+DEFAULT_PROGRESS_WAIT = 15
 
-    def __eq__(self, other):
-        try:
-            equals = other and (self.request == other or self.request == other.request)
 
-        except:
-            equals = False
+class _BatchHandle(object):
+    """
+    In-memory state of a batch being processed: just what is needed to feed its elements to the processor service.
+    The rest of the batch lives in the store.
+    """
 
-        return equals
+    def __init__(self, batch_id, options, weight, canceled=False):
+        self.batch_id = batch_id
+        self.options = options
+        self.weight = weight
+        self.canceled = canceled
+        self.finalizing = False
 
-    def __ne__(self, other):
-        return not self.__eq__(other)
+        # Position of the last element queued, and amount of queued elements not processed yet.
+        self.last_position = -1
+        self.in_flight = 0
 
-    def __hash__(self):
-        return hash(self.request)
+        # Increased every time the progress of the batch changes.
+        self.version = 0
 
-    def __str__(self):
-        return self.request
+
+class RequestWrapper(CaptureRequest):
+    """
+    Request of an element of a batch. Each batch is a flow of the batch priority class.
+    """
+
+    def __init__(self, request, batch_id, options=None, weight=1, position=None, batch_handle=None):
+        super().__init__(request, options)
+        self.batch_id = batch_id
+        self.weight = weight
+        self.position = position
+        self.batch_handle = batch_handle
 
     def get_batch_id(self):
         return self.batch_id
 
+    def get_position(self):
+        return self.position
+
+    def get_priority_class(self):
+        return BATCH
+
+    def get_flow_id(self):
+        return "batch-{}".format(self.batch_id)
+
+    def get_weight(self):
+        return self.weight
+
+    def is_canceled(self):
+        """
+        Requests of a canceled batch are aborted if they were not dispatched yet.
+        """
+        return self.batch_handle is not None and self.batch_handle.canceled
+
+    def __getstate__(self):
+        # The handle is only meaningful in the process of the service.
+        state = dict(self.__dict__)
+        state['batch_handle'] = None
+        return state
 
-class BatchesService(ServiceInterface):
 
-    def __init__(self, processor_service):
+class BatchesService(ServiceInterface):
+    """
+    Captures batches of URLs.
+
+    Batches are kept in a batch store (see main/services/batch_store.py), so they survive restarts: the pending
+    elements of the batches that were being processed are queued again when the service starts. Only a window of the
+    pending elements of each batch is queued at a time in the processor service; the window is refilled from the store
+    as its elements are processed.
+    """
+
+    def __init__(self, processor_service, finalization_workers=DEFAULT_FINALIZATION_WORKERS, batch_store=None,
+                 batches_folder=DEFAULT_BATCHES_FOLDER, window=DEFAULT_WINDOW, blob_store=None):
+        """
+        Initializes the service.
+        :param processor_service: ProcessorService that captures the elements of the batches.
+        :param finalization_workers: amount of batches that can be zipped at the same time.
+        :param batch_store: BatchStore of the batches. By default, a SQLite store inside the batches folder.
+        :param batches_folder: folder where the ZIPs of the batches are stored.
+        :param window: maximum amount of elements of each batch queued at the same time in the processor service.
+        :param blob_store: BlobStore of the screenshots. By default, a "blobs" folder inside the batches folder.
+        """
         ServiceInterface.__init__(self)
-        self.batches = {}
-        self.batches_num = 0
         self.processor_service = processor_service
+        self.batches_folder = batches_folder
+        self.store = batch_store if batch_store is not None else \
+            SQLiteBatchStore(os.path.join(batches_folder, os.path.basename(DEFAULT_STORE_PATH)))
+        self.blob_store = blob_store if blob_store is not None else BlobStore(os.path.join(batches_folder, "blobs"))
+        self.window = window
+        self.batch_handles = {}
+        self.stage_timings = StageTimings()
+        self.stop_event = Event()
+
+        # Notified every time an element of any batch is processed, or a batch is removed.
+        self.progress_condition = Condition(self.lock)
+
+        # Notified every time a batch has room in its window for more elements.
+        self.feed_condition = Condition(self.lock)
+        self.batches_to_feed = set()
+
+        # Batches are finalized (content.json written and zipped) as soon as their last element is processed.
+        # Several batches can be finalized at the same time, up to the amount of finalization workers.
+        self.finalization_pool = ThreadPoolExecutor(max_workers=finalization_workers)
+
+        # Blobs are referenced in the store right after being found or written, and removed right after being
+        # unreferenced, so that no blob is removed between both steps.
+        self.blobs_lock = Lock()
+        self.blobs_written = 0
+        self.blobs_deduplicated = 0
+
         try:
-            os.mkdir(ZIP_FOLDER)
-        except:
+            os.makedirs(batches_folder)
+        except OSError:
             pass
 
-    def new_batch(self, url_list):
+    @classmethod
+    def from_config(cls, processor_service, batches_config):
+        """
+        Builds the service from the "batches" section of the configuration.
+        :param processor_service: ProcessorService that captures the elements of the batches.
+        :param batches_config: dict with the keys "finalization_workers", "folder", "store", "blobs" and "window".
+        """
+        batches_folder = batches_config.get('folder', DEFAULT_BATCHES_FOLDER)
+        store_path = batches_config.get('store') or os.path.join(batches_folder,
+                                                                  os.path.basename(DEFAULT_STORE_PATH))
+        blobs_folder = batches_config.get('blobs') or os.path.join(batches_folder, "blobs")
+
+        return cls(processor_service, int(batches_config.get('finalization_workers', DEFAULT_FINALIZATION_WORKERS)),
+                   SQLiteBatchStore(store_path), batches_folder, int(batches_config.get('window', DEFAULT_WINDOW)),
+                   BlobStore(blobs_folder))
+
+    def _get_legacy_batch_folder(self, batch_id):
+        # Folder of the screenshots of the batches stored before the blobs.
+        return os.path.join(self.batches_folder, "batch_{}".format(batch_id))
+
+    def _get_batch_zip_path(self, batch_id):
+        return os.path.join(self.batches_folder, "batch_{}.zip".format(batch_id))
 
-        callback = self._batch_element_processed
+    @staticmethod
+    def _parse_batch_id(batch_id):
+        if not str(batch_id).isdigit():
+            raise Exception ("specified batch_id is not a valid ID.")
 
-        promises = {}
+        return int(batch_id)
 
-        with self.lock:
-            batch_id = self.batches_num
-            self.batches_num += 1
-            uri = "/tmp/batch_folder_{}/".format(batch_id)
-            self.batches[batch_id] = {"uri": uri, "url_processed": [], "url_pending": url_list, "zip_uri": "", "promises": promises, "url_uri_map": {}}
+    def _get_batch(self, batch_id):
+        batch = self.store.get_batch(self._parse_batch_id(batch_id))
+
+        if batch is None:
+            raise Exception("Batch {} does not exist.".format(batch_id))
+
+        return batch
+
+    def new_batch(self, url_list, options=None, weight=1):
+        """
+        Queues the capture of a batch of URLs.
+        :param url_list: list of URLs to capture.
+        :param options: dict of capture options, common to every URL.
+        :param weight: share of the workers of this batch relative to the rest of batches.
+        :return: ID of the batch.
+        """
+        batch_id = self.store.create_batch(url_list, options, weight)
+        self._start_batch(batch_id, options, weight)
+
+        return batch_id
+
+    def new_uploaded_batch(self, url_iterable, options=None, weight=1):
+        """
+        Queues the capture of a batch whose URLs are read as they arrive, for example from the lines of a streamed
+        request body. The URLs are stored chunk by chunk, so the size of the batch is bounded by the disk instead of the
+        memory. Its capture starts once all of them are stored.
+        :param url_iterable: iterable of URLs to capture. Exceptions raised by it abort the batch.
+        :param options: dict of capture options, common to every URL.
+        :param weight: share of the workers of this batch relative to the rest of batches.
+        :return: ID of the batch.
+        """
+        batch_id = self.store.open_batch(options, weight)
+        total = 0
 
         try:
-            os.mkdir(uri)
+            chunk = []
+
+            for url in url_iterable:
+                chunk.append(url)
+
+                if len(chunk) == UPLOAD_CHUNK_SIZE:
+                    self.store.add_elements(batch_id, total, chunk)
+                    total += len(chunk)
+                    chunk = []
+
+            self.store.add_elements(batch_id, total, chunk)
+            total += len(chunk)
+
+            if total == 0:
+                raise Exception("Required at least 1 URL in the batch.")
+
         except:
-            pass
+            self.store.remove_batch(batch_id)
+            raise
 
-        for url in url_list:
-            with self.lock:
-                promises[url] = self.processor_service.queue_request(RequestWrapper(url, batch_id), callback)
+        self.store.seal_batch(batch_id, total)
+        self._start_batch(batch_id, options, weight)
 
         return batch_id
 
+    def _start_batch(self, batch_id, options, weight):
+        """
+        Starts feeding the elements of a stored batch to the processor service.
+        """
+        with self.lock:
+            self.batch_handles[batch_id] = _BatchHandle(batch_id, options, weight)
+            self.batches_to_feed.add(batch_id)
+            self.feed_condition.notify_all()
+
+    def _feed_batch(self, batch_id):
+        """
+        Queues pending elements of a batch in the processor service, up to its window.
+        :param batch_id: ID of the batch.
+        """
+        with self.lock:
+            batch_handle = self.batch_handles.get(batch_id)
+
+            if batch_handle is None or batch_handle.canceled:
+                return
+
+            count = self.window - batch_handle.in_flight
+            last_position = batch_handle.last_position
+
+        if count <= 0:
+            return
+
+        elements = self.store.get_pending_elements(batch_id, last_position, count)
+
+        with self.lock:
+            # Elements after the last queued position are canceled by the store when the batch is canceled.
+            if batch_handle.canceled or len(elements) == 0:
+                return
+
+            batch_handle.in_flight += len(elements)
+            batch_handle.last_position = elements[-1][0]
+
+        for position, url in elements:
+            request = RequestWrapper(url, batch_id, batch_handle.options, batch_handle.weight, position, batch_handle)
+            self.processor_service.queue_request(request, self._batch_element_processed)
+
     def _batch_element_processed(self, batch_element_promise):
+        callback_start_time = time.time()
         result = batch_element_promise.get_result()
         request = batch_element_promise.get_request()
 
         batch_id = request.get_batch_id()
 
         with self.lock:
-            father_uri = self.batches[batch_id]["uri"]
-            if batch_id not in self.batches:
+            if batch_id not in self.batch_handles:
                 return
 
         if result is None:
             # It was aborted.
-            uri = "Canceled"
+            processed, total = self.store.finish_element(batch_id, request.get_position(), "Canceled", [])
         else:
-            uri = os.path.join(father_uri, "{}.png".format(str(request).replace("://", "----").replace("/", "--")))
-            self._save_screenshot(result, uri)
+            extension = FORMAT_EXTENSIONS[result.get_metadata('format', "png")]
+            start_time = time.time()
+            written = 0
+
+            # The main image comes first. Blobs are hashed and written without the lock, which only guards their
+            # references.
+            images = [image.getbuffer() for image in result.get_images().values()]
+            images_uris = []
+
+            for image in images:
+                blob_id, is_written = self.blob_store.put(image, extension)
+                images_uris.append(blob_id)
+                written += int(is_written)
+
+            end_time = time.time()
+            uri = images_uris[0] if len(images_uris) > 0 else None
+
+            # Served from the cache or revalidated by the change detector instead of captured again.
+            reused = result.get_metadata('cache') is not None
+
+            with self.blobs_lock:
+                processed, total = self.store.finish_element(batch_id, request.get_position(), uri, images_uris,
+                                                             reused)
+                unreferenced_blob_ids = self.store.get_unreferenced_blob_ids(images_uris)
+
+                for blob_id, image in zip(images_uris, images):
+                    if blob_id not in unreferenced_blob_ids:
+                        # A batch removed since the blob was found stored may have deleted it.
+                        self.blob_store.put(image, extension)
+
+                # The element was canceled or its batch removed meanwhile: its blobs are deleted unless other elements
+                # reference them.
+                self.blob_store.remove(unreferenced_blob_ids)
+                self.blobs_written += written
+                self.blobs_deduplicated += len(images_uris) - written
+
+            self.stage_timings.observe(STAGE_FILE_WRITE, end_time - start_time)
+            self.processor_service.tracer.add_span(request.get_trace_id(), STAGE_FILE_WRITE, start_time, end_time,
+                                                   attributes={"blobs_written": written})
+
+        self.processor_service.tracer.add_span(request.get_trace_id(), SPAN_BATCH_CALLBACK, callback_start_time,
+                                               time.time(), attributes={"batch_id": batch_id,
+                                                                        "position": request.get_position()})
 
         with self.lock:
-            try:
-                del self.batches[batch_id]["promises"][request]
-            except:
-                print("Discarded 1 element not appearing in the promises of batch {} ({})".format(batch_id, request))
-                pass
-            self.batches[batch_id]["url_processed"].append(request)
-            self.batches[batch_id]["url_uri_map"][str(request)] = uri
+            batch_handle = self.batch_handles.get(batch_id)
+
+            if batch_handle is None:
+                return
+
+            batch_handle.in_flight -= 1
+            batch_handle.version += 1
+            self.batches_to_feed.add(batch_id)
+            self.feed_condition.notify_all()
+            self.progress_condition.notify_all()
+            finalize = self._should_finalize(batch_handle, processed, total)
+
+        if finalize:
+            self.finalization_pool.submit(self._finalize_batch, batch_id)
 
     @staticmethod
-    def _save_screenshot(binary_data, filename):
-        if not filename.endswith(".png"):
-            filename += ".png"
+    def _should_finalize(batch_handle, processed, total):
+        """
+        Checks whether a batch is completed and not being finalized yet, flagging it as being finalized.
+        Must be called with the lock acquired.
+        """
+        finalize = processed >= total and not batch_handle.finalizing
+
+        if finalize:
+            batch_handle.finalizing = True
+
+        return finalize
+
+    def _iter_content_json(self, batch_id):
+        """
+        Builds the content.json of a batch: the map of each URL to the name of its main screenshot in the ZIP (the
+        hash of its content), or "Canceled".
+        :return: generator of the pieces of the JSON.
+        """
+        separator = "{\n"
+
+        for url, uri in self.store.iter_url_uri_pairs(batch_id):
+            name = uri if uri is None else os.path.basename(uri)
+            yield "{}    {}: {}".format(separator, json.dumps(url), json.dumps(name))
+            separator = ",\n"
+
+        yield "{\n}" if separator == "{\n" else "\n}"
+
+    def _finalize_batch(self, batch_id):
+        """
+        Zips the screenshots of a completed batch, each distinct one once, together with its content.json.
+        :param batch_id: ID of the batch to finalize.
+        """
+        start_time = time.time()
 
-        with open(filename, "wb") as file:
-            file.write(binary_data)
+        try:
+            zip_uri = self._zip_batch(batch_id, self._get_batch_zip_path(batch_id))
+            self.stage_timings.observe(STAGE_ARCHIVE_BUILD, time.time() - start_time)
 
-    def remove_batch(self, batch_id):
-        if not str(batch_id).isdigit():
-            raise Exception ("specified batch_id is not a valid ID.")
+        except Exception as ex:
+            # The batch may have been removed in the meantime.
+            print("Could not finalize batch {}: {}".format(batch_id, ex))
+            return
 
-        batch_id = int(batch_id)
+        self.store.set_zip_uri(batch_id, zip_uri)
 
         with self.lock:
-            for request, promise in self.batches[batch_id]["promises"].items(): promise.abort()
-            rmtree("/tmp/batch_folder_{}".format(batch_id))
-            del self.batches[batch_id]
+            # Dropping the handle tells the watchers of the batch that its ZIP is ready.
+            is_removed = self.batch_handles.pop(batch_id, None) is None
+            self.progress_condition.notify_all()
 
-    def get_batch_zip_bytes(self, batch_id):
-        if not str(batch_id).isdigit():
-            raise Exception ("specified batch_id is not a valid ID.")
+        if is_removed:
+            os.remove(zip_uri)
+
+    def remove_batch(self, batch_id):
+        batch = self._get_batch(batch_id)
+        batch_id = batch["batch_id"]
 
         with self.lock:
-            zip_uri = self.batches[batch_id]['zip_uri']
+            batch_handle = self.batch_handles.pop(batch_id, None)
 
-        with open(zip_uri) as f:
-            zip_content = f.read()
+            if batch_handle is not None:
+                # Its queued elements are aborted.
+                batch_handle.canceled = True
 
-        return zip_content
+            self.progress_condition.notify_all()
 
-    def get_batch_zip_uri(self, batch_id):
-        if not str(batch_id).isdigit():
-            raise Exception ("specified batch_id is not a valid ID.")
+        with self.blobs_lock:
+            self.blob_store.remove(self.store.remove_batch(batch_id))
 
-        batch_id = int(batch_id)
+        rmtree(self._get_legacy_batch_folder(batch_id), ignore_errors=True)
 
-        with self.lock:
-            zip_uri = self.batches[batch_id]['zip_uri']
+        if batch["zip_uri"] != "":
+            os.remove(batch["zip_uri"])
 
-        return zip_uri
+    def get_batch_zip_bytes(self, batch_id):
+        zip_uri = self.get_batch_zip_uri(batch_id)
 
-    def get_processed_percentage(self, batch_id):
-        if not str(batch_id).isdigit():
-            raise Exception ("specified batch_id is not a valid ID.")
+        with open(zip_uri, "rb") as f:
+            zip_content = f.read()
 
-        batch_id = int(batch_id)
+        return zip_content
 
-        with self.lock:
-            batch = self.batches[batch_id]
+    def get_batch_zip_uri(self, batch_id):
+        return self._get_batch(batch_id)["zip_uri"]
 
-        processed_percentage = round(len(batch["url_processed"]) / len(batch["url_pending"]) * 100)
+    def get_processed_percentage(self, batch_id):
+        batch = self._get_batch(batch_id)
+
+        processed_percentage = round(batch["processed"] / batch["total"] * 100)
         is_zipped = batch["zip_uri"] != ""
         return processed_percentage, is_zipped
 
-    def get_batches_ids(self):
+    def iter_processed_elements(self, batch_id):
+        """
+        Iterates over the elements of a batch as they are processed, waiting for the pending ones.
+        :param batch_id: ID of the batch.
+        :return: generator of tuples (url, uri, images uris), where uri is the blob ID of the main screenshot or
+        "Canceled", and images uris is the list of blob IDs of all the images captured for the URL.
+        """
+        batch_id = self._get_batch(batch_id)["batch_id"]
+        sequence = 0
+        count = 0
+        is_completed = False
+
+        while not is_completed:
+            with self.progress_condition:
+                batch = self.store.get_batch(batch_id)
+
+                while batch is not None and count == batch["processed"]:
+                    self.progress_condition.wait()
+                    batch = self.store.get_batch(batch_id)
+
+            if batch is None:
+                raise Exception("Batch {} has been removed.".format(batch_id))
+
+            elements = self.store.get_processed_elements(batch_id, sequence, ITER_PAGE_SIZE)
+
+            for sequence, url, uri, images_uris, reused in elements:
+                yield url, uri, images_uris
+
+            count += len(elements)
+            is_completed = count >= batch["total"]
+
+    def _get_progress_version(self, batch_id):
+        """
+        Must be called with the lock acquired.
+        :return: version of the progress of a batch being processed, or None if it is not being processed.
+        """
+        batch_handle = self.batch_handles.get(batch_id)
+
+        return None if batch_handle is None else batch_handle.version
+
+    def wait_for_progress(self, batch_id, after_sequence=0, timeout=DEFAULT_PROGRESS_WAIT, limit=ITER_PAGE_SIZE):
+        """
+        Waits until a batch progresses past a point: until it has elements processed after a sequence number, or
+        until its ZIP is ready.
+        :param batch_id: ID of the batch.
+        :param after_sequence: sequence number of the last processed element already known (0 for none).
+        :param timeout: maximum seconds to wait.
+        :param limit: maximum amount of processed elements to retrieve.
+        :return: tuple (dict of the batch, list of tuples (sequence number, url, uri, images uris, reused) of the
+        elements processed after the sequence number). The list is empty if the batch did not progress within the
+        timeout.
+        """
+        batch_id = self._parse_batch_id(batch_id)
+        deadline = time.time() + timeout
+
+        while True:
+            with self.lock:
+                version = self._get_progress_version(batch_id)
+
+            # The store is read without the lock; a change after taking the version is noticed by the wait below.
+            batch = self._get_batch(batch_id)
+            elements = self.store.get_processed_elements(batch_id, after_sequence, limit)
+            remaining = deadline - time.time()
+
+            if len(elements) > 0 or batch["zip_uri"] != "" or remaining <= 0:
+                return batch, elements
+
+            with self.progress_condition:
+                self.progress_condition.wait_for(lambda: self._get_progress_version(batch_id) != version, remaining)
+
+    def iter_progress(self, batch_id, after_sequence=0, keep_alive=DEFAULT_PROGRESS_WAIT):
+        """
+        Iterates over the progress of a batch as it happens, until its ZIP is ready.
+        :param batch_id: ID of the batch.
+        :param after_sequence: sequence number of the last processed element already known (0 for none).
+        :param keep_alive: maximum seconds between updates; an update without elements is generated when the batch
+        does not progress for that long.
+        :return: generator of tuples (dict of the batch, list of tuples (sequence number, url, uri, images uris,
+        reused) of the elements processed since the previous update).
+        """
+        is_zipped = False
+
+        while not is_zipped:
+            batch, elements = self.wait_for_progress(batch_id, after_sequence, keep_alive)
+
+            if len(elements) > 0:
+                after_sequence = elements[-1][0]
+
+            # The last elements are retrieved before reporting the ZIP as ready.
+            is_zipped = batch["zip_uri"] != "" and len(elements) < ITER_PAGE_SIZE
+
+            yield batch, elements
+
+    def stream_batch_zip(self, batch_id):
+        """
+        Builds the ZIP of a batch while its elements are being processed. Every distinct screenshot is added to the
+        archive as soon as it is available, and the content.json is added once all the elements are processed.
+        :param batch_id: ID of the batch.
+        :return: generator of the bytes of the archive.
+        """
+        zip_stream = ZipStream()
+        written_uris = set()
+
+        for url, uri, images_uris in self.iter_processed_elements(batch_id):
+            for image_uri in images_uris:
+                if image_uri in written_uris:
+                    continue
+
+                written_uris.add(image_uri)
+
+                for chunk in zip_stream.write_file(self.blob_store.get_path(image_uri), os.path.basename(image_uri)):
+                    yield chunk
+
+        yield zip_stream.write_bytes("content.json", "".join(self._iter_content_json(int(batch_id))))
+        yield zip_stream.close()
+
+    def list_batches(self, after=None, limit=100):
+        """
+        Lists the IDs of the batches, page by page.
+        :param after: ID of the batch after which the page starts, or None for the first page.
+        :param limit: maximum amount of batches of the page.
+        :return: tuple (list of IDs, ID to request the next page after or None if this page is the last one).
+        """
+        batches_ids = [batch["batch_id"] for batch in self.store.list_batches(after, limit)]
+        next_after = batches_ids[-1] if len(batches_ids) == limit else None
+
+        return batches_ids, next_after
+
+    def get_pending_count(self):
+        """
+        :return: amount of elements of all the batches pending to be processed.
+        """
+        return self.store.get_pending_count()
+
+    def get_stats(self):
+        """
+        :return: dict with the amount of "batches", how many of them are "zipped", "canceled" and "processing", the
+        amount of "pending_elements" among all of them, and how many images were stored in new blobs
+        ("blobs_written") or found already stored ("blobs_deduplicated") since the service was created.
+        """
+        stats = self.store.get_stats()
+        stats["pending_elements"] = self.store.get_pending_count()
+
+        with self.blobs_lock:
+            stats["blobs_written"] = self.blobs_written
+            stats["blobs_deduplicated"] = self.blobs_deduplicated
+
         with self.lock:
-            batches_ids = list(self.batches.keys())
+            stats["processing"] = len(self.batch_handles)
 
-        return batches_ids
+        return stats
 
     def cancel_batch(self, batch_id):
-        if not str(batch_id).isdigit():
-            raise Exception ("specified batch_id is not a valid ID.")
+        batch_id = self._get_batch(batch_id)["batch_id"]
+
+        with self.lock:
+            batch_handle = self.batch_handles.get(batch_id)
+
+            if batch_handle is None or batch_handle.canceled:
+                return
 
-        batch_id = int(batch_id)
+            # Its queued elements are aborted; the ones not queued yet are canceled in the store.
+            batch_handle.canceled = True
+            last_position = batch_handle.last_position
+
+        processed, total = self.store.cancel_batch(batch_id, last_position)
 
         with self.lock:
-            for request, promise in self.batches[batch_id]["promises"].items(): promise.abort()
+            batch_handle.version += 1
+            self.progress_condition.notify_all()
+            finalize = self._should_finalize(batch_handle, processed, total)
 
-    @staticmethod
-    def _zip_file(folder):
-        filename = "{}".format(str(uuid.uuid4()))
+        if finalize:
+            self.finalization_pool.submit(self._finalize_batch, batch_id)
 
-        make_archive(filename, 'zip', root_dir=folder)
+    def _resume_batches(self):
+        """
+        Resumes the batches that were not zipped when the service was stopped: their pending elements are queued again
+        and the completed ones are finalized.
+        """
+        for batch in self.store.get_unzipped_batches():
+            batch_id = batch["batch_id"]
 
-        filename = "{}.zip".format(filename)
-        dst = os.path.join(ZIP_FOLDER, filename)
+            if batch["total"] == UNSEALED_TOTAL:
+                # Its upload was interrupted; the client never got its ID.
+                self.store.remove_batch(batch_id)
+                continue
 
-        move(filename, dst)
+            batch_handle = _BatchHandle(batch_id, batch["options"], batch["weight"])
 
-        return dst
+            with self.lock:
+                # The service may be started again while its batches are being processed.
+                if batch_id in self.batch_handles:
+                    continue
 
-    def __internal_thread__(self):
-        ServiceInterface.__internal_thread__(self)
+                self.batch_handles[batch_id] = batch_handle
+                self.batches_to_feed.add(batch_id)
 
-        while not self.__get_stop_flag__():
-            try:
+            if batch["canceled"]:
+                processed, total = self.store.cancel_batch(batch_id, -1)
+                batch_handle.canceled = True
+            else:
+                processed, total = batch["processed"], batch["total"]
 
-                with self.lock:
-                    batch_ids = list(self.batches.keys())
+            with self.lock:
+                finalize = self._should_finalize(batch_handle, processed, total)
+
+            if finalize:
+                self.finalization_pool.submit(self._finalize_batch, batch_id)
+
+            print("Resumed batch {} ({}/{} elements processed).".format(batch_id, processed, total))
+
+    def _zip_batch(self, batch_id, dst):
+        """
+        Writes the ZIP of a batch straight from the blobs of its screenshots. Screenshots are stored without
+        compression, as they are already compressed images; the content.json is deflated.
+        :return: path of the ZIP.
+        """
+        written_uris = set()
+        after_sequence = 0
+
+        with ZipFile(dst, "w", ZIP_STORED) as zip_file:
+            while True:
+                elements = self.store.get_processed_elements(batch_id, after_sequence, ITER_PAGE_SIZE)
+
+                for sequence, url, uri, images_uris, reused in elements:
+                    for image_uri in images_uris:
+                        if image_uri not in written_uris:
+                            written_uris.add(image_uri)
+                            zip_file.write(self.blob_store.get_path(image_uri), os.path.basename(image_uri))
 
-                for batch_id in batch_ids:
-                    completion_percentage, is_zipped = self.get_processed_percentage(batch_id)
+                if len(elements) < ITER_PAGE_SIZE:
+                    break
 
-                    if completion_percentage == 100 and not is_zipped:
-                            with self.lock:
+                after_sequence = elements[-1][0]
 
-                                if batch_id not in self.batches:
-                                    continue
+            content_info = ZipInfo("content.json", time.localtime(time.time())[:6])
+            content_info.compress_type = ZIP_DEFLATED
 
-                                batch_data = self.batches[batch_id]
+            with zip_file.open(content_info, "w", force_zip64=True) as f:
+                for piece in self._iter_content_json(batch_id):
+                    f.write(piece.encode())
 
-                            url_uri_map = batch_data["url_uri_map"]
-                            father_uri = batch_data["uri"]
+        return dst
+
+    def start(self):
+        self.stop_event.clear()
+
+        # Before serving, so that uploads in progress can be told apart from interrupted ones.
+        self._resume_batches()
+        ServiceInterface.start(self)
 
-                            with open(os.path.join(father_uri, "content.json"), "w") as f:
-                                json.dump(url_uri_map, f, indent=4)
+    def stop(self, wait_for_finish=True):
+        with self.lock:
+            self.stop_event.set()
+            self.feed_condition.notify_all()
 
-                            zip_uri = self._zip_file(father_uri)
+        ServiceInterface.stop(self, wait_for_finish)
 
-                            with self.lock:
+    def __internal_thread__(self):
+        ServiceInterface.__internal_thread__(self)
 
-                                if batch_id not in self.batches:
-                                    continue
+        # Batches are finalized from the callbacks of their elements; this thread refills their windows.
+        while not self.stop_event.is_set():
+            with self.feed_condition:
+                while len(self.batches_to_feed) == 0 and not self.stop_event.is_set():
+                    self.feed_condition.wait()
 
-                                self.batches[batch_id]["zip_uri"] = zip_uri
-            except:
-                # We don't care if a key has been removed from the list, next while iteration will take rid of it.
-                pass
+                batches_ids = self.batches_to_feed
+                self.batches_to_feed = set()
 
-            sleep(0.1)
+            for batch_id in batches_ids:
+                self._feed_batch(batch_id)
 
         self.__set_status__(SERVICE_STOPPED)
 
     def __del__(self):
-        rmtree(ZIP_FOLDER)
\ No newline at end of file
+        self.finalization_pool.shutdown(wait=False)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import uuid
+
+__author__ = 'Iván de Paz Centeno'
+
+DEFAULT_BLOBS_FOLDER = "/tmp/screenshooter_batches/blobs/"
+
+
+class BlobStore(object):
+    """
+    Content-addressed store of the images of the batches.
+
+    Each image is stored once, in a blob named after the hash of its content: identical captures (error pages, parked
+    domains, login walls...) share the same blob no matter how many URLs or batches they belong to. A blob ID is the
+    SHA-256 hex digest of the content followed by the extension of its format. Blobs are spread in subfolders named
+    after the first characters of their IDs, so that no folder grows too large.
+
+    The store does not know who references its blobs; the references are counted by the batch store.
+    """
+
+    def __init__(self, folder=DEFAULT_BLOBS_FOLDER):
+        """
+        :param folder: folder of the blobs.
+        """
+        self.folder = folder
+
+    @staticmethod
+    def get_blob_id(data, extension):
+        """
+        :param data: bytes-like content of the blob.
+        :param extension: extension of the format of the content.
+        :return: ID of the blob of the content.
+        """
+        return "{}.{}".format(hashlib.sha256(data).hexdigest(), extension)
+
+    def get_path(self, blob_id):
+        """
+        :return: path of the file of a blob.
+        """
+        if os.path.isabs(blob_id):
+            # Screenshots of batches stored before the blobs, referenced by their paths.
+            return blob_id
+
+        return os.path.join(self.folder, blob_id[:2], blob_id)
+
+    def put(self, data, extension):
+        """
+        Stores a content, unless a blob with the same content is already stored.
+        :param data: bytes-like content.
+        :param extension: extension of the format of the content.
+        :return: tuple (blob ID, True if the blob was written or False if it was already stored).
+        """
+        blob_id = self.get_blob_id(data, extension)
+        path = self.get_path(blob_id)
+
+        if os.path.exists(path):
+            return blob_id, False
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Written aside and moved into place, so that a blob is either complete or missing.
+        temporary_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+
+        with open(temporary_path, "wb") as f:
+            f.write(data)
+
+        os.replace(temporary_path, path)
+
+        return blob_id, True
+
+    def remove(self, blob_ids):
+        """
+        Removes blobs that are not referenced anymore.
+        :param blob_ids: list of IDs of the blobs.
+        """
+        for blob_id in blob_ids:
+            try:
+                os.remove(self.get_path(blob_id))
+            except OSError:
+                pass
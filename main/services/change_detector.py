@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import hashlib
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+__author__ = 'Iván de Paz Centeno'
+
+DEFAULT_WORKERS = 8
+DEFAULT_TIMEOUT = 10
+DEFAULT_MAX_BYTES = 5 * 1024 * 1024
+USER_AGENT = "web-screenshooter change detector"
+
+CHECK_UNCHANGED = "unchanged"
+CHECK_CHANGED = "changed"
+CHECK_FAILED = "failed"
+
+
+class ChangeDetector(object):
+    """
+    Tells whether a webpage changed since its last capture with a plain HTTP request, much cheaper than rendering it in
+    a browser.
+
+    The validators of a page are its ETag, its Last-Modified date and the hash of its HTML. The previous ones are sent
+    as a conditional request: the page is unchanged if the server answers 304 Not Modified, or if it answers with the
+    same ETag or the same HTML. Anything else, failures included, counts as a change, so that the page is captured.
+
+    Checks run in a pool of threads of their own, so that they never take a browser worker.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, timeout=DEFAULT_TIMEOUT, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param workers: amount of checks run at the same time.
+        :param timeout: seconds a check waits for the server.
+        :param max_bytes: maximum bytes of HTML hashed; the rest of the page is ignored.
+        """
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.lock = Lock()
+        self.stats = {CHECK_UNCHANGED: 0, CHECK_CHANGED: 0, CHECK_FAILED: 0}
+
+    @classmethod
+    def from_config(cls, change_detection_config):
+        """
+        Builds the detector from the "change_detection" section of the configuration.
+        :param change_detection_config: dict with the keys "workers", "timeout" and "max_bytes".
+        """
+        return cls(int(change_detection_config.get('workers', DEFAULT_WORKERS)),
+                   float(change_detection_config.get('timeout', DEFAULT_TIMEOUT)),
+                   int(change_detection_config.get('max_bytes', DEFAULT_MAX_BYTES)))
+
+    def submit(self, function, *args):
+        """
+        Runs a function in the pool of the checks.
+        """
+        return self.pool.submit(function, *args)
+
+    def _fetch(self, url, previous_validators):
+        headers = {"User-Agent": USER_AGENT}
+
+        if previous_validators.get('etag') is not None:
+            headers["If-None-Match"] = previous_validators['etag']
+
+        if previous_validators.get('last_modified') is not None:
+            headers["If-Modified-Since"] = previous_validators['last_modified']
+
+        http_request = urllib.request.Request(url, headers=headers)
+
+        try:
+            with urllib.request.urlopen(http_request, timeout=self.timeout) as response:
+                content_hash = hashlib.sha256(response.read(self.max_bytes)).hexdigest()
+                return response.status, response.headers, content_hash
+
+        except urllib.error.HTTPError as ex:
+            if ex.code != 304:
+                raise
+
+            return ex.code, ex.headers, None
+
+    def check(self, url, previous_validators=None):
+        """
+        Checks whether a webpage changed.
+        :param url: URL of the webpage.
+        :param previous_validators: dict with the "etag", "last_modified" and "content_hash" of the webpage when it was
+        last captured, or None if they are unknown.
+        :return: tuple (outcome, validators), where outcome is CHECK_UNCHANGED, CHECK_CHANGED or CHECK_FAILED, and
+        validators are the current ones of the webpage (None if the check failed).
+        """
+        previous_validators = previous_validators or {}
+
+        try:
+            status, headers, content_hash = self._fetch(url, previous_validators)
+
+        except (OSError, ValueError) as ex:
+            print("Could not check whether {} changed: {}".format(url, ex))
+            outcome, validators = CHECK_FAILED, None
+
+        else:
+            if status == 304:
+                validators = previous_validators
+                outcome = CHECK_UNCHANGED
+
+            else:
+                validators = {"etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified"),
+                              "content_hash": content_hash}
+                is_same_etag = validators["etag"] is not None and validators["etag"] == previous_validators.get('etag')
+                is_same_content = content_hash == previous_validators.get('content_hash')
+                outcome = CHECK_UNCHANGED if is_same_etag or is_same_content else CHECK_CHANGED
+
+        with self.lock:
+            self.stats[outcome] += 1
+
+        return outcome, validators
+
+    def get_stats(self):
+        """
+        :return: dict with the amount of checks of each outcome.
+        """
+        with self.lock:
+            stats = dict(self.stats)
+
+        return stats
+
+    def terminate(self):
+        self.pool.shutdown(wait=False)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import bisect
+from threading import Lock
+
+__author__ = 'Iván de Paz Centeno'
+
+# Upper bounds, in seconds, of the buckets of the latency histograms.
+DEFAULT_LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Stages of a capture.
+STAGE_QUEUE_WAIT = "queue_wait"
+STAGE_NAVIGATION = "navigation"
+STAGE_READINESS_WAIT = "readiness_wait"
+STAGE_SCREENSHOT = "screenshot"
+STAGE_ENCODE = "encode"
+STAGE_FILE_WRITE = "file_write"
+STAGE_ARCHIVE_BUILD = "archive_build"
+
+# Stages measured by the processors, reported in the "timings" metadata of their results.
+PROCESSOR_STAGES = [STAGE_NAVIGATION, STAGE_READINESS_WAIT, STAGE_SCREENSHOT]
+
+
+class Histogram(object):
+    """
+    Distribution of observed values in buckets of fixed upper bounds, as a Prometheus histogram.
+    """
+
+    def __init__(self, buckets=None):
+        self.buckets = list(buckets or DEFAULT_LATENCY_BUCKETS)
+        self.lock = Lock()
+
+        # The last count is the one of the values above every bound.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def get_snapshot(self):
+        """
+        :return: tuple (list of (upper bound, cumulative count) including "+Inf", sum, count).
+        """
+        with self.lock:
+            counts = list(self.counts)
+            total_sum = self.sum
+
+        cumulative_counts = []
+        cumulative_count = 0
+
+        for bound, count in zip(self.buckets + ["+Inf"], counts):
+            cumulative_count += count
+            cumulative_counts.append((bound, cumulative_count))
+
+        return cumulative_counts, total_sum, cumulative_count
+
+
+class StageTimings(object):
+    """
+    Latency histograms of the stages of the captures, by stage name.
+    """
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets
+        self.lock = Lock()
+        self.histograms = {}
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+
+            if histogram is None:
+                histogram = Histogram(self.buckets)
+                self.histograms[stage] = histogram
+
+        histogram.observe(seconds)
+
+    def observe_all(self, timings):
+        """
+        :param timings: dict of stage name -> seconds.
+        """
+        for stage, seconds in timings.items():
+            self.observe(stage, seconds)
+
+    def get_snapshots(self):
+        """
+        :return: dict of stage name -> snapshot of its histogram (see Histogram.get_snapshot()).
+        """
+        with self.lock:
+            histograms = dict(self.histograms)
+
+        return {stage: histogram.get_snapshot() for stage, histogram in histograms.items()}
+
+
+class MetricsWriter(object):
+    """
+    Writes metrics in the Prometheus text exposition format.
+    """
+
+    def __init__(self, prefix="screenshooter_"):
+        self.prefix = prefix
+        self.lines = []
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ""
+
+        return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                              for name, value in labels.items()) + "}"
+
+    def _add_family(self, name, metric_type, description, samples):
+        """
+        :param samples: list of tuples (labels dict, value).
+        """
+        name = self.prefix + name
+        self.lines.append("# HELP {} {}".format(name, description))
+        self.lines.append("# TYPE {} {}".format(name, metric_type))
+
+        for labels, value in samples:
+            self.lines.append("{}{} {}".format(name, self._format_labels(labels), value))
+
+    def add_gauge(self, name, description, samples):
+        """
+        :param samples: value, or list of tuples (labels dict, value).
+        """
+        self._add_family(name, "gauge", description, samples if isinstance(samples, list) else [({}, samples)])
+
+    def add_counter(self, name, description, samples):
+        """
+        :param samples: value, or list of tuples (labels dict, value).
+        """
+        self._add_family(name, "counter", description, samples if isinstance(samples, list) else [({}, samples)])
+
+    def add_histograms(self, name, description, label_name, snapshots):
+        """
+        :param label_name: name of the label that tells the histograms apart.
+        :param snapshots: dict of label value -> snapshot of its histogram (see Histogram.get_snapshot()).
+        """
+        name = self.prefix + name
+        self.lines.append("# HELP {} {}".format(name, description))
+        self.lines.append("# TYPE {} histogram".format(name))
+
+        for label_value, (cumulative_counts, total_sum, count) in sorted(snapshots.items()):
+            for bound, cumulative_count in cumulative_counts:
+                labels = self._format_labels({label_name: label_value, "le": bound})
+                self.lines.append("{}_bucket{} {}".format(name, labels, cumulative_count))
+
+            labels = self._format_labels({label_name: label_value})
+            self.lines.append("{}_sum{} {}".format(name, labels, total_sum))
+            self.lines.append("{}_count{} {}".format(name, labels, count))
+
+    def get_text(self):
+        return "\n".join(self.lines) + "\n"
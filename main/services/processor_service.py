@@ -1,83 +1,485 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-from time import sleep
+import time
+from threading import Lock
 
-from main.parallelization.pool_interface import PoolInterface
+from main.parallelization.pool_interface import PoolInterface, DISPATCH, ABORT, SKIP
 from main.parallelization.result_promise import ResultPromise, WaitableEvent
 from main.parallelization.service_interface import ServiceInterface, SERVICE_STOPPED
+from main.processors.capture_result import CaptureResult
+from main.processors.recycling_policy import RECYCLE_REASONS
+from main.services.admission_control import CaptureRateMeter
+from main.services.change_detector import CHECK_UNCHANGED
+from main.services.metrics import StageTimings, STAGE_QUEUE_WAIT, STAGE_ENCODE
+from main.services.tracing import Tracer, SPAN_CAPTURE, SPAN_CACHE_LOOKUP, SPAN_DISPATCH, SPAN_RESULT_TRANSFER, \
+    SPAN_CHANGE_CHECK
 
 __author__ = 'Iván de Paz Centeno'
 
 
+class _Capture(object):
+    """
+    Capture in flight of a cache key, shared by every request of that key.
+    """
+
+    def __init__(self, request):
+        self.queued_requests = [request]
+        self.queued_time = time.time()
+        self.dispatched_request = None
+        self.dispatch_time = None
+        self.promises = []
+        self.aborted_promises = set()
+
+        # Validators of the webpage checked before queuing the capture, stored with its result.
+        self.validators = None
+
+
 class ProcessorService(ServiceInterface, PoolInterface):
+    """
+    Captures the requests in the pool of processors.
+
+    Requests are coalesced by their cache key (normalized URL and capture options): while a key is being captured, new
+    requests of the same key subscribe to the capture in flight instead of capturing it again. Every subscriber gets its
+    own promise, with its own request and callback, and all of them get the result. A capture is only aborted if all of
+    its subscribers abort it before it is dispatched, and it is promoted to the priority class of its most prioritary
+    subscriber.
 
-    def __init__(self, processor_class, parallel_workers=10, processor_class_init_args=None):
+    Requests with the option "if_changed" whose cached result expired are checked by the change detector before being
+    queued: if their webpage did not change, the previous result is renewed and served with the metadata "cache" set to
+    "revalidated", without taking a worker.
+    """
+
+    def __init__(self, processor_class, parallel_workers=10, processor_class_init_args=None, result_cache=None,
+                 image_encoder=None, requests_per_worker=1, scheduler=None, tracer=None, change_detector=None):
         ServiceInterface.__init__(self)
         PoolInterface.__init__(self, processor_class=processor_class, pool_limit=parallel_workers,
-                               processor_class_init_args=processor_class_init_args)
+                               processor_class_init_args=processor_class_init_args, chunk_size=requests_per_worker,
+                               scheduler=scheduler)
         self.total_workers = parallel_workers
-        self.promises = {}
-        self.promises_lock = self.manager.Lock()
+        self.captures = {}
+        self.coalesced_requests = 0
+        self.promises_lock = Lock()
         self.promises_event = WaitableEvent()
+        self.result_cache = result_cache
+        self.image_encoder = image_encoder
+        self.capture_rate_meter = CaptureRateMeter()
+        self.stage_timings = StageTimings()
+        self.tracer = tracer if tracer is not None else Tracer()
+        self.change_detector = change_detector
+        self.browser_recycles = {}
+        self.blocked_requests = 0
 
     def queue_request(self, request, callback=None):
+        cache_key = request.get_cache_key()
+
+        promise = ResultPromise(request, self, callback, promise_lock=self.promises_lock,
+                                promise_event=self.promises_event)
+
+        if self.result_cache is not None:
+            start_time = time.time()
+            cached_result = self.result_cache.get(cache_key, request.get_option('max_age'))
+            self.tracer.add_span(self._get_trace_id(request), SPAN_CACHE_LOOKUP, start_time, time.time(),
+                                 attributes={"url": str(request), "hit": cached_result is not None})
+
+            if cached_result is not None:
+                # Served straight from the cache, without taking a worker.
+                promise.set_result(cached_result)
+                return promise
+
+        if self._is_revalidable(request, cache_key):
+            self.change_detector.submit(self._revalidate, request, promise, cache_key)
+        else:
+            self._subscribe(request, promise, cache_key)
+
+        return promise
+
+    def _is_revalidable(self, request, cache_key):
+        """
+        Checks whether a request has to be checked for changes of its webpage before being queued. Requests that can
+        join a capture in flight are not.
+        """
+        if self.change_detector is None or self.result_cache is None or not request.get_option('if_changed'):
+            return False
+
+        with self.lock:
+            is_in_flight = cache_key in self.captures
+
+        return not is_in_flight
+
+    def _revalidate(self, request, promise, cache_key):
+        """
+        Serves the previous result of a request if its webpage did not change since it was captured; subscribes the
+        request to a new capture otherwise.
+        Invoked in the threads of the change detector.
+        """
+        validators = None
+
+        try:
+            start_time = time.time()
+            previous_result = self.result_cache.get_stale(cache_key)
+            previous_validators = None if previous_result is None else previous_result.get_metadata('validators')
+            outcome, validators = self.change_detector.check(request.get_url(), previous_validators)
+            self.tracer.add_span(self._get_trace_id(request), SPAN_CHANGE_CHECK, start_time, time.time(),
+                                 attributes={"url": str(request), "outcome": outcome})
+
+            if outcome == CHECK_UNCHANGED and previous_result is not None:
+                renewed_result = CaptureResult(previous_result.get_images(),
+                                               dict(previous_result.get_metadata(), validators=validators))
+
+                if validators != previous_validators or not self.result_cache.touch(cache_key):
+                    self.result_cache.put(cache_key, renewed_result)
+
+                promise.set_result(CaptureResult(renewed_result.get_images(),
+                                                 dict(renewed_result.get_metadata(), cache="revalidated")))
+                return
+
+        except Exception as ex:
+            print("Could not revalidate {}: {}".format(request, ex))
+
+        self._subscribe(request, promise, cache_key, validators)
+
+    def _subscribe(self, request, promise, cache_key, validators=None):
+        """
+        Subscribes the promise of a request to the capture in flight of its cache key, starting the capture if there
+        is none.
+        :param validators: validators of the webpage, to be stored with the result of the capture.
+        """
+        request_to_queue = None
+
         with self.lock:
-            if request in self.promises:
-                promise = self.promises[request]
-                promise.discard_one_abort()
+            capture = self.captures.get(cache_key)
+
+            if capture is None:
+                capture = _Capture(request)
+                self.captures[cache_key] = capture
+                request_to_queue = request
 
             else:
-                promise = ResultPromise(self.manager, request, self, callback, promise_lock=self.promises_lock,
-                                        promise_event=self.promises_event)
-                self.promises[request] = promise
-                PoolInterface.queue_request(self, request)
+                self.coalesced_requests += 1
 
-        return promise
+                # A new subscriber revives a capture aborted by the previous ones.
+                capture.aborted_promises.clear()
+
+                if capture.dispatched_request is None and \
+                        self.get_priority(request) < min(self.get_priority(queued_request)
+                                                         for queued_request in capture.queued_requests):
+                    # Queued again in the class of the new subscriber; whichever copy is taken first is dispatched.
+                    capture.queued_requests.append(request)
+                    request_to_queue = request
+
+            capture.promises.append(promise)
+
+            if validators is not None:
+                capture.validators = validators
+
+        # The queue has its own lock, which must not be acquired while holding the lock of the captures.
+        if request_to_queue is not None:
+            PoolInterface.queue_request(self, request_to_queue)
+
+    @staticmethod
+    def _get_trace_id(request):
+        return request.get_trace_id() if hasattr(request, 'get_trace_id') else None
+
+    def get_priority(self, request):
+        return self.processing_queue.get_priority(request) if hasattr(self.processing_queue, 'get_priority') else 0
+
+    def _get_dispatch_action(self, request):
+        """
+        Dispatches only the first copy of a capture taken from the queue, unless all its subscribers aborted it.
+        """
+        with self.lock:
+            capture = self.captures.get(request.get_cache_key())
+
+            if capture is None or capture.dispatched_request is not None or \
+                    not any(queued_request is request for queued_request in capture.queued_requests):
+                dispatch_action = SKIP
+
+            elif all(self._is_promise_aborted(capture, promise) for promise in capture.promises):
+                dispatch_action = ABORT
+
+            else:
+                capture.dispatched_request = request
+                capture.dispatch_time = time.time()
+                self.stage_timings.observe(STAGE_QUEUE_WAIT, capture.dispatch_time - capture.queued_time)
+                dispatch_action = DISPATCH
+
+        return dispatch_action
+
+    def _request_requeued(self, request):
+        """
+        A capture whose request is queued again is pending to be dispatched again.
+        """
+        with self.lock:
+            capture = self.captures.get(request.get_cache_key())
+
+            if capture is not None and capture.dispatched_request is request:
+                capture.dispatched_request = None
+                capture.dispatch_time = None
+                capture.queued_time = time.time()
+                capture.queued_requests = [request]
+
+    @staticmethod
+    def _is_promise_aborted(capture, promise):
+        """
+        Checks whether a subscriber aborted its capture, either through its promise or because its request was
+        canceled (for example, by the cancellation of its batch).
+        Must be called with the lock acquired.
+        """
+        request = promise.get_request()
+
+        return promise in capture.aborted_promises or (hasattr(request, 'is_canceled') and request.is_canceled())
+
+    def abort_request(self, request):
+        """
+        Aborts the subscription of a request to its capture. The capture is only aborted when all its subscribers are.
+        :param request: request of the promise to abort.
+        """
+        with self.lock:
+            capture = self.captures.get(request.get_cache_key())
+
+            if capture is None:
+                return
+
+            for promise in capture.promises:
+                if promise.get_request() is request:
+                    capture.aborted_promises.add(promise)
+
+    def is_request_aborted(self, request):
+
+        with self.lock:
+            capture = self.captures.get(request.get_cache_key())
+            aborted = capture is not None and any(promise.get_request() is request and
+                                                  self._is_promise_aborted(capture, promise)
+                                                  for promise in capture.promises)
+
+        return aborted
 
     def get_queue_remaining(self):
 
         with self.lock_process_variable:
-            queue_size = self.processing_queue.qsize()
+            queue_size = len(self.processing_queue)
 
         return queue_size
 
+    def _record_result_metrics(self, result):
+        """
+        Accounts the stage timings and the browser recycles reported by the processor in the metadata of a result.
+        """
+        self.stage_timings.observe_all(result.get_metadata('timings', {}))
+
+        if result.get_metadata('encoding_time') is not None:
+            self.stage_timings.observe(STAGE_ENCODE, result.get_metadata('encoding_time'))
+
+        recycle_reason = result.get_metadata('browser_recycled')
+        blocked_requests = result.get_metadata('blocked_requests')
+
+        if blocked_requests:
+            with self.lock:
+                self.blocked_requests += blocked_requests
+
+        if recycle_reason is not None:
+            # Results of remote agents can report anything; the reasons label the metrics, so they are a fixed set.
+            recycle_reason = recycle_reason if recycle_reason in RECYCLE_REASONS else "other"
+
+            with self.lock:
+                self.browser_recycles[recycle_reason] = self.browser_recycles.get(recycle_reason, 0) + 1
+
+    def _record_spans(self, request, capture, result, finish_time):
+        """
+        Records the spans of a capture in the trace of every subscriber: the ones measured by the service around the
+        ones reported by the processor in the "spans" metadata of the result.
+        """
+        spans = [(SPAN_CAPTURE, capture.queued_time, finish_time, None,
+                  {"url": str(request), "subscribers": len(capture.promises), "failed": result is None})]
+
+        if capture.dispatch_time is not None:
+            spans.append((STAGE_QUEUE_WAIT, capture.queued_time, capture.dispatch_time, None, None))
+
+        if result is not None:
+            worker_pid = result.get_metadata('worker_pid')
+            worker_started_at = result.get_metadata('worker_started_at')
+            delivered_at = result.get_metadata('delivered_at')
+            received_at = result.get_metadata('received_at')
+
+            if capture.dispatch_time is not None and worker_started_at is not None:
+                spans.append((SPAN_DISPATCH, capture.dispatch_time, worker_started_at, None, None))
+
+            for name, start_time, end_time in result.get_metadata('spans', []):
+                spans.append((name, start_time, end_time, worker_pid, None))
+
+            if delivered_at is not None and received_at is not None:
+                spans.append((SPAN_RESULT_TRANSFER, delivered_at, received_at, None, None))
+
+            if result.get_metadata('encoding_time') is not None and received_at is not None:
+                spans.append((STAGE_ENCODE, received_at, finish_time, None, None))
+
+        for promise in capture.promises:
+            trace_id = self._get_trace_id(promise.get_request())
+
+            for span in spans:
+                self.tracer.add_span(trace_id, *span)
+
+    def get_browser_recycles(self):
+        """
+        :return: dict of reason -> amount of browsers recycled by that reason, among the local and remote workers.
+        """
+        with self.lock:
+            browser_recycles = dict(self.browser_recycles)
+
+        return browser_recycles
+
+    def get_queued_count(self, class_name):
+        """
+        Counts the requests queued ahead of a new request of a priority class.
+        :param class_name: name of the priority class.
+        """
+        with self.lock_process_variable:
+            if hasattr(self.processing_queue, 'get_queued_count'):
+                queued_count = self.processing_queue.get_queued_count(class_name)
+            else:
+                queued_count = len(self.processing_queue)
+
+        return queued_count
+
+    def get_capture_slots(self):
+        """
+        :return: amount of captures the local workers can have in flight at the same time.
+        """
+        return self.total_workers * self.chunk_size
+
+    def get_capture_rate(self):
+        """
+        Estimates the captures per second the service is able to finish: the highest of the measured rate and the rate
+        the local workers achieve with the measured duration of the captures. The latter keeps the estimate accurate
+        while the service is not busy.
+        :return: captures per second, or None if no capture was measured yet.
+        """
+        measured_rate = self.capture_rate_meter.get_rate()
+        mean_duration = self.capture_rate_meter.get_mean_duration()
+
+        if measured_rate is None:
+            return None
+
+        if mean_duration is not None and mean_duration > 0:
+            measured_rate = max(measured_rate, self.get_capture_slots() / mean_duration)
+
+        return measured_rate if measured_rate > 0 else None
+
+    def get_cache_stats(self):
+        """
+        Retrieves the counters of the result cache.
+        :return: dict of counters, or None if the service has no cache.
+        """
+        if self.result_cache is None:
+            return None
+
+        return self.result_cache.get_stats()
+
+    def get_change_detection_stats(self):
+        """
+        Retrieves the counters of the checks of changes of the webpages.
+        :return: dict of counters, or None if the service has no change detector.
+        """
+        if self.change_detector is None:
+            return None
+
+        return self.change_detector.get_stats()
+
+    def can_encode_images(self):
+        """
+        Checks whether the service is able to post-process the images of the results.
+        :return: True if the service has an image encoder.
+        """
+        return self.image_encoder is not None
+
     def get_workers_processing(self):
 
         workers_free = self.get_processes_free()
         return self.total_workers - workers_free
 
-    def __internal_thread__(self):
-        ServiceInterface.__internal_thread__(self)
+    def terminate(self):
+        PoolInterface.terminate(self)
 
-        while not self.__get_stop_flag__():
+        if self.image_encoder is not None:
+            self.image_encoder.terminate()
 
-            if self.get_queue_remaining() == 0 or self.get_processes_free() == 0:
-                sleep(0.1)
+        if self.change_detector is not None:
+            self.change_detector.terminate()
 
-            self.process_queue()
+    def start(self):
+        PoolInterface.resume(self)
+        ServiceInterface.start(self)
+
+    def stop(self, wait_for_finish=True):
+        # Wakes up the dispatcher so that it notices the stop.
+        PoolInterface.do_stop(self)
+        ServiceInterface.stop(self, wait_for_finish)
+
+    def __internal_thread__(self):
+        ServiceInterface.__internal_thread__(self)
+
+        while not self.__get_stop_flag__() and not self._stop_requested():
+            self.process_queue(block=True)
 
         self.__set_status__(SERVICE_STOPPED)
 
     def process_finished(self, wrapped_result):
         """
         Method invoked when the process of the processor finished processing the request.
+        The images of the result are post-processed by the image encoder if the request requires it.
         :param wrapped_result: parameters of the result
         :return:
         """
+        request = wrapped_result[0]
+        result = wrapped_result[1]
+
+        if result is not None:
+            result.set_metadata("received_at", time.time())
+
+        if result is not None and self.image_encoder is not None and self.image_encoder.is_required(request):
+            self.image_encoder.encode(request, result, self._request_finished)
+        else:
+            self._request_finished(request, result)
 
+    def _request_finished(self, request, result):
+        """
+        Delivers the result of a capture to every subscriber.
+        :param request: request processed.
+        :param result: result of the request, with its images still spooled.
+        """
         try:
-            request = wrapped_result[0]
-            result = wrapped_result[1]
+            if result is not None:
+                result.attach_images()
+
+            # A result captured without the blocking profiles of its request does not match its cache key.
+            if result is not None and self.result_cache is not None and not result.get_metadata('blocking_ignored'):
+                with self.lock:
+                    capture = self.captures.get(request.get_cache_key())
+
+                if capture is not None and capture.validators is not None:
+                    result.set_metadata("validators", capture.validators)
+
+                self.result_cache.put(request.get_cache_key(), result)
 
             with self.lock:
-                if request in self.promises:
-                    promise = self.promises[request]
-                    del self.promises[request]
-                    promise.set_result(result)
-                else:
-                    raise Exception("Retrieved result for a request not listed as queued.")
+                capture = self.captures.pop(request.get_cache_key(), None)
+
+            if capture is None:
+                raise Exception("Retrieved result for a request not listed as queued.")
+
+            self.capture_rate_meter.record(None if capture.dispatch_time is None else
+                                           time.time() - capture.dispatch_time)
+
+            if result is not None:
+                self._record_result_metrics(result)
+
+            self._record_spans(request, capture, result, time.time())
+
+            if result is not None:
+                result.set_metadata("subscribers", len(capture.promises))
+
+            for promise in capture.promises:
+                promise.set_result(result)
 
         except Exception as ex:
             print(ex)
-
-        self.process_queue()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import hmac
+import time
+import uuid
+from collections import OrderedDict
+from threading import Event
+
+from main.parallelization.service_interface import ServiceInterface, SERVICE_STOPPED
+
+__author__ = 'Iván de Paz Centeno'
+
+DEFAULT_LEASE_TIMEOUT = 30
+DEFAULT_MAX_POLL_WAIT = 20
+
+# Seconds between checks of the expired leases.
+EXPIRATION_CHECK_INTERVAL = 1
+
+
+class _Lease(object):
+    """
+    Requests handed to a remote worker, pending to be finished by it.
+    """
+
+    def __init__(self, agent_id, requests, deadline):
+        self.lease_id = uuid.uuid4().hex
+        self.agent_id = agent_id
+        self.jobs = OrderedDict((str(job_id), request) for job_id, request in enumerate(requests))
+        self.deadline = deadline
+
+
+class RemoteWorkersService(ServiceInterface):
+    """
+    Lends requests of a processor service to worker agents running on other machines (see main/bin/worker_agent.py).
+
+    An agent long-polls for a lease of requests, processes them with its own processor and sends back the result of
+    each of them. While it works, it sends heartbeats that keep its leases alive. The requests of a lease that expires
+    (because its agent died or lost the connection) are queued again, to be processed by any other worker.
+    """
+
+    def __init__(self, processor_service, token, lease_timeout=DEFAULT_LEASE_TIMEOUT,
+                 max_poll_wait=DEFAULT_MAX_POLL_WAIT):
+        """
+        Initializes the service.
+        :param processor_service: ProcessorService whose requests are lent.
+        :param token: secret the agents must present. Required: the agents take the requests of every client and their
+        results are served to them.
+        :param lease_timeout: seconds a lease lives without heartbeats of its agent.
+        :param max_poll_wait: maximum seconds an agent can wait for requests in a single poll.
+        """
+        if not token:
+            raise Exception("The remote workers require a token.")
+
+        ServiceInterface.__init__(self)
+        self.processor_service = processor_service
+        self.lease_timeout = lease_timeout
+        self.max_poll_wait = max_poll_wait
+        self.token = token
+        self.leases = {}
+        self.agents = {}
+        self.stop_event = Event()
+
+    @classmethod
+    def from_config(cls, processor_service, remote_workers_config):
+        """
+        Builds the service from the "remote_workers" section of the configuration.
+        :param processor_service: ProcessorService whose requests are lent.
+        :param remote_workers_config: dict with the keys "lease_timeout", "max_poll_wait" and "token".
+        """
+        return cls(processor_service, remote_workers_config.get('token'),
+                   float(remote_workers_config.get('lease_timeout', DEFAULT_LEASE_TIMEOUT)),
+                   float(remote_workers_config.get('max_poll_wait', DEFAULT_MAX_POLL_WAIT)))
+
+    def is_token_valid(self, token):
+        return token is not None and hmac.compare_digest(token.encode(), self.token.encode())
+
+    def _touch_agent(self, agent_id):
+        """
+        Records that an agent is alive.
+        Must be called with the lock acquired.
+        """
+        agent = self.agents.get(agent_id)
+
+        if agent is None:
+            agent = {"leased": 0, "finished": 0, "expired": 0}
+            self.agents[agent_id] = agent
+
+        agent["last_seen"] = time.time()
+
+        return agent
+
+    def lease(self, agent_id, max_jobs, wait):
+        """
+        Lends requests to an agent, waiting for them if there are none.
+        :param agent_id: identifier of the agent.
+        :param max_jobs: maximum amount of requests to lend.
+        :param wait: maximum seconds to wait for requests. It is capped by max_poll_wait.
+        :return: the lease, or None if there were no requests to lend.
+        """
+        with self.lock:
+            self._touch_agent(agent_id)
+
+        requests = self.processor_service.lease_requests(max_jobs, min(wait, self.max_poll_wait))
+
+        if len(requests) == 0:
+            return None
+
+        lease = _Lease(agent_id, requests, time.time() + self.lease_timeout)
+
+        with self.lock:
+            self.leases[lease.lease_id] = lease
+            self._touch_agent(agent_id)["leased"] += len(requests)
+
+        return lease
+
+    def heartbeat(self, agent_id):
+        """
+        Keeps alive the leases of an agent.
+        :param agent_id: identifier of the agent.
+        :return: list of IDs of the leases of the agent that are still alive.
+        """
+        deadline = time.time() + self.lease_timeout
+
+        with self.lock:
+            self._touch_agent(agent_id)
+            leases_ids = []
+
+            for lease in self.leases.values():
+                if lease.agent_id == agent_id:
+                    lease.deadline = deadline
+                    leases_ids.append(lease.lease_id)
+
+        return leases_ids
+
+    def finish_job(self, lease_id, job_id, result):
+        """
+        Delivers the result of a request lent to an agent.
+        :param lease_id: ID of the lease of the request.
+        :param job_id: ID of the request inside the lease.
+        :param result: CaptureResult with the binary data of the images, or None if the capture failed.
+        :return: True if the result was delivered, or False if the lease has expired or has no such job.
+        """
+        with self.lock:
+            lease = self.leases.get(lease_id)
+
+            if lease is None or job_id not in lease.jobs:
+                return False
+
+            request = lease.jobs.pop(job_id)
+            lease.deadline = time.time() + self.lease_timeout
+            self._touch_agent(lease.agent_id)["finished"] += 1
+
+            if len(lease.jobs) == 0:
+                del self.leases[lease_id]
+
+        # The binary data of the images is already in this process: it is wrapped in buffers when the result is
+        # delivered, without going through spool files as the results of the local workers do.
+        self.processor_service.finish_request(request, result)
+
+        return True
+
+    def _expire_leases(self):
+        """
+        Queues again the requests of the leases whose agents stopped sending heartbeats.
+        """
+        now = time.time()
+
+        with self.lock:
+            expired_leases = [lease for lease in self.leases.values() if lease.deadline < now]
+
+            for lease in expired_leases:
+                del self.leases[lease.lease_id]
+                self._touch_agent(lease.agent_id)["expired"] += len(lease.jobs)
+
+        for lease in expired_leases:
+            print("Lease {} of agent {} expired; queueing again its {} requests.".format(lease.lease_id, lease.agent_id,
+                                                                                       len(lease.jobs)))
+            self.processor_service.requeue_requests(list(lease.jobs.values()))
+
+    def get_agents_stats(self):
+        """
+        Retrieves the state of the agents seen so far.
+        :return: dict of agent ID -> dict with the seconds since it was last seen, its requests in flight and its
+        counters of requests leased, finished and expired.
+        """
+        now = time.time()
+
+        with self.lock:
+            agents_stats = {agent_id: dict(agent, last_seen=now - agent["last_seen"], in_flight=0)
+                            for agent_id, agent in self.agents.items()}
+
+            for lease in self.leases.values():
+                agents_stats[lease.agent_id]["in_flight"] += len(lease.jobs)
+
+        return agents_stats
+
+    def start(self):
+        self.stop_event.clear()
+        ServiceInterface.start(self)
+
+    def stop(self, wait_for_finish=True):
+        self.stop_event.set()
+        ServiceInterface.stop(self, wait_for_finish)
+
+    def __internal_thread__(self):
+        ServiceInterface.__internal_thread__(self)
+
+        while not self.stop_event.wait(EXPIRATION_CHECK_INTERVAL):
+            self._expire_leases()
+
+        self.__set_status__(SERVICE_STOPPED)
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import pickle
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock
+
+from main.parallelization.result_buffer import ScreenshotBuffer
+from main.processors.capture_result import CaptureResult
+
+__author__ = 'Iván de Paz Centeno'
+
+DEFAULT_MEMORY_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_DISK_MAX_BYTES = 2 * 1024 * 1024 * 1024
+DEFAULT_DISK_FOLDER = "/tmp/screenshooter_cache/"
+DEFAULT_MAX_AGE = 3600
+CACHE_FILE_EXTENSION = ".cache"
+
+
+class ResultCache(object):
+    """
+    Two-tier cache of capture results: a bounded in-memory LRU backed by a bounded on-disk store.
+    Results are identified by the cache key of their requests (see CaptureRequest.get_cache_key()).
+    """
+
+    def __init__(self, memory_max_bytes=DEFAULT_MEMORY_MAX_BYTES, disk_folder=DEFAULT_DISK_FOLDER,
+                 disk_max_bytes=DEFAULT_DISK_MAX_BYTES, max_age=DEFAULT_MAX_AGE):
+        """
+        Initializes the cache. Results already stored in the disk folder are indexed to be served.
+        :param memory_max_bytes: maximum bytes of images to hold in memory.
+        :param disk_folder: folder where the results are stored on disk. If None, the disk tier is disabled.
+        :param disk_max_bytes: maximum bytes of the results stored on disk.
+        :param max_age: default seconds a result is valid for.
+        """
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_folder = disk_folder
+        self.disk_max_bytes = disk_max_bytes
+        self.max_age = max_age
+        self.lock = Lock()
+
+        # key -> (timestamp, result, size). Ordered from the least to the most recently used.
+        self.memory_entries = OrderedDict()
+        self.memory_bytes = 0
+
+        # key -> (timestamp, size). Ordered from the least to the most recently used.
+        self.disk_entries = OrderedDict()
+        self.disk_bytes = 0
+
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "expired": 0, "stores": 0, "evictions": 0}
+
+        if self.disk_folder is not None:
+            self._index_disk_folder()
+
+    @classmethod
+    def from_config(cls, cache_config):
+        """
+        Builds a cache from the "cache" section of the configuration.
+        :param cache_config: dict with the keys "memory_max_bytes", "disk_folder", "disk_max_bytes" and "max_age".
+        :return: ResultCache instance.
+        """
+        return cls(memory_max_bytes=int(cache_config.get('memory_max_bytes', DEFAULT_MEMORY_MAX_BYTES)),
+                   disk_folder=cache_config.get('disk_folder', DEFAULT_DISK_FOLDER) or None,
+                   disk_max_bytes=int(cache_config.get('disk_max_bytes', DEFAULT_DISK_MAX_BYTES)),
+                   max_age=float(cache_config.get('max_age', DEFAULT_MAX_AGE)))
+
+    def _index_disk_folder(self):
+        try:
+            os.makedirs(self.disk_folder)
+        except OSError:
+            pass
+
+        files = []
+
+        for filename in os.listdir(self.disk_folder):
+            if not filename.endswith(CACHE_FILE_EXTENSION):
+                continue
+
+            stat = os.stat(os.path.join(self.disk_folder, filename))
+            files.append((stat.st_mtime, filename[:-len(CACHE_FILE_EXTENSION)], stat.st_size))
+
+        for timestamp, key, size in sorted(files):
+            self.disk_entries[key] = (timestamp, size)
+            self.disk_bytes += size
+
+        self._evict_disk()
+
+    def _get_disk_filename(self, key):
+        return os.path.join(self.disk_folder, key + CACHE_FILE_EXTENSION)
+
+    @staticmethod
+    def _get_result_size(result):
+        return sum(len(image) for image in result.get_images().values())
+
+    def get(self, key, max_age=None):
+        """
+        Retrieves a result from the cache.
+        :param key: cache key of the request.
+        :param max_age: maximum age in seconds of the result for this request. It can only lower the default max age,
+        which is used if None.
+        :return: CaptureResult whose metadata "cache" is "hit", or None if there is no valid result cached.
+        """
+        max_age = self.max_age if max_age is None else min(max_age, self.max_age)
+
+        now = time.time()
+        result = None
+        disk_entry = None
+
+        with self.lock:
+            if key in self.memory_entries:
+                timestamp, result, size = self.memory_entries[key]
+
+                if now - timestamp > max_age:
+                    result = None
+                    self.stats["expired"] += 1
+                else:
+                    self.memory_entries.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+
+            else:
+                disk_entry = self.disk_entries.get(key)
+
+        if disk_entry is not None:
+            timestamp, size = disk_entry
+
+            if now - timestamp > max_age:
+                with self.lock:
+                    self.stats["expired"] += 1
+
+            else:
+                try:
+                    result = self._read_disk_file(key)
+
+                    with self.lock:
+                        if key in self.disk_entries:
+                            self.disk_entries.move_to_end(key)
+                        self.stats["disk_hits"] += 1
+
+                    self._put_memory(key, timestamp, result)
+
+                except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+                    result = None
+
+        if result is None:
+            with self.lock:
+                self.stats["misses"] += 1
+
+            return None
+
+        return CaptureResult(result.get_images(), dict(result.get_metadata(), cache="hit"))
+
+    def get_stale(self, key):
+        """
+        Retrieves a result from the cache however old it is, without accounting it as a hit nor a miss. Used to
+        revalidate expired results instead of capturing their webpages again.
+        :param key: cache key of the request.
+        :return: CaptureResult, or None if there is no result cached.
+        """
+        with self.lock:
+            memory_entry = self.memory_entries.get(key)
+            is_on_disk = key in self.disk_entries
+
+        if memory_entry is not None:
+            return memory_entry[1]
+
+        if not is_on_disk:
+            return None
+
+        try:
+            return self._read_disk_file(key)
+        except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+            return None
+
+    def touch(self, key):
+        """
+        Renews a result, so that its age counts from now.
+        :param key: cache key of the request.
+        :return: True if the result is still cached.
+        """
+        timestamp = time.time()
+
+        with self.lock:
+            is_in_memory = key in self.memory_entries
+
+            if is_in_memory:
+                _, result, size = self.memory_entries[key]
+                self.memory_entries[key] = (timestamp, result, size)
+                self.memory_entries.move_to_end(key)
+
+            is_on_disk = key in self.disk_entries
+
+            if is_on_disk:
+                self.disk_entries[key] = (timestamp, self.disk_entries[key][1])
+                self.disk_entries.move_to_end(key)
+
+        if is_on_disk:
+            try:
+                # The age of the results on disk is read from their files when the cache is created.
+                os.utime(self._get_disk_filename(key), (timestamp, timestamp))
+            except OSError:
+                pass
+
+        return is_in_memory or is_on_disk
+
+    def put(self, key, result):
+        """
+        Stores a result in the cache.
+        :param key: cache key of the request.
+        :param result: CaptureResult to store.
+        """
+        timestamp = time.time()
+
+        # Stored apart from the result delivered to the requests, whose metadata is completed afterwards, so that both
+        # tiers of the cache keep the same metadata.
+        self._put_memory(key, timestamp, CaptureResult(result.get_images(), result.get_metadata()))
+
+        if self.disk_folder is not None:
+            try:
+                size = self._write_disk_file(key, result)
+
+            except OSError as ex:
+                print("Could not store the result {} in the disk cache: {}".format(key, ex))
+                return
+
+            with self.lock:
+                if key in self.disk_entries:
+                    self.disk_bytes -= self.disk_entries[key][1]
+
+                self.disk_entries[key] = (timestamp, size)
+                self.disk_entries.move_to_end(key)
+                self.disk_bytes += size
+
+            self._evict_disk()
+
+        with self.lock:
+            self.stats["stores"] += 1
+
+    def _write_disk_file(self, key, result):
+        """
+        Writes a result into its disk file: a header with the metadata and the sizes of the images, followed by the
+        binary data of the images.
+        :return: size of the file.
+        """
+        images = result.get_images()
+        header = {"images": [(name, len(image)) for name, image in images.items()], "metadata": result.get_metadata()}
+        filename = self._get_disk_filename(key)
+        # Unique per write: threads of the service can store the same key at the same time.
+        tmp_filename = "{}.{}.tmp".format(filename, uuid.uuid4().hex)
+
+        try:
+            with open(tmp_filename, "wb") as f:
+                pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+                for image in images.values():
+                    f.write(image.getbuffer())
+
+            size = os.path.getsize(tmp_filename)
+            os.replace(tmp_filename, filename)
+
+        except OSError:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+
+        return size
+
+    def _read_disk_file(self, key):
+        with open(self._get_disk_filename(key), "rb") as f:
+            header = pickle.load(f)
+            images = [(name, ScreenshotBuffer.from_bytes(f.read(size))) for name, size in header["images"]]
+
+        return CaptureResult(images, header["metadata"])
+
+    def _put_memory(self, key, timestamp, result):
+        size = self._get_result_size(result)
+
+        if size > self.memory_max_bytes:
+            return
+
+        with self.lock:
+            if key in self.memory_entries:
+                self.memory_bytes -= self.memory_entries[key][2]
+
+            self.memory_entries[key] = (timestamp, result, size)
+            self.memory_entries.move_to_end(key)
+            self.memory_bytes += size
+
+            while self.memory_bytes > self.memory_max_bytes:
+                _, (_, _, evicted_size) = self.memory_entries.popitem(last=False)
+                self.memory_bytes -= evicted_size
+                self.stats["evictions"] += 1
+
+    def _evict_disk(self):
+        evicted_keys = []
+
+        with self.lock:
+            while self.disk_bytes > self.disk_max_bytes and len(self.disk_entries) > 0:
+                key, (_, size) = self.disk_entries.popitem(last=False)
+                self.disk_bytes -= size
+                self.stats["evictions"] += 1
+                evicted_keys.append(key)
+
+        for key in evicted_keys:
+            try:
+                os.remove(self._get_disk_filename(key))
+            except OSError:
+                pass
+
+    def get_stats(self):
+        """
+        Retrieves the counters of the cache.
+        :return: dict with the hits, misses, stores and evictions, and the amount of entries and bytes of each tier.
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            stats["memory_entries"] = len(self.memory_entries)
+            stats["memory_bytes"] = self.memory_bytes
+            stats["disk_entries"] = len(self.disk_entries)
+            stats["disk_bytes"] = self.disk_bytes
+
+        return stats
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import re
+import uuid
+from collections import OrderedDict
+from threading import Lock
+
+__author__ = 'Iván de Paz Centeno'
+
+DEFAULT_MAX_TRACES = 1000
+
+# Header of the HTTP requests and responses with the trace ID.
+TRACE_ID_HEADER = "X-Trace-Id"
+
+# Trace IDs accepted from the clients; anything else is replaced by a new one.
+TRACE_ID_PATTERN = re.compile(r"^[0-9A-Za-z_\-]{1,64}$")
+
+# Spans recorded by the service around the spans reported by the processors.
+SPAN_CAPTURE = "capture"
+SPAN_CACHE_LOOKUP = "cache_lookup"
+SPAN_CHANGE_CHECK = "change_check"
+SPAN_DISPATCH = "dispatch"
+SPAN_RESULT_TRANSFER = "result_transfer"
+SPAN_BATCH_CALLBACK = "batch_callback"
+SPAN_HTTP_REQUEST = "http_request"
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+def parse_trace_id(trace_id):
+    """
+    :param trace_id: trace ID sent by a client, or None.
+    :return: the trace ID if it is valid, a new one otherwise.
+    """
+    if trace_id is not None and TRACE_ID_PATTERN.match(trace_id):
+        return trace_id
+
+    return new_trace_id()
+
+
+class Tracer(object):
+    """
+    Keeps the timed spans of the most recent traces, so that the time of a slow capture can be broken down into the
+    stages it went through: the queue, the dispatch, the navigation of the browser, the wait for the page, the
+    screenshot, the transfer of the result to the service, the encoding and the callback of its batch.
+
+    Spans are recorded with absolute timestamps and the process that measured them, and the traces are exportable as
+    JSON and in the Chrome trace event format (chrome://tracing, Perfetto).
+    """
+
+    def __init__(self, max_traces=DEFAULT_MAX_TRACES):
+        """
+        :param max_traces: amount of traces kept; the oldest ones are forgotten.
+        """
+        self.max_traces = max_traces
+        self.lock = Lock()
+        self.traces = OrderedDict()
+
+    @classmethod
+    def from_config(cls, tracing_config):
+        """
+        Builds the tracer from the "tracing" section of the configuration.
+        :param tracing_config: dict with the key "max_traces".
+        """
+        return cls(int(tracing_config.get('max_traces', DEFAULT_MAX_TRACES)))
+
+    def add_span(self, trace_id, name, start_time, end_time, pid=None, attributes=None):
+        """
+        Records a span of a trace.
+        :param trace_id: ID of the trace.
+        :param name: name of the span.
+        :param start_time: timestamp of its start.
+        :param end_time: timestamp of its end.
+        :param pid: process that measured it; by default, the current one.
+        :param attributes: dict of values describing the span.
+        """
+        if trace_id is None or self.max_traces <= 0:
+            return
+
+        span = {
+            "name": name,
+            "start": start_time,
+            "duration": max(end_time - start_time, 0),
+            "pid": pid if pid is not None else os.getpid(),
+            "attributes": attributes or {}
+        }
+
+        with self.lock:
+            spans = self.traces.get(trace_id)
+
+            if spans is None:
+                spans = []
+                self.traces[trace_id] = spans
+
+                while len(self.traces) > self.max_traces:
+                    self.traces.popitem(last=False)
+
+            spans.append(span)
+
+    def get_trace(self, trace_id):
+        """
+        :return: list of the spans of a trace sorted by their start, or None if the trace is not kept.
+        """
+        with self.lock:
+            spans = self.traces.get(trace_id)
+            spans = None if spans is None else list(spans)
+
+        return None if spans is None else sorted(spans, key=lambda span: span["start"])
+
+    @staticmethod
+    def _summarize(trace_id, spans):
+        start_time = min(span["start"] for span in spans)
+        end_time = max(span["start"] + span["duration"] for span in spans)
+        url = next((span["attributes"]["url"] for span in spans if "url" in span["attributes"]), None)
+
+        return {"trace_id": trace_id, "url": url, "start": start_time, "duration": end_time - start_time,
+                "spans": len(spans)}
+
+    def list_traces(self, limit=100, slowest=False):
+        """
+        :param limit: maximum amount of traces to list.
+        :param slowest: if True, the slowest traces are listed first; otherwise, the most recent ones.
+        :return: list of dicts with the "trace_id", "url", "start", "duration" and amount of "spans" of each trace.
+        """
+        with self.lock:
+            traces = [(trace_id, list(spans)) for trace_id, spans in self.traces.items()]
+
+        summaries = [self._summarize(trace_id, spans) for trace_id, spans in traces]
+        summaries.sort(key=lambda summary: summary["duration" if slowest else "start"], reverse=True)
+
+        return summaries[:limit]
+
+    def export_chrome(self, trace_ids):
+        """
+        Exports traces in the Chrome trace event format. Each trace is drawn in its own row of every process.
+        :param trace_ids: list of IDs of the traces to export.
+        :return: dict serializable to JSON.
+        """
+        events = []
+        pids = set()
+
+        for row, trace_id in enumerate(trace_ids):
+            for span in self.get_trace(trace_id) or []:
+                pids.add(span["pid"])
+                events.append({
+                    "name": span["name"],
+                    "cat": "capture",
+                    "ph": "X",
+                    "ts": span["start"] * 1000000,
+                    "dur": span["duration"] * 1000000,
+                    "pid": span["pid"],
+                    "tid": row,
+                    "args": dict(span["attributes"], trace_id=trace_id)
+                })
+
+        for pid in pids:
+            events.append({"name": "process_name", "ph": "M", "pid": pid, "tid": 0,
+                           "args": {"name": "service" if pid == os.getpid() else "worker {}".format(pid)}})
+
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
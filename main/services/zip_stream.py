@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from zipfile import ZipFile, ZIP_STORED
+
+__author__ = 'Iván de Paz Centeno'
+
+READ_CHUNK_SIZE = 256 * 1024
+
+
+class _StreamBuffer(object):
+    """
+    Non-seekable file-like object that accumulates the bytes written into it until they are taken.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        """
+        Takes the bytes written since the last take.
+        :return: bytes
+        """
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class ZipStream(object):
+    """
+    Builds a ZIP archive incrementally. Every write returns the bytes of the archive produced so far, so that the archive
+    can be sent while it is being built, without staging it anywhere.
+
+    Entries are stored without compression, as the screenshots are already compressed images.
+    """
+
+    def __init__(self):
+        self.buffer = _StreamBuffer()
+        self.zip_file = ZipFile(self.buffer, "w", ZIP_STORED)
+
+    def write_file(self, filename, arcname):
+        """
+        Adds a file to the archive.
+        :param filename: path of the file to add.
+        :param arcname: name of the file inside the archive.
+        :return: generator of the bytes of the archive produced while adding the file.
+        """
+        with open(filename, "rb") as source, self.zip_file.open(arcname, "w") as destination:
+            chunk = source.read(READ_CHUNK_SIZE)
+
+            while len(chunk) > 0:
+                destination.write(chunk)
+                yield self.buffer.take()
+                chunk = source.read(READ_CHUNK_SIZE)
+
+        yield self.buffer.take()
+
+    def write_bytes(self, arcname, data):
+        """
+        Adds a file to the archive from its content.
+        :param arcname: name of the file inside the archive.
+        :param data: content of the file.
+        :return: bytes of the archive produced while adding the file.
+        """
+        self.zip_file.writestr(arcname, data)
+        return self.buffer.take()
+
+    def close(self):
+        """
+        Finishes the archive by writing its central directory.
+        :return: last bytes of the archive.
+        """
+        self.zip_file.close()
+        return self.buffer.take()